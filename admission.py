@@ -0,0 +1,287 @@
+import asyncio
+import math
+import os
+import threading
+import time
+
+DEFAULT_MAX_QUEUE = 64
+DEFAULT_QUEUE_TIMEOUT = 10.0
+
+
+class AdmissionRejected(Exception):
+    """A request over a rate or concurrency limit; callers answer 429 with `retry_after`."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class TokenBucket:
+    """`per_minute` units refilled continuously; holds at most one minute's worth."""
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def shortfall(self, amount, now):
+        """Seconds until `amount` units are available. Requests larger than the bucket only need a full bucket."""
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, amount):
+        # May go negative when a request turns out bigger than estimated; later requests pay the debt
+        self.level -= amount
+
+
+class AdmissionLimit:
+    """Requests/min and tokens/min buckets plus a bounded queue for concurrency slots.
+
+    Requests over a rate limit are rejected at once. Requests that find all
+    `max_concurrency` slots taken wait for one, at most `max_queue` of them and
+    each for at most `queue_timeout` seconds; everything beyond is rejected.
+    """
+
+    def __init__(self, name, requests_per_minute=None, tokens_per_minute=None, max_concurrency=None,
+                 max_queue=DEFAULT_MAX_QUEUE, queue_timeout=DEFAULT_QUEUE_TIMEOUT):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.blocked_until = 0.0
+        self._condition = threading.Condition()
+
+    @classmethod
+    def from_env(cls, name, prefix, **defaults):
+        def setting(key, cast):
+            value = os.getenv(f'{prefix}_{key}')
+            return cast(value) if value else defaults.get(key.lower())
+        return cls(name, requests_per_minute=setting('RPM', float), tokens_per_minute=setting('TPM', float),
+                   max_concurrency=setting('MAX_CONCURRENCY', int),
+                   max_queue=setting('MAX_QUEUE', int) or DEFAULT_MAX_QUEUE,
+                   queue_timeout=setting('QUEUE_TIMEOUT', float) or DEFAULT_QUEUE_TIMEOUT)
+
+    def _reject(self, reason, retry_after):
+        self.rejected += 1
+        raise AdmissionRejected(f"{self.name}: {reason}", retry_after)
+
+    def _take_rate(self, tokens):
+        # Called with the condition held
+        now = time.monotonic()
+        if now < self.blocked_until:
+            self._reject("upstream rate limited", self.blocked_until - now)
+        wait = max(self.requests.shortfall(1, now) if self.requests else 0.0,
+                   self.tokens.shortfall(tokens, now) if self.tokens and tokens else 0.0)
+        if wait > 0:
+            self._reject("rate limit exceeded", wait)
+        if self.requests:
+            self.requests.take(1)
+        if self.tokens and tokens:
+            self.tokens.take(tokens)
+
+    def _refund_rate(self, tokens):
+        if self.requests:
+            self.requests.take(-1)
+        if self.tokens and tokens:
+            self.tokens.take(-tokens)
+
+    def _has_slot(self):
+        return self.max_concurrency is None or self.in_flight < self.max_concurrency
+
+    def _admitted(self, waited):
+        self.in_flight += 1
+        self.admitted += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+    def acquire(self, tokens=0):
+        with self._condition:
+            self._take_rate(tokens)
+            if self._has_slot():
+                self._admitted(0.0)
+                return
+            if self.queued >= self.max_queue:
+                self._refund_rate(tokens)
+                self._reject("queue full", self.queue_timeout)
+            started = time.monotonic()
+            self.queued += 1
+            try:
+                if not self._condition.wait_for(self._has_slot, timeout=self.queue_timeout):
+                    self._refund_rate(tokens)
+                    self._reject("timed out waiting for a slot", self.queue_timeout)
+            finally:
+                self.queued -= 1
+            self._admitted(time.monotonic() - started)
+
+    async def acquire_async(self, tokens=0):
+        # Poll instead of blocking a thread, so a cancelled waiter never takes a slot afterwards
+        with self._condition:
+            self._take_rate(tokens)
+            if self._has_slot():
+                self._admitted(0.0)
+                return
+            if self.queued >= self.max_queue:
+                self._refund_rate(tokens)
+                self._reject("queue full", self.queue_timeout)
+            self.queued += 1
+        started = time.monotonic()
+        try:
+            while True:
+                await asyncio.sleep(0.01)
+                with self._condition:
+                    if self._has_slot():
+                        self._admitted(time.monotonic() - started)
+                        return
+                    if time.monotonic() - started >= self.queue_timeout:
+                        self._refund_rate(tokens)
+                        self._reject("timed out waiting for a slot", self.queue_timeout)
+        except asyncio.CancelledError:
+            with self._condition:
+                self._refund_rate(tokens)
+            raise
+        finally:
+            with self._condition:
+                self.queued -= 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def refund(self, tokens=0):
+        """Undo acquire(tokens) for a request that never ran: free its slot and give back its rate."""
+        with self._condition:
+            self._refund_rate(tokens)
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def settle(self, estimated, actual):
+        """Charge the tokens/min bucket for the tokens a request really used instead of its estimate."""
+        if self.tokens and actual is not None:
+            with self._condition:
+                self.tokens.take(actual - estimated)
+
+    def back_off(self, seconds):
+        """Reject everything for `seconds`, e.g. after the upstream answered 429."""
+        with self._condition:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def stats(self):
+        with self._condition:
+            now = time.monotonic()
+            for bucket in (self.requests, self.tokens):
+                if bucket:
+                    bucket.shortfall(0, now)
+            return {
+                'in_flight': self.in_flight,
+                'max_concurrency': self.max_concurrency,
+                'queued': self.queued,
+                'max_queue': self.max_queue,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'avg_wait': self.wait_total / self.admitted if self.admitted else 0.0,
+                'max_wait': self.wait_max,
+                'requests_available': self.requests.level if self.requests else None,
+                'tokens_available': self.tokens.level if self.tokens else None,
+                'blocked_for': max(0.0, self.blocked_until - now),
+            }
+
+
+class KeyedRateLimit:
+    """`per_minute` requests per key, e.g. votes per verified user, each key with its own TokenBucket.
+
+    Buckets that have refilled completely are forgotten, since a new one is
+    the same.
+    """
+
+    def __init__(self, name, per_minute, prune_interval=60.0):
+        self.name = name
+        self.per_minute = per_minute
+        self.prune_interval = prune_interval
+        self.rejected = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._pruned_at = time.monotonic()
+
+    def acquire(self, key):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._pruned_at >= self.prune_interval:
+                self._buckets = {key: bucket for key, bucket in self._buckets.items()
+                                 if bucket.shortfall(bucket.capacity, now) > 0}
+                self._pruned_at = now
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.per_minute)
+            wait = bucket.shortfall(1, now)
+            if wait > 0:
+                self.rejected += 1
+                raise AdmissionRejected(f"{self.name}: rate limit exceeded", wait)
+            bucket.take(1)
+
+    def stats(self):
+        with self._lock:
+            return {'keys': len(self._buckets), 'rejected': self.rejected}
+
+
+class Ticket:
+    """Admission to a chain of limits (e.g. model, then provider), taken in order and released together."""
+
+    def __init__(self, limits, tokens):
+        self.limits = limits
+        self.tokens = tokens
+
+    @classmethod
+    def acquire(cls, limits, tokens=0):
+        acquired = []
+        try:
+            for limit in limits:
+                limit.acquire(tokens)
+                acquired.append(limit)
+        except AdmissionRejected:
+            for limit in acquired:
+                limit.refund(tokens)
+            raise
+        return cls(limits, tokens)
+
+    @classmethod
+    async def acquire_async(cls, limits, tokens=0):
+        acquired = []
+        try:
+            for limit in limits:
+                await limit.acquire_async(tokens)
+                acquired.append(limit)
+        except BaseException:
+            for limit in acquired:
+                limit.refund(tokens)
+            raise
+        return cls(limits, tokens)
+
+    def settle(self, actual_tokens):
+        for limit in self.limits:
+            limit.settle(self.tokens, actual_tokens)
+
+    def release(self):
+        limits, self.limits = self.limits, []
+        for limit in limits:
+            limit.release()
+
+    def refund(self):
+        """Release a ticket whose call never happened, giving back the rate it took."""
+        limits, self.limits = self.limits, []
+        for limit in limits:
+            limit.refund(self.tokens)
@@ -1,27 +1,45 @@
 import json
-import time
 import logging
-import random
+import atexit
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
-from web3 import Web3
-from web3.middleware import geth_poa_middleware
 from dotenv import load_dotenv
 import os
-import openai
-import anthropic
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, g
 from flask_cors import CORS
-from flask_sqlalchemy import SQLAlchemy
-import httpx
-
-from circle import create_transfer
+from sqlalchemy import func
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db, ModelScore, AgentScore, configure_database
+from migrations import migrate, pending_migrations
+from payouts import PayoutWorker, enqueue_payout, payout_backlog
+from circle import CIRCLE_API_BASE_URL
+from votes import VoteApplier
+from rating_store import RatingStore
+from leaderboard import LeaderboardCache
+from matchmaking import Matchmaker
+from verification import VerificationStore, proof_digest
+from http_client import get_session, CircuitOpenError
+from chain import Chain
+from response_watcher import ContractResponseTimeout, ContractTransactionFailed
+from critic import CriticBatcher, CriticResponseError
+from llm_cache import ResponseCache
+from providers import ModelRegistry
+from admission import AdmissionLimit, AdmissionRejected, KeyedRateLimit
+from streaming import StreamSource, replay_deltas, sse_event, stream_sse
+from readiness import Check, run_checks, configured, circuit_closed, READY_TIMEOUT
+import metrics
+from metrics import observe
 
 load_dotenv()
 
-# Clients for different LLM services
-clientAnthropic = anthropic.Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
-clientOpenai = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+# Models of the arena and the clients of their providers, configured in models_data.json
+model_registry = ModelRegistry.from_file('models_data.json')
+
+with open('agents_data.json', 'r') as file:
+    agents_data = json.load(file)
 
 # Web3 setup
 RPC_URL = os.getenv('RPC_URL')
@@ -32,214 +50,250 @@ CONTRACT_CRITIC_WALLET = os.getenv('CONTRACT_CRITIC_WALLET')
 if not RPC_URL or not PRIVATE_KEY or not CONTRACT_CRITIC_ADDRESS:
     raise ValueError("Missing required environment variables")
 
-web3 = Web3(Web3.HTTPProvider(RPC_URL))
-web3.middleware_onion.inject(geth_poa_middleware, layer=0)
-if not web3.is_connected():
-    raise ConnectionError("Unable to connect to Ethereum node")
-
-with open('abis/OpenAiSimpleLLM.json', 'r') as file:
-    contract_abi = json.load(file)
-account = web3.eth.account.from_key(PRIVATE_KEY)
-
-# Flask app setup
-app = Flask(__name__)
-CORS(app, resources={r"/*": {"origins": "*"}})
-
-# Database setup
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///models.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
-
-class ModelScore(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(50), unique=True, nullable=False)
-    score = db.Column(db.Float, default=1200)
-    price = db.Column(db.Float, nullable=False)
-
-class AgentScore(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(50), unique=True, nullable=False)
-    score = db.Column(db.Float, default=1200)
-    price = db.Column(db.Float, nullable=False)
-    address = db.Column(db.String(50), nullable=False)
-    wallet = db.Column(db.String(50), nullable=False)
+# Seconds between response polls and how long to wait for a contract response
+CONTRACT_POLL_INTERVAL = float(os.getenv('CONTRACT_POLL_INTERVAL', '1'))
+CONTRACT_RESPONSE_TIMEOUT = float(os.getenv('CONTRACT_RESPONSE_TIMEOUT', '120'))
+# Web3 client, transaction pipeline, agent and critic contracts; built by the first request that needs the chain
+chain = Chain(RPC_URL, PRIVATE_KEY, 'abis/OpenAiSimpleLLM.json', chain_id=696969, gas=2000000,
+              gas_price_gwei=os.getenv('TX_GAS_PRICE_GWEI', '5'),
+              replace_after=float(os.getenv('TX_REPLACE_AFTER', '60')),
+              poll_interval=CONTRACT_POLL_INTERVAL, response_timeout=CONTRACT_RESPONSE_TIMEOUT)
+# Admission for agent requests, each of which costs a transaction; set CONTRACT_RPM, CONTRACT_MAX_CONCURRENCY, ...
+contract_limit = AdmissionLimit.from_env('contracts', 'CONTRACT')
 
 
 # Initialize models and agents from JSON if not already initialized
 def initialize_models():
-    if not ModelScore.query.first():
-        with open('models_data.json', 'r') as file:
-            models_data = json.load(file)
-            for model in models_data:
-                new_model = ModelScore(name=model['name'], price=model['price'])
-                db.session.add(new_model)
-            db.session.commit()
+    # Models added to models_data.json (or whose endpoint got configured) join the leaderboard on the next init-db
+    existing = {name for name, in db.session.query(ModelScore.name)}
+    for name in model_registry.names():
+        if name not in existing:
+            db.session.add(ModelScore(name=name, price=model_registry.specs[name].price))
+    db.session.commit()
 
 def initialize_agents():
     if not AgentScore.query.first():
-        with open('agents_data.json', 'r') as file:
-            agents_data = json.load(file)
-            for agent in agents_data:
-                new_agent = AgentScore(name=agent['name'], price=agent['price'],
-                                       address=agent['address'], wallet=agent['wallet'])
-                db.session.add(new_agent)
-            db.session.commit()
-
-with app.app_context():
+        for agent in agents_data:
+            new_agent = AgentScore(name=agent['name'], price=agent['price'],
+                                   address=agent['address'], wallet=agent['wallet'])
+            db.session.add(new_agent)
+        db.session.commit()
+
+def init_db():
     db.create_all()
+    migrate()
     initialize_models()
     initialize_agents()
+    recovered = vote_applier.recover()
+    if recovered:
+        logger.info(f"Applied {recovered} logged votes no worker had applied")
+
+def init_db_command():
+    """Create or migrate the tables and add new models and agents to the leaderboards."""
+    init_db()
+    logger.info("Database initialized")
+
+def create_app():
+    """Build and configure the Flask app.
+
+    Nothing here touches the network or the database: web3, the LLM clients
+    and the payout worker start on first use, and the schema is created by
+    `flask --app app init-db` (or `python app.py`), not by every worker.
+    """
+    app = Flask(__name__)
+    CORS(app, resources={r"/*": {"origins": "*"}})
+    configure_database(app)
+    app.cli.command('init-db')(init_db_command)
+    return app
+
+app = create_app()
+
+# Payouts are queued in the database and sent to Circle in the background, aggregated per wallet
+payout_worker = PayoutWorker(app, window=float(os.getenv('PAYOUT_WINDOW', '30')),
+                             interval=float(os.getenv('PAYOUT_INTERVAL', '5')))
+
+# Cache of LLM answers; set LLM_CACHE_SQLITE=1 to also keep them in a SQLite file next to models.db
+llm_cache = ResponseCache(
+    max_entries=int(os.getenv('LLM_CACHE_SIZE', '1024')),
+    ttl=float(os.getenv('LLM_CACHE_TTL', '3600')),
+    sqlite_path=os.path.join(app.instance_path, 'llm_cache.db') if os.getenv('LLM_CACHE_SQLITE') == '1' else None,
+    sqlite_max_entries=int(os.getenv('LLM_CACHE_SQLITE_MAX_ENTRIES', '100000')),
+    wait_timeout=float(os.getenv('LLM_CACHE_WAIT_TIMEOUT', '120'))
+)
+
+# World ID verifications, checked locally before asking World ID and to gate votes and prompt bounties
+verifications = VerificationStore(app, ttl=float(os.getenv('WORLD_ID_VERIFICATION_TTL', str(7 * 86400))))
+# Set WORLD_ID_REQUIRED=1 to accept votes and pay prompt bounties only for requests carrying a verification_token
+# handed out by /verify, for WORLD_ID_ACTION if set
+WORLD_ID_REQUIRED = os.getenv('WORLD_ID_REQUIRED') == '1'
+WORLD_ID_ACTION = os.getenv('WORLD_ID_ACTION') or None
+# Votes per verified user and minute, counted per worker
+vote_limit = KeyedRateLimit('votes', float(os.getenv('WORLD_ID_VOTES_PER_MINUTE', '30')))
 
 # Logging setup
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Helper function to get all model names from JSON
-def get_all_models():
-    with open('models_data.json', 'r') as file:
-        models_data = json.load(file)
-    return [model['name'] for model in models_data]
+ALL_MODELS = model_registry.names()
+ALL_AGENTS = [agent['name'] for agent in agents_data]
+_agent_addresses = None
+_agent_wallets = None
+
+def load_agents(reload=False):
+    # Read on the first agent request or vote rather than at import
+    global _agent_addresses, _agent_wallets
+    if _agent_addresses is None or reload:
+        with app.app_context():
+            agents = AgentScore.query.all()
+        _agent_wallets = {agent.name: agent.wallet for agent in agents}
+        _agent_addresses = {agent.name: agent.address for agent in agents}
+
+def get_agent_addresses():
+    load_agents()
+    return _agent_addresses
 
-# Helper function to get all agent names from JSON
-def get_all_agents():
-    with open('agents_data.json', 'r') as file:
-        agents_data = json.load(file)
-    return [agent['name'] for agent in agents_data]
+def get_agent_wallets():
+    load_agents()
+    return _agent_wallets
 
-ALL_MODELS = get_all_models()
-ALL_AGENTS = get_all_agents()
+# Runs both contestants of a battle side by side
+battle_executor = ThreadPoolExecutor(max_workers=int(os.getenv('BATTLE_WORKERS', '32')))
 
 # Helper functions
 
 def send_message_to_contract(message, contract_address):
-    contract = web3.eth.contract(address=contract_address, abi=contract_abi)
-
-    nonce = web3.eth.get_transaction_count(account.address)
-    txn = contract.functions.sendMessage(message).build_transaction({
-        'chainId': 696969,
-        'gas': 2000000,
-        'gasPrice': web3.to_wei('5', 'gwei'),
-        'nonce': nonce
-    })
-    signed_txn = web3.eth.account.sign_transaction(txn, private_key=PRIVATE_KEY)
-    tx_hash = web3.eth.send_raw_transaction(signed_txn.rawTransaction)
-    return tx_hash
-
-
-def wait_for_transaction_receipt(tx_hash):
-    return web3.eth.wait_for_transaction_receipt(tx_hash)
-
-def get_contract_response(contract_address):
-    contract = web3.eth.contract(address=contract_address, abi=contract_abi)
-    while True:
-        response = contract.functions.response().call()
-        if response:
-            return response
-        time.sleep(2)
-
-def get_openai_completion(message, model='gpt-3.5-turbo'):
-    completion = clientOpenai.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": "You are a poetic assistant, skilled in explaining complex programming concepts with creative flair."},
-            {"role": "user", "content": message}
-        ]
-    )
-    return completion.choices[0].message.content
-
-def get_claude_completion(message, model='claude-3-5-sonnet-20240620'):
-    response = clientAnthropic.messages.create(
-        model=model,
-        max_tokens=1024,
-        messages=[{"role": "user", "content": message}]
-    )
-    return response.content[0].text if response.content and len(response.content) > 0 else ""
+    return chain.tx_pipeline.send(chain.contracts.get(contract_address).functions.sendMessage(message))
+
+def request_contract_response(message, contract_address, agent):
+    with observe('tx_submit', agent=agent):
+        tx_hash = send_message_to_contract(message, contract_address)
+    logger.info(f"Transaction sent, tx hash: {tx_hash.hex()}")
+    return chain.response_watcher.wait(contract_address, tx_hash, agent=agent)
+
+CRITIC_BATCH_WINDOW = float(os.getenv('CRITIC_BATCH_WINDOW', '0.5'))
+
+# CRITIC_MAX_BATCH > 1 lets critiques share one transaction per batch; only enable it for a critic contract known
+# to answer batches. CRITIC_MAX_IN_FLIGHT caps the critic transactions out at a time. A caller waits for a batch in
+# flight to free a slot and then its own before answering 504.
+critic_batcher = CriticBatcher(lambda message: request_contract_response(message, CONTRACT_CRITIC_ADDRESS, 'critic'),
+                               max_batch=int(os.getenv('CRITIC_MAX_BATCH', '1')), window=CRITIC_BATCH_WINDOW,
+                               timeout=2 * CONTRACT_RESPONSE_TIMEOUT + CRITIC_BATCH_WINDOW,
+                               max_in_flight=int(os.getenv('CRITIC_MAX_IN_FLIGHT', '16')))
+
+def is_verified_user(data):
+    return not WORLD_ID_REQUIRED or verifications.verified_nullifier(data.get('verification_token'),
+                                                                     WORLD_ID_ACTION) is not None
+
+def admit_voter(data):
+    # Raises AdmissionRejected when the verified user votes too often
+    if not WORLD_ID_REQUIRED:
+        return True
+    nullifier_hash = verifications.verified_nullifier(data.get('verification_token'), WORLD_ID_ACTION)
+    if nullifier_hash is None:
+        return False
+    vote_limit.acquire(nullifier_hash)
+    return True
 
 def select_random_models():
-    return random.sample(ALL_MODELS, 2)
+    return matchmaker.pick('model')
 
 def select_random_agents():
-    return random.sample(ALL_AGENTS, 2)
+    return matchmaker.pick('agent')
 
 def handle_llm_request(message, model):
-    if 'gpt' in model:
-        return get_openai_completion(message, model)
-    elif 'claude' in model:
-        return get_claude_completion(message, model)
-    else:
+    if model_registry.get(model) is None:
         return None
+    return llm_cache.get_or_compute(model_registry.cache_key(model, message),
+                                    lambda: model_registry.complete(model, message))
 
 def handle_agent_request(message, agent_name):
-    agent = AgentScore.query.filter_by(name=agent_name).first()
-    if not agent:
+    contract_address = get_agent_addresses().get(agent_name)
+    if not contract_address:
         logger.error(f"Agent {agent_name} not found")
         return None
 
-    contract_address = agent.address
-    tx_hash = send_message_to_contract(message, contract_address)
-    logger.info(f"Transaction sent, tx hash: {tx_hash.hex()}")
-    receipt = wait_for_transaction_receipt(tx_hash)
-    logger.info(f"Transaction receipt: {receipt}")
-    time.sleep(10)
-
-    response = get_contract_response(contract_address)
-    logger.info(f"Contract response: {response}")
+    contract_limit.acquire()
+    try:
+        response = request_contract_response(message, contract_address, agent_name)
+    except (ContractResponseTimeout, ContractTransactionFailed) as e:
+        logger.error(f"Agent {agent_name} did not respond: {e}")
+        return None
+    finally:
+        contract_limit.release()
+    logger.debug(f"Contract response: {response}")
 
     return response
 
 
+def run_with_app_context(func, *args):
+    with app.app_context():
+        return func(*args)
+
+def handle_battle(message, arena):
+    if arena == 'agents':
+        contestant_a, contestant_b = select_random_agents()
+        handler = handle_agent_request
+    else:
+        contestant_a, contestant_b = select_random_models()
+        handler = handle_llm_request
+
+    # Copy the request's context so the contestants' timings join its trace
+    future_a = battle_executor.submit(contextvars.copy_context().run, run_with_app_context, handler, message,
+                                      contestant_a)
+    future_b = battle_executor.submit(contextvars.copy_context().run, run_with_app_context, handler, message,
+                                      contestant_b)
+    return contestant_a, contestant_b, future_a.result(), future_b.result()
+
+
+def llm_stream_source(message, model, contestant=None, ticket=None):
+    cache_key = model_registry.cache_key(model, message)
+    cached = llm_cache.get(cache_key)
+    if cached is not None:
+        if ticket:
+            ticket.refund()
+        return StreamSource(model, lambda cancellation: replay_deltas(cached), contestant)
+
+    # Admit before the response starts, so a request over the limits still gets a 429
+    ticket = ticket or model_registry.admit(model, message)
+    # Only complete, error-free streams are cached
+    return StreamSource(model, lambda cancellation: model_registry.stream(model, message, cancellation, ticket),
+                        contestant, on_complete=lambda text: llm_cache.set(cache_key, text), ticket=ticket)
+
+def agent_stream_source(message, agent_name, contestant=None):
+    # Contracts answer in one piece, so an agent contributes a single delta
+    def deltas(cancellation):
+        response = run_with_app_context(handle_agent_request, message, agent_name)
+        if response is None:
+            raise RuntimeError('Failed to get a response from the agent')
+        yield 'delta', response
+        yield 'done', 'end_turn'
+    return StreamSource(agent_name, deltas, contestant)
+
 def handle_llm_stream_request(message, model):
-    logger.info(f"Streaming request received for model: {model}")
-    try:
-        if 'gpt' in model:
-            logger.info(f"Using OpenAI model: {model}")
-            stream = clientOpenai.chat.completions.create(
-                model=model,
-                messages=[{"role": "user", "content": message}],
-                stream=True,
-            )
-            logger.info("Started streaming from OpenAI")
-            try:
-                for chunk in stream:
-                    if chunk.choices[0].delta.content is not None:
-                        logger.info(f"Streaming chunk: {chunk.choices[0].delta.content}")
-                        yield f"{chunk.choices[0].delta.content}\n\n"
-            except Exception as e:
-                logger.error(f"Error while streaming from OpenAI: {str(e)}")
-            logger.info("Finished streaming from OpenAI")
-        elif 'claude' in model:
-            logger.info(f"Using Claude model: {model}")
-            logger.info("Entered stream_claude_response")
-            response = clientAnthropic.messages.create(
-                model=model,
-                max_tokens=1024,
-                messages=[{"role": "user", "content": message}],
-                stream=True,
-            )
-            logger.info("Started streaming from Claude")
-            try:
-                for line in response.iter_lines():
-                    if line:
-                        decoded_line = line.decode('utf-8')
-                        event_data = json.loads(decoded_line)
-                        if event_data.get('type') == 'completion':
-                            completion_data = {
-                                "type": "completion",
-                                "completion": event_data.get('completion', ''),
-                                "stop_reason": event_data.get('stop_reason'),
-                                "model": model
-                            }
-                            logger.info(f"Streaming chunk: {completion_data}")
-                            yield f"event: completion\ndata: {json.dumps(completion_data)}\n\n"
-            except Exception as e:
-                logger.error(f"Error while streaming from Claude: {str(e)}")
-            logger.info("Finished streaming from Claude")
-        else:
-            logger.error(f"Invalid model: {model}")
-            yield f"data: {{\"error\": \"Invalid model: {model}. Available models are: {ALL_MODELS}\"}}\n\n"
-    except Exception as e:
-        logger.error(f"Error in handle_llm_stream_request: {str(e)}")
-        yield f"data: {{\"error\": \"{str(e)}\"}}\n\n"
+    return stream_sse([llm_stream_source(message, model)])
+
+def handle_battle_stream(message, arena):
+    if arena == 'agents':
+        contestant_a, contestant_b = select_random_agents()
+        sources, key = [agent_stream_source(message, contestant_a, 'A'),
+                        agent_stream_source(message, contestant_b, 'B')], 'agent'
+    else:
+        contestant_a, contestant_b = select_random_models()
+        ticket_a, ticket_b = model_registry.admit_all([contestant_a, contestant_b], message)
+        sources, key = [llm_stream_source(message, contestant_a, 'A', ticket_a),
+                        llm_stream_source(message, contestant_b, 'B', ticket_b)], 'model'
+
+    start = sse_event('start', {f'{key}A': contestant_a, f'{key}B': contestant_b, 'message': message})
+    return stream_sse(sources, first=[start])
+
+def sse_response(frames):
+    # Tell proxies not to buffer the stream, or the coalesced frames arrive all at once
+    return Response(frames, content_type='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.errorhandler(AdmissionRejected)
+def admission_rejected(e):
+    return jsonify({'error': str(e)}), 429, {'Retry-After': str(e.retry_after)}
 
 @app.route('/random_models', methods=['GET'])
 def random_models():
@@ -261,12 +315,11 @@ def llm_request():
     if model not in ALL_MODELS:
         return jsonify({'error': f'Invalid model: {model}. Available models are: {ALL_MODELS}'}), 400
 
-    logger.info(f"Received message for LLM completion: {message}, model: {model}")
+    logger.info(f"Received message for LLM completion ({len(message)} chars), model: {model}")
     response = handle_llm_request(message, model)
     if response is None:
         return jsonify({'error': 'Failed to get a response from the model'}), 500
 
-    logger.info(f"LLM response: {response}")
     return jsonify({'message': message, 'response': response})
 
 @app.route('/agent_request', methods=['POST'])
@@ -279,12 +332,11 @@ def agent_request():
     if agent not in ALL_AGENTS:
         return jsonify({'error': f'Invalid agent: {agent}. Available agents are: {ALL_AGENTS}'}), 400
 
-    logger.info(f"Received message for agent completion: {message}, agent: {agent}")
+    logger.info(f"Received message for agent completion ({len(message)} chars), agent: {agent}")
     response = handle_agent_request(message, agent)
     if response is None:
         return jsonify({'error': 'Failed to get a response from the agent'}), 500
 
-    logger.info(f"Agent response: {response}")
     return jsonify({'message': message, 'response': response})
 
 @app.route('/llm_request_streaming', methods=['POST'])
@@ -297,23 +349,176 @@ def llm_request_streaming():
     if model not in ALL_MODELS:
         return jsonify({'error': f'Invalid model: {model}. Available models are: {ALL_MODELS}'}), 400
 
-    logger.info(f"Received message for LLM streaming: {message}, model: {model}")
-    return Response(handle_llm_stream_request(message, model), content_type='text/event-stream')
+    logger.info(f"Received message for LLM streaming ({len(message)} chars), model: {model}")
+    return sse_response(handle_llm_stream_request(message, model))
+
+@app.route('/battle', methods=['POST'])
+def battle():
+    data = request.json
+    message = data.get('message')
+    arena = data.get('arena', 'models')  # 'models' or 'agents'
+    if not message:
+        return jsonify({'error': 'Message is required'}), 400
+    if arena not in ['models', 'agents']:
+        return jsonify({'error': f'Invalid arena: {arena}. Available arenas are: models, agents'}), 400
+
+    logger.info(f"Received message for {arena} battle ({len(message)} chars)")
+    if data.get('stream'):
+        return sse_response(handle_battle_stream(message, arena))
+    contestant_a, contestant_b, response_a, response_b = handle_battle(message, arena)
+    if response_a is None or response_b is None:
+        failed = [name for name, response in [(contestant_a, response_a), (contestant_b, response_b)]
+                  if response is None]
+        return jsonify({'error': f'Failed to get a response from: {", ".join(failed)}'}), 500
+
+    key = 'agent' if arena == 'agents' else 'model'
+    return jsonify({
+        f'{key}A': contestant_a,
+        f'{key}B': contestant_b,
+        'message': message,
+        'responseA': response_a,
+        'responseB': response_b
+    })
+
+@app.before_request
+def start_background_workers():
+    # Started by requests rather than at import, so every preforked worker runs its own (start() is idempotent)
+    payout_worker.start()
+
+@app.before_request
+def start_request_timing():
+    g.request_started = time.perf_counter()
+    g.trace_token = metrics.start_trace(request.path)
+
+@app.after_request
+def remember_status(response):
+    g.status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_timing(error=None):
+    # Streamed responses are timed until they start; their stages show up in the stage histograms
+    if 'request_started' in g:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        status = g.get('status', 500)
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, endpoint=endpoint,
+                                        method=request.method, status=status)
+        metrics.finish_trace(g.trace_token, status)
+
+def collect_metrics():
+    families = []
+    registry_stats = model_registry.stats()
+    limits = [('provider', name, limit_stats) for name, limit_stats in registry_stats['providers'].items()]
+    limits += [('model', name, limit_stats) for name, limit_stats in registry_stats['models'].items()]
+    limits.append(('contracts', 'contracts', contract_limit.stats()))
+    for field, metric_type, help in [('in_flight', 'gauge', 'Upstream calls in flight'),
+                                     ('queued', 'gauge', 'Requests waiting for a concurrency slot'),
+                                     ('admitted', 'counter', 'Requests admitted'),
+                                     ('rejected', 'counter', 'Requests rejected with 429'),
+                                     ('max_wait', 'gauge', 'Longest wait for a concurrency slot in seconds')]:
+        families.append((f'llamarally_admission_{field}', metric_type, help,
+                         [({'scope': scope, 'name': name}, limit_stats[field]) for scope, name, limit_stats in limits]))
+    cache = llm_cache.stats()
+    families.append(('llamarally_llm_cache_lookups', 'counter', 'LLM cache lookups by result',
+                     [({'result': result}, cache[result])
+                      for result in ('hits', 'sqlite_hits', 'misses', 'coalesced')]))
+    verification_stats = verifications.stats()
+    families.append(('llamarally_world_id_lookups', 'counter', 'Verification lookups by where they were answered',
+                     [({'result': result}, verification_stats[result])
+                      for result in ('local_hits', 'database_hits', 'misses')]))
+    critic_stats = critic_batcher.stats()
+    families.append(('llamarally_critic_prompts', 'counter', 'Prompts sent to the critic',
+                     [({}, critic_stats['prompts'])]))
+    families.append(('llamarally_critic_batches', 'counter', 'Critic transactions', [({}, critic_stats['batches'])]))
+    families.append(('llamarally_critic_queued', 'gauge', 'Prompts waiting for the next critic batch',
+                     [({}, critic_stats['queued'])]))
+    families.append(('llamarally_critic_in_flight', 'gauge', 'Critic transactions awaiting their answer',
+                     [({}, critic_stats['in_flight'])]))
+    families.append(('llamarally_votes_rate_limited', 'counter', 'Votes refused for a user voting too often',
+                     [({}, vote_limit.stats()['rejected'])]))
+    families.append(('llamarally_votes_parked', 'counter', 'Votes left unapplied after failing to be written alone',
+                     [({}, vote_applier.parked)]))
+    families.append(('llamarally_votes_pending', 'gauge', 'Votes waiting to be applied',
+                     [({}, vote_applier.pending())]))
+    return families
+
+metrics.register_collector(collect_metrics)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4')
+
+def check_database():
+    try:
+        models = db.session.query(func.count(ModelScore.id)).scalar()
+    except SQLAlchemyError as e:
+        raise RuntimeError(f"{getattr(e, 'orig', None) or e}; run `flask --app app init-db`")
+    if not models:
+        raise RuntimeError("no models on the leaderboard; run `flask --app app init-db`")
+    required = pending_migrations(required=True)
+    if required:
+        raise RuntimeError(f"migrations {', '.join(required)} pending; run `flask --app app init-db`")
+    # Optional ones are reported only: the app works without the newer indexes, just slower
+    return {'models': models, 'pending_migrations': pending_migrations()}
+
+def check_provider(provider):
+    def probe():
+        specs = [spec for spec in model_registry.specs.values() if spec.provider == provider and spec.enabled]
+        # Self-hosted servers get by without a key
+        configured(*sorted({spec.api_key_env for spec in specs if spec.provider != 'openai-compatible'}))
+        blocked_for = model_registry.provider_limits[provider].stats()['blocked_for']
+        if blocked_for:
+            raise RuntimeError(f"rate limited by the provider for another {blocked_for:.0f}s")
+        return {'models': len(specs)}
+    return probe
+
+def check_circle():
+    configured('CIRCLE_API_KEY')
+    return circuit_closed(CIRCLE_API_BASE_URL)
+
+def check_world_id():
+    configured('NEXT_PUBLIC_WLD_API_BASE_URL', 'NEXT_PUBLIC_WLD_APP_ID')
+    return circuit_closed(os.getenv('NEXT_PUBLIC_WLD_API_BASE_URL'))
+
+# Without the database a replica can serve neither votes nor leaderboards; the upstreams are only reported
+readiness_checks = [
+    Check('database', check_database, required=True),
+    Check('chain', lambda: chain.check(READY_TIMEOUT)),
+    *[Check(f'llm_{provider}', check_provider(provider)) for provider in model_registry.provider_limits],
+    Check('circle', check_circle),
+    Check('world_id', check_world_id),
+]
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    is_ready, checks = run_checks(readiness_checks)
+    return jsonify({'status': 'ready' if is_ready else 'not_ready', 'checks': checks}), 200 if is_ready else 503
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify(llm_cache.stats())
+
+@app.route('/admission_stats', methods=['GET'])
+def admission_stats():
+    return jsonify({**model_registry.stats(), 'contracts': contract_limit.stats()})
+
+@app.route('/payouts', methods=['GET'])
+def payouts():
+    status = request.args.get('status')
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify(payout_backlog(status, limit))
 
 def payUser(wallet_address):
-    # Placeholder function to pay the user
-    logger.info(f"Paying user with wallet address: {wallet_address}")
-    create_transfer("1", wallet_address)
+    logger.info(f"Queueing payout to user with wallet address: {wallet_address}")
+    enqueue_payout(wallet_address, "1", 'user')
 
-def payAgent(wallet_address):
-    # Placeholder function to pay the user
-    logger.info(f"Paying agent with wallet address: {wallet_address}")
-    create_transfer("1", wallet_address)
+def payAgent(wallet_address, commit=True):
+    logger.info(f"Queueing payout to agent with wallet address: {wallet_address}")
+    enqueue_payout(wallet_address, "1", 'agent', commit=commit)
 
 def payCritic(wallet_address):
-    # Placeholder function to pay the user
-    logger.info(f"Paying critic agent with wallet address: {wallet_address}")
-    create_transfer("0.1", wallet_address)
+    logger.info(f"Queueing payout to critic agent with wallet address: {wallet_address}")
+    enqueue_payout(wallet_address, "0.1", 'critic')
 
 @app.route('/criticize_user_request', methods=['POST'])
 def criticize_user_request():
@@ -324,7 +529,7 @@ def criticize_user_request():
     if not prompt:
         return jsonify({'error': 'Prompt is required'}), 400
 
-    logger.info(f"Received message: {prompt}")
+    logger.info(f"Received prompt for the critic ({len(prompt)} chars)")
 
     # message = ("You are to receive a user message that is a prompt."
     #            "Your task is to evaluate this prompt,"
@@ -336,24 +541,19 @@ def criticize_user_request():
     #            "\"description\": \"<explanation of the score>\"}"
     #            f"\n\nHere is the user's prompt for you to evaluate:\n\n{prompt}")
 
-    tx_hash = send_message_to_contract(prompt, CONTRACT_CRITIC_ADDRESS)
-    logger.info(f"Transaction sent, tx hash: {tx_hash.hex()}")
-    receipt = wait_for_transaction_receipt(tx_hash)
-    logger.info(f"Transaction receipt: {receipt}")
-    time.sleep(5)
-
-    response = get_contract_response(CONTRACT_CRITIC_ADDRESS)
-    logger.info(f"Contract response: {response}")
-
     try:
-        response_data = json.loads(response)
-        score = response_data.get('score')
-        description = response_data.get('description')
-    except (ValueError, KeyError) as e:
+        verdict = critic_batcher.evaluate(prompt)
+    except ContractResponseTimeout:
+        return jsonify({'error': 'Timed out waiting for the critic response'}), 504
+    except ContractTransactionFailed:
+        return jsonify({'error': 'Critic transaction failed'}), 502
+    except CriticResponseError as e:
         logger.error(f"Error parsing response: {e}")
         return jsonify({'error': 'Failed to parse contract response'}), 500
+    score = verdict['score']
+    description = verdict['description']
 
-    if wallet_address and score >= 7:
+    if wallet_address and score >= 7 and is_verified_user(data):
         payUser(wallet_address)
 
     payCritic(CONTRACT_CRITIC_WALLET)
@@ -370,18 +570,20 @@ def vote():
     model_b = data.get('modelB')
     result = data.get('result')  # '<model_name>' or 'draw'
 
+    if not admit_voter(data):
+        return jsonify({'error': 'World ID verification required'}), 403
+
     if not model_a or not model_b or (result not in [model_a, model_b, 'draw']):
         return jsonify({'error': 'Invalid input'}), 400
 
-    model_a_record = ModelScore.query.filter_by(name=model_a).first()
-    model_b_record = ModelScore.query.filter_by(name=model_b).first()
+    if model_a == model_b:
+        return jsonify({'error': 'A model cannot be voted against itself'}), 400
 
-    if not model_a_record or not model_b_record:
+    if model_a not in ALL_MODELS or model_b not in ALL_MODELS:
         return jsonify({'error': 'Model not found'}), 404
 
-    update_elo_ratings(model_a_record, model_b_record, result)
-
-    db.session.commit()
+    if not vote_applier.submit('model', model_a, model_b, result):
+        return jsonify({'error': 'Model not found'}), 404
 
     return jsonify({'message': 'Vote recorded and ratings updated'})
 
@@ -392,91 +594,81 @@ def vote_agents():
     agent_b = data.get('agentB')
     result = data.get('result')  # '<agent_name>' or 'draw'
 
+    if not admit_voter(data):
+        return jsonify({'error': 'World ID verification required'}), 403
+
     if not agent_a or not agent_b or (result not in [agent_a, agent_b, 'draw']):
         return jsonify({'error': 'Invalid input'}), 400
 
-    agent_a_record = AgentScore.query.filter_by(name=agent_a).first()
-    agent_b_record = AgentScore.query.filter_by(name=agent_b).first()
+    if agent_a == agent_b:
+        return jsonify({'error': 'A agent cannot be voted against itself'}), 400
 
-    if not agent_a_record or not agent_b_record:
+    if agent_a not in ALL_AGENTS or agent_b not in ALL_AGENTS:
         return jsonify({'error': 'Agent not found'}), 404
 
-    update_elo_ratings_agents(agent_a_record, agent_b_record, result)
-
-    # Pay the winning agent
-    if result == agent_a_record.name:
-        payAgent(agent_a_record.wallet)
-    elif result == agent_b_record.name:
-        payAgent(agent_b_record.wallet)
-
-    db.session.commit()
+    if not vote_applier.submit('agent', agent_a, agent_b, result):
+        return jsonify({'error': 'Agent not found'}), 404
 
     return jsonify({'message': 'Vote recorded and ratings updated'})
 
-
-def update_elo_ratings(model_a, model_b, result):
-    K = 32  # ELO constant
-
-    def calculate_new_rating(rating, opponent_rating, actual_score):
-        expected_score = 1 / (1 + 10 ** ((opponent_rating - rating) / 400))
-        return rating + K * (actual_score - expected_score)
-
-    if result == model_a.name:
-        score_a, score_b = 1, 0
-    elif result == model_b.name:
-        score_a, score_b = 0, 1
-    elif result == 'draw':
-        score_a, score_b = 0.5, 0.5
-
-    model_a.score = calculate_new_rating(model_a.score, model_b.score, score_a)
-    model_b.score = calculate_new_rating(model_b.score, model_a.score, score_b)
-
-def update_elo_ratings_agents(agent_a, agent_b, result):
-    K = 32  # ELO constant
-
-    def calculate_new_rating(rating, opponent_rating, actual_score):
-        expected_score = 1 / (1 + 10 ** ((opponent_rating - rating) / 400))
-        return rating + K * (actual_score - expected_score)
-
-    if result == agent_a.name:
-        score_a, score_b = 1, 0
-    elif result == agent_b.name:
-        score_a, score_b = 0, 1
-    elif result == 'draw':
-        score_a, score_b = 0.5, 0.5
-
-    agent_a.score = calculate_new_rating(agent_a.score, agent_b.score, score_a)
-    agent_b.score = calculate_new_rating(agent_b.score, agent_a.score, score_b)
+def vote_payouts(vote):
+    # Queue the winning agent's payout in the same transaction as the vote
+    if vote.kind == 'agent' and vote.result != 'draw':
+        if vote.result not in get_agent_wallets():
+            # An agent added since the wallets were read
+            load_agents(reload=True)
+        payAgent(get_agent_wallets()[vote.result], commit=False)
+
+LEADERBOARD_MAX_AGE = float(os.getenv('LEADERBOARD_MAX_AGE', '5'))
+
+# Ratings live in memory and are checkpointed to the score tables; other workers' votes show up within
+# LEADERBOARD_MAX_AGE seconds
+rating_store = RatingStore(app, max_age=LEADERBOARD_MAX_AGE)
+
+# Leaderboards are rebuilt when votes are checkpointed here, or after LEADERBOARD_MAX_AGE seconds
+leaderboard_cache = LeaderboardCache(app, rating_store, max_age=LEADERBOARD_MAX_AGE)
+
+# Battle pairs favour close ratings and contestants with few votes; MATCHMAKING_EXPLORE is the share of uniform pairs
+matchmaker = Matchmaker(rating_store, {'model': ALL_MODELS, 'agent': ALL_AGENTS},
+                        neighbours=int(os.getenv('MATCHMAKING_NEIGHBOURS', '4')),
+                        explore=float(os.getenv('MATCHMAKING_EXPLORE', '0.1')))
+
+def votes_applied(kind):
+    leaderboard_cache.invalidate(kind)
+    matchmaker.invalidate(kind)
+
+# Votes are logged before they are answered, those arriving within VOTE_LOG_WINDOW seconds in one commit, update the
+# ratings at once and are checkpointed to the score tables in batches, at most VOTE_MAX_DELAY seconds after they arrive
+vote_applier = VoteApplier(app, rating_store, on_vote=vote_payouts,
+                           max_delay=float(os.getenv('VOTE_MAX_DELAY', '0.5')),
+                           max_batch=int(os.getenv('VOTE_MAX_BATCH', '500')),
+                           on_applied=votes_applied,
+                           log_window=float(os.getenv('VOTE_LOG_WINDOW', '0.005')))
+atexit.register(vote_applier.flush)
+
+def leaderboard_response(kind):
+    page = request.args.get('page', type=int)
+    per_page = request.args.get('per_page', type=int)
+    if (page is None) != (per_page is None) or (page is not None and (page < 1 or per_page < 1)):
+        return jsonify({'error': 'page and per_page must be given together and be positive'}), 400
+
+    body, etag, total = leaderboard_cache.get(kind, page, per_page)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Total-Count'] = str(total)
+    return response
 
 @app.route('/leaderboard', methods=['GET'])
 def leaderboard():
-    models = ModelScore.query.order_by(ModelScore.score.desc()).all()
-    leaderboard = [
-        {
-            'rank': idx + 1,
-            'name': model.name,
-            'score': model.score,
-            'price': model.price,
-            'price_per_score':  model.score / model.price if model.price != 0 else 0
-        }
-        for idx, model in enumerate(models)
-    ]
-    return jsonify(leaderboard)
+    return leaderboard_response('model')
 
 @app.route('/leaderboard_agents', methods=['GET'])
 def leaderboard_agents():
-    agents = AgentScore.query.order_by(AgentScore.score.desc()).all()
-    leaderboard = [
-        {
-            'rank': idx + 1,
-            'name': agent.name,
-            'score': agent.score,
-            'price': agent.price,
-            'price_per_score': agent.score / agent.price if agent.price != 0 else 0
-        }
-        for idx, agent in enumerate(agents)
-    ]
-    return jsonify(leaderboard)
+    return leaderboard_response('agent')
 
 @app.route('/verify', methods=['POST'])
 def verify():
@@ -492,11 +684,22 @@ def verify():
         "signal": req_body["signal"],
     }
 
+    # The proof already accepted for this nullifier and action is answered locally; World ID would refuse it a second
+    # time. Any other proof goes to World ID.
+    proof_hash = proof_digest(payload)
+    token = verifications.reissue(payload["nullifier_hash"], payload["action"], proof_hash)
+    if token:
+        return jsonify({"code": "success", "detail": "This action verified correctly!", "token": token})
+
     print("Sending request to World ID /verify endpoint:\n", payload)
 
     verify_endpoint = f"{os.getenv('NEXT_PUBLIC_WLD_API_BASE_URL')}/api/v1/verify/{os.getenv('NEXT_PUBLIC_WLD_APP_ID')}"
 
-    verify_res = requests.post(verify_endpoint, json=payload)
+    try:
+        with observe('world_id'):
+            verify_res = get_session().post(verify_endpoint, json=payload)
+    except CircuitOpenError:
+        return jsonify({"code": "unavailable", "detail": "World ID is temporarily unavailable"}), 503
     wld_response = verify_res.json()
 
     print(f"Received {verify_res.status_code} response from World ID /verify endpoint:\n", wld_response)
@@ -505,11 +708,15 @@ def verify():
         # This is where you should perform backend actions based on the verified credential, such as setting a user as "verified" in a database
         # For this example, we'll just return a 200 response and console.log the verified credential
         print("Credential verified! This user's nullifier hash is: ", wld_response["nullifier_hash"])
-        return jsonify({"code": "success", "detail": "This action verified correctly!"})
+        token = verifications.record(payload["nullifier_hash"], payload["action"], payload["verification_level"],
+                                     proof_hash)
+        return jsonify({"code": "success", "detail": "This action verified correctly!", "token": token})
     else:
         # This is where you should handle errors from the World ID /verify endpoint. Usually these errors are due to an invalid credential or a credential that has already been used.
         # For this example, we'll just return the error code and detail from the World ID /verify endpoint.
         return jsonify({"code": wld_response["code"], "detail": wld_response["detail"]}), verify_res.status_code
 
 if __name__ == '__main__':
+    with app.app_context():
+        init_db()
     app.run(host='0.0.0.0', port=5001)
@@ -0,0 +1,307 @@
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+from app import (app as flask_app, ALL_MODELS, ALL_AGENTS, CONTRACT_CRITIC_WALLET, chain,
+                 get_agent_addresses, select_random_models, select_random_agents, llm_cache, model_registry,
+                 contract_limit, payout_worker, payUser, payCritic, verifications, is_verified_user, critic_batcher)
+from http_client import make_async_httpx_client, CircuitOpenError
+from admission import AdmissionRejected
+from metrics import observe, traced
+from response_watcher import ContractResponseTimeout, ContractTransactionFailed
+from critic import CriticResponseError
+from verification import proof_digest
+from streaming import StreamSource, replay_deltas_async, sse_event, stream_sse_async
+
+# Async serving mode: the same endpoints as app.py, but the slow LLM, chain and payment calls are awaited
+# instead of holding a worker thread. Everything else is served by the Flask app mounted below.
+# Run with: uvicorn asgi_app:app --host 0.0.0.0 --port 5001
+
+logger = logging.getLogger(__name__)
+
+http_client = make_async_httpx_client()
+
+
+async def run_in_app_context(func, *args):
+    def call():
+        with flask_app.app_context():
+            return func(*args)
+    return await asyncio.to_thread(call)
+
+
+async def handle_llm_request(message, model):
+    if model_registry.get(model) is None:
+        return None
+    return await llm_cache.get_or_compute_async(model_registry.cache_key(model, message),
+                                                lambda: model_registry.complete_async(model, message))
+
+async def llm_stream_source(message, model, contestant=None, ticket=None):
+    cache_key = model_registry.cache_key(model, message)
+    cached = llm_cache.get(cache_key)
+    if cached is not None:
+        if ticket:
+            ticket.refund()
+        return StreamSource(model, lambda: replay_deltas_async(cached), contestant)
+
+    ticket = ticket or await model_registry.admit_async(model, message)
+    return StreamSource(model, lambda: model_registry.stream_async(model, message, ticket), contestant,
+                        on_complete=lambda text: llm_cache.set(cache_key, text), ticket=ticket)
+
+def agent_stream_source(message, agent_name, contestant=None):
+    async def deltas():
+        response = await handle_agent_request(message, agent_name)
+        if response is None:
+            raise RuntimeError('Failed to get a response from the agent')
+        yield 'delta', response
+        yield 'done', 'end_turn'
+    return StreamSource(agent_name, deltas, contestant)
+
+async def handle_llm_stream_request(message, model):
+    return stream_sse_async([await llm_stream_source(message, model)])
+
+async def handle_battle_stream(message, arena):
+    if arena == 'agents':
+        contestant_a, contestant_b = await asyncio.to_thread(select_random_agents)
+        sources, key = [agent_stream_source(message, contestant_a, 'A'),
+                        agent_stream_source(message, contestant_b, 'B')], 'agent'
+    else:
+        contestant_a, contestant_b = await asyncio.to_thread(select_random_models)
+        ticket_a, ticket_b = await model_registry.admit_all_async([contestant_a, contestant_b], message)
+        sources, key = [await llm_stream_source(message, contestant_a, 'A', ticket_a),
+                        await llm_stream_source(message, contestant_b, 'B', ticket_b)], 'model'
+
+    start = sse_event('start', {f'{key}A': contestant_a, f'{key}B': contestant_b, 'message': message})
+    return stream_sse_async(sources, first=[start])
+
+class SSEResponse(StreamingResponse):
+    # Starlette doesn't close the body iterator, so a stream cancelled before its first frame would keep its tickets
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.body_iterator.aclose()
+
+def sse_response(frames):
+    return SSEResponse(frames, media_type='text/event-stream',
+                       headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+async def request_contract_response(message, contract_address, agent):
+    # The first call imports web3 and builds the chain clients, which would stall the event loop. Nonces and signing
+    # stay in the shared pipeline so both serving modes can use one account
+    sync_contract = await asyncio.to_thread(chain.contracts.get, contract_address)
+    with observe('tx_submit', agent=agent):
+        tx_hash = await asyncio.wrap_future(chain.tx_pipeline.submit(sync_contract.functions.sendMessage(message)))
+    logger.info(f"Transaction sent, tx hash: {tx_hash.hex()}")
+    return await asyncio.wrap_future(chain.response_watcher.watch(contract_address, tx_hash, agent=agent))
+
+async def handle_agent_request(message, agent_name):
+    contract_address = get_agent_addresses().get(agent_name)
+    if not contract_address:
+        logger.error(f"Agent {agent_name} not found")
+        return None
+
+    await contract_limit.acquire_async()
+    try:
+        response = await request_contract_response(message, contract_address, agent_name)
+    except (ContractResponseTimeout, ContractTransactionFailed) as e:
+        logger.error(f"Agent {agent_name} did not respond: {e}")
+        return None
+    finally:
+        contract_limit.release()
+    logger.debug(f"Contract response: {response}")
+
+    return response
+
+async def handle_battle(message, arena):
+    if arena == 'agents':
+        contestant_a, contestant_b = await asyncio.to_thread(select_random_agents)
+        handler = handle_agent_request
+    else:
+        contestant_a, contestant_b = await asyncio.to_thread(select_random_models)
+        handler = handle_llm_request
+
+    response_a, response_b = await asyncio.gather(handler(message, contestant_a), handler(message, contestant_b))
+    return contestant_a, contestant_b, response_a, response_b
+
+
+async def llm_request(request):
+    data = await request.json()
+    message = data.get('message')
+    model = data.get('model')
+    if not message:
+        return JSONResponse({'error': 'Message is required'}, status_code=400)
+    if model not in ALL_MODELS:
+        return JSONResponse({'error': f'Invalid model: {model}. Available models are: {ALL_MODELS}'}, status_code=400)
+
+    logger.info(f"Received message for LLM completion ({len(message)} chars), model: {model}")
+    response = await handle_llm_request(message, model)
+    if response is None:
+        return JSONResponse({'error': 'Failed to get a response from the model'}, status_code=500)
+
+    return JSONResponse({'message': message, 'response': response})
+
+async def agent_request(request):
+    data = await request.json()
+    message = data.get('message')
+    agent = data.get('agent')
+    if not message:
+        return JSONResponse({'error': 'Message is required'}, status_code=400)
+    if agent not in ALL_AGENTS:
+        return JSONResponse({'error': f'Invalid agent: {agent}. Available agents are: {ALL_AGENTS}'}, status_code=400)
+
+    logger.info(f"Received message for agent completion ({len(message)} chars), agent: {agent}")
+    response = await handle_agent_request(message, agent)
+    if response is None:
+        return JSONResponse({'error': 'Failed to get a response from the agent'}, status_code=500)
+
+    return JSONResponse({'message': message, 'response': response})
+
+async def llm_request_streaming(request):
+    data = await request.json()
+    message = data.get('message')
+    model = data.get('model', 'gpt-3.5-turbo')  # Default to gpt-3.5-turbo if model not provided
+    if not message:
+        return JSONResponse({'error': 'Message is required'}, status_code=400)
+    if model not in ALL_MODELS:
+        return JSONResponse({'error': f'Invalid model: {model}. Available models are: {ALL_MODELS}'}, status_code=400)
+
+    logger.info(f"Received message for LLM streaming ({len(message)} chars), model: {model}")
+    return sse_response(await handle_llm_stream_request(message, model))
+
+async def battle(request):
+    data = await request.json()
+    message = data.get('message')
+    arena = data.get('arena', 'models')  # 'models' or 'agents'
+    if not message:
+        return JSONResponse({'error': 'Message is required'}, status_code=400)
+    if arena not in ['models', 'agents']:
+        return JSONResponse({'error': f'Invalid arena: {arena}. Available arenas are: models, agents'}, status_code=400)
+
+    logger.info(f"Received message for {arena} battle ({len(message)} chars)")
+    if data.get('stream'):
+        return sse_response(await handle_battle_stream(message, arena))
+    contestant_a, contestant_b, response_a, response_b = await handle_battle(message, arena)
+    if response_a is None or response_b is None:
+        failed = [name for name, response in [(contestant_a, response_a), (contestant_b, response_b)]
+                  if response is None]
+        return JSONResponse({'error': f'Failed to get a response from: {", ".join(failed)}'}, status_code=500)
+
+    key = 'agent' if arena == 'agents' else 'model'
+    return JSONResponse({
+        f'{key}A': contestant_a,
+        f'{key}B': contestant_b,
+        'message': message,
+        'responseA': response_a,
+        'responseB': response_b
+    })
+
+async def criticize_user_request(request):
+    data = await request.json()
+    prompt = data.get('prompt')
+    wallet_address = os.getenv("USER_WALLET_ADDRESS")
+
+    if not prompt:
+        return JSONResponse({'error': 'Prompt is required'}, status_code=400)
+
+    logger.info(f"Received prompt for the critic ({len(prompt)} chars)")
+
+    try:
+        verdict = await asyncio.wait_for(asyncio.wrap_future(critic_batcher.submit(prompt)), critic_batcher.timeout)
+    except (ContractResponseTimeout, asyncio.TimeoutError):
+        return JSONResponse({'error': 'Timed out waiting for the critic response'}, status_code=504)
+    except ContractTransactionFailed:
+        return JSONResponse({'error': 'Critic transaction failed'}, status_code=502)
+    except CriticResponseError as e:
+        logger.error(f"Error parsing response: {e}")
+        return JSONResponse({'error': 'Failed to parse contract response'}, status_code=500)
+    score = verdict['score']
+    description = verdict['description']
+
+    if wallet_address and score >= 7 and await asyncio.to_thread(is_verified_user, data):
+        await run_in_app_context(payUser, wallet_address)
+
+    await run_in_app_context(payCritic, CONTRACT_CRITIC_WALLET)
+
+    return JSONResponse({
+        'score': score,
+        'description': description
+    })
+
+async def verify(request):
+    req_body = await request.json()
+
+    payload = {
+        "nullifier_hash": req_body["nullifier_hash"],
+        "merkle_root": req_body["merkle_root"],
+        "proof": req_body["proof"],
+        "verification_level": req_body["verification_level"],
+        "action": req_body["action"],
+        "signal": req_body["signal"],
+    }
+
+    proof_hash = proof_digest(payload)
+    token = await asyncio.to_thread(verifications.reissue, payload["nullifier_hash"], payload["action"], proof_hash)
+    if token:
+        return JSONResponse({"code": "success", "detail": "This action verified correctly!", "token": token})
+
+    verify_endpoint = f"{os.getenv('NEXT_PUBLIC_WLD_API_BASE_URL')}/api/v1/verify/{os.getenv('NEXT_PUBLIC_WLD_APP_ID')}"
+
+    try:
+        with observe('world_id'):
+            verify_res = await http_client.post(verify_endpoint, json=payload)
+    except CircuitOpenError:
+        return JSONResponse({"code": "unavailable", "detail": "World ID is temporarily unavailable"}, status_code=503)
+    wld_response = verify_res.json()
+
+    logger.info(f"Received {verify_res.status_code} response from World ID /verify endpoint")
+
+    if verify_res.status_code == 200:
+        token = await asyncio.to_thread(verifications.record, payload["nullifier_hash"], payload["action"],
+                                        payload["verification_level"], proof_hash)
+        return JSONResponse({"code": "success", "detail": "This action verified correctly!", "token": token})
+    else:
+        return JSONResponse({"code": wld_response["code"], "detail": wld_response["detail"]},
+                            status_code=verify_res.status_code)
+
+
+async def admission_rejected(request, exc):
+    return JSONResponse({'error': str(exc)}, status_code=429, headers={'Retry-After': str(exc.retry_after)})
+
+
+@asynccontextmanager
+async def lifespan(app):
+    payout_worker.start()
+    yield
+    await http_client.aclose()
+    await model_registry.aclose()
+
+
+routes = [
+    Route('/llm_request', traced(llm_request), methods=['POST']),
+    Route('/llm_request_streaming', traced(llm_request_streaming), methods=['POST']),
+    Route('/agent_request', traced(agent_request), methods=['POST']),
+    Route('/battle', traced(battle), methods=['POST']),
+    Route('/criticize_user_request', traced(criticize_user_request), methods=['POST']),
+    Route('/verify', traced(verify), methods=['POST']),
+    # Votes, leaderboards and random pairs are quick local DB work; the Flask app serves them unchanged
+    Mount('/', app=WSGIMiddleware(flask_app)),
+]
+
+app = Starlette(
+    routes=routes,
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    exception_handlers={AdmissionRejected: admission_rejected},
+    lifespan=lifespan,
+)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=5001)
@@ -0,0 +1,271 @@
+import argparse
+import asyncio
+import itertools
+import json
+import random
+
+import rlp
+import uvicorn
+from eth_abi import decode, encode
+from eth_account import Account
+from eth_utils import keccak, to_checksum_address
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+# A minimal JSON-RPC node standing in for the chain: every address behaves like an OpenAiSimpleLLM contract.
+# Transactions are mined every `block_time` seconds in nonce order per sender. Like Galadriel's oracle, mining a
+# sendMessage(string) logs OpenAiPromptAdded from the oracle contract, and `oracle_latency` seconds later its
+# operator sends addOpenAiResponse(promptId, ...) to the oracle contract, which sets the new response() of the
+# contract that asked. Batches are supported.
+
+config = {
+    'chain_id': 696969,
+    'block_time': 1.0,
+    'oracle_latency': 2.0,
+    'jitter': 0.2,
+}
+
+GAS_PRICE = 10 ** 9
+SEND_MESSAGE = keccak(text='sendMessage(string)')[:4]
+RESPONSE = keccak(text='response()')[:4]
+MESSAGE = keccak(text='message()')[:4]
+ADD_RESPONSE_TYPES = ['uint256', 'uint256', '(string,string,string,string,uint64,string,string,string,uint32,uint32,'
+                      'uint32)', 'string']
+ADD_RESPONSE = keccak(text=f"addOpenAiResponse({','.join(ADD_RESPONSE_TYPES)})")[:4]
+PROMPT_ADDED = '0x' + keccak(text='OpenAiPromptAdded(uint256,uint256,address)').hex()
+ORACLE = to_checksum_address('0x' + keccak(text='oracle').hex()[-40:])
+ORACLE_OPERATOR = to_checksum_address('0x' + keccak(text='oracle operator').hex()[-40:])
+
+
+class RPCFailure(Exception):
+    def __init__(self, message, code=-32000):
+        super().__init__(message)
+        self.code = code
+
+
+class Chain:
+    def __init__(self):
+        self.block_number = 0
+        self.mined_nonces = {}  # sender -> next nonce to mine
+        self.pending = {}  # sender -> {nonce: tx}
+        self.transactions = {}  # hash -> tx
+        self.receipts = {}  # hash -> receipt
+        self.responses = {}  # contract address -> response() value
+        self.messages = {}  # contract address -> last message
+        self.blocks = {}  # number -> transactions mined in it
+        self.answers = []  # operator transactions waiting for the next block
+        self.prompts = {}  # prompt id -> address of the contract that asked, None once answered
+        self._answers = itertools.count(1)
+
+    def nonce(self, sender, tag):
+        sender = to_checksum_address(sender)
+        mined = self.mined_nonces.get(sender, 0)
+        if tag != 'pending':
+            return mined
+        pending = self.pending.get(sender, {})
+        # Like geth, the pending nonce only counts transactions without a gap before them
+        while mined in pending:
+            mined += 1
+        return mined
+
+    def send_raw(self, raw_hex):
+        raw = bytes.fromhex(raw_hex[2:] if raw_hex.startswith('0x') else raw_hex)
+        if raw and raw[0] <= 0x7f:
+            raise RPCFailure("typed transactions are not supported by the bench node")
+        nonce, gas_price, gas, to, value, data, v, r, s = rlp.decode(raw)
+        tx_hash = '0x' + keccak(raw).hex()
+        if tx_hash in self.transactions:
+            raise RPCFailure("already known")
+        sender = Account.recover_transaction(raw)
+        tx = {
+            'hash': tx_hash, 'from': sender, 'nonce': int.from_bytes(nonce, 'big'),
+            'gasPrice': int.from_bytes(gas_price, 'big'), 'gas': int.from_bytes(gas, 'big'),
+            'to': to_checksum_address(to) if to else None, 'value': int.from_bytes(value, 'big'), 'input': data,
+        }
+        if tx['nonce'] < self.mined_nonces.get(sender, 0):
+            raise RPCFailure("nonce too low")
+        pending = self.pending.setdefault(sender, {})
+        replaced = pending.get(tx['nonce'])
+        if replaced and tx['gasPrice'] < replaced['gasPrice'] * 1.1:
+            raise RPCFailure("replacement transaction underpriced")
+        if replaced:
+            del self.transactions[replaced['hash']]
+        pending[tx['nonce']] = tx
+        self.transactions[tx_hash] = tx
+        return tx_hash
+
+    def mine(self):
+        self.block_number += 1
+        block_hash = '0x' + keccak(self.block_number.to_bytes(32, 'big')).hex()
+        mined = []
+        for sender, pending in self.pending.items():
+            nonce = self.mined_nonces.get(sender, 0)
+            while nonce in pending:
+                mined.append(pending.pop(nonce))
+                nonce += 1
+            self.mined_nonces[sender] = nonce
+        mined.extend(self.answers)
+        self.answers = []
+        for index, tx in enumerate(mined):
+            tx.update(blockHash=block_hash, blockNumber=hex(self.block_number), transactionIndex=hex(index))
+            logs, status = self.execute(tx)
+            self.receipts[tx['hash']] = {
+                'transactionHash': tx['hash'], 'transactionIndex': hex(index), 'blockHash': block_hash,
+                'blockNumber': hex(self.block_number), 'from': tx['from'], 'to': tx['to'],
+                'cumulativeGasUsed': hex(21000 * (index + 1)), 'gasUsed': hex(21000),
+                'effectiveGasPrice': hex(tx['gasPrice']), 'contractAddress': None,
+                'logs': [dict(log, blockHash=block_hash, blockNumber=hex(self.block_number), transactionHash=tx['hash'],
+                              transactionIndex=hex(index), logIndex=hex(i), removed=False)
+                         for i, log in enumerate(logs)],
+                'logsBloom': '0x' + '00' * 256, 'status': hex(status), 'type': '0x0',
+            }
+        self.blocks[self.block_number] = mined
+        return len(mined)
+
+    def execute(self, tx):
+        """Effects of a mined transaction: its logs and status."""
+        data = tx['input']
+        if tx['to'] == ORACLE and data[:4] == ADD_RESPONSE:
+            prompt_id, _, response, error = decode(ADD_RESPONSE_TYPES, data[4:])
+            address = self.prompts.get(prompt_id)
+            if address is None:
+                # "Prompt already processed", or never asked
+                return [], 0
+            self.prompts[prompt_id] = None
+            # The oracle calls back onOracleOpenAiLlmResponse, which stores the error message if there is one
+            self.responses[address] = error or response[1]
+            return [], 1
+        if tx['to'] and data[:4] == SEND_MESSAGE:
+            message = decode(['string'], data[4:])[0]
+            self.messages[tx['to']] = message
+            prompt_id = len(self.prompts)
+            self.prompts[prompt_id] = tx['to']
+            asyncio.get_running_loop().call_later(jittered(config['oracle_latency']), self.answer, prompt_id, message)
+            return [{'address': ORACLE, 'topics': [PROMPT_ADDED, '0x' + prompt_id.to_bytes(32, 'big').hex()],
+                     'data': '0x' + encode(['uint256', 'address'], [0, tx['to']]).hex()}], 1
+        return [], 1
+
+    def answer(self, prompt_id, message):
+        # Answers parse as the critic's JSON verdict; a message ending in a JSON array of {"id", "prompt"} is a batch
+        # of prompts and gets one verdict per prompt
+        answer = next(self._answers)
+        try:
+            prompts = json.loads(message[message.rindex('\n['):])
+        except ValueError:
+            prompts = None
+        if isinstance(prompts, list):
+            content = json.dumps([{'id': item['id'], 'score': random.randint(1, 10),
+                                   'description': f"Answer {answer} to a {len(item['prompt'])} character prompt"}
+                                  for item in prompts])
+        else:
+            content = json.dumps({'score': random.randint(1, 10),
+                                  'description': f"Answer {answer} to a {len(message)} character prompt"})
+        data = ADD_RESPONSE + encode(ADD_RESPONSE_TYPES,
+                                     [prompt_id, 0, ('', content, '', '', 0, '', '', '', 0, 0, 0), ''])
+        tx_hash = '0x' + keccak(data + answer.to_bytes(32, 'big')).hex()
+        tx = {'hash': tx_hash, 'from': ORACLE_OPERATOR, 'nonce': answer - 1, 'gasPrice': GAS_PRICE, 'gas': 500000,
+              'to': ORACLE, 'value': 0, 'input': data}
+        self.transactions[tx_hash] = tx
+        self.answers.append(tx)
+
+    def call(self, call):
+        address = to_checksum_address(call['to'])
+        data = bytes.fromhex(call.get('data', call.get('input', '0x'))[2:])
+        if data[:4] == RESPONSE:
+            return '0x' + encode(['string'], [self.responses.get(address, '')]).hex()
+        if data[:4] == MESSAGE:
+            return '0x' + encode(['string'], [self.messages.get(address, '')]).hex()
+        raise RPCFailure("execution reverted")
+
+    def block(self, number, full=False):
+        number = self.block_number if number in ('latest', 'pending', 'safe', 'finalized') else int(number, 16)
+        if number > self.block_number:
+            return None
+        transactions = self.blocks.get(number, [])
+        return {
+            'number': hex(number), 'hash': '0x' + keccak(number.to_bytes(32, 'big')).hex(),
+            'parentHash': '0x' + keccak(max(number - 1, 0).to_bytes(32, 'big')).hex(),
+            'timestamp': hex(1700000000 + number), 'gasLimit': hex(30000000), 'gasUsed': '0x0',
+            'baseFeePerGas': None, 'extraData': '0x', 'miner': '0x' + '00' * 20,
+            'transactions': [dict(tx, value=hex(tx['value']), nonce=hex(tx['nonce']), gas=hex(tx['gas']),
+                                  gasPrice=hex(tx['gasPrice']), input='0x' + tx['input'].hex())
+                             if full else tx['hash'] for tx in transactions],
+            'difficulty': '0x1', 'nonce': '0x' + '00' * 8, 'logsBloom': '0x' + '00' * 256,
+        }
+
+
+def jittered(seconds):
+    return max(0.0, seconds * random.uniform(1 - config['jitter'], 1 + config['jitter']))
+
+
+chain = Chain()
+
+METHODS = {
+    'web3_clientVersion': lambda: 'llamarally-bench-node/1.0',
+    'net_version': lambda: str(config['chain_id']),
+    'eth_chainId': lambda: hex(config['chain_id']),
+    'eth_blockNumber': lambda: hex(chain.block_number),
+    'eth_gasPrice': lambda: hex(GAS_PRICE),
+    'eth_estimateGas': lambda call, *args: hex(200000),
+    'eth_getTransactionCount': lambda address, tag='latest': hex(chain.nonce(address, tag)),
+    'eth_sendRawTransaction': chain.send_raw,
+    'eth_getTransactionReceipt': lambda tx_hash: chain.receipts.get(tx_hash.lower()),
+    'eth_call': lambda call, *args: chain.call(call),
+    'eth_getBlockByNumber': lambda number, full=False: chain.block(number, full),
+}
+
+
+def dispatch(request):
+    reply = {'jsonrpc': '2.0', 'id': request.get('id')}
+    method = METHODS.get(request.get('method'))
+    if method is None:
+        reply['error'] = {'code': -32601, 'message': f"the method {request.get('method')} does not exist"}
+        return reply
+    try:
+        reply['result'] = method(*request.get('params', []))
+    except RPCFailure as e:
+        reply['error'] = {'code': e.code, 'message': str(e)}
+    except Exception as e:
+        reply['error'] = {'code': -32602, 'message': f"invalid params: {e}"}
+    return reply
+
+
+async def rpc(request):
+    body = await request.json()
+    if isinstance(body, list):
+        return JSONResponse([dispatch(item) for item in body])
+    return JSONResponse(dispatch(body))
+
+
+async def miner():
+    while True:
+        await asyncio.sleep(config['block_time'])
+        chain.mine()
+
+
+async def lifespan(app):
+    task = asyncio.create_task(miner())
+    yield
+    task.cancel()
+
+
+app = Starlette(routes=[Route('/', rpc, methods=['POST'])], lifespan=lifespan)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fake EVM JSON-RPC node for benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8545)
+    parser.add_argument('--chain-id', type=int, default=config['chain_id'])
+    parser.add_argument('--block-time', type=float, default=config['block_time'])
+    parser.add_argument('--oracle-latency', type=float, default=config['oracle_latency'],
+                        help='seconds from mining a sendMessage to the oracle operator sending its answer')
+    parser.add_argument('--jitter', type=float, default=config['jitter'], help='relative spread of latencies')
+    args = parser.parse_args(argv)
+    config.update({key: value for key, value in vars(args).items() if key in config})
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning', ws='none')
+
+
+if __name__ == '__main__':
+    main()
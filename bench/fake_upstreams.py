@@ -0,0 +1,199 @@
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+import uuid
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+# Stand-ins for the HTTP upstreams of the arena, served from one process:
+#   POST /v1/chat/completions          OpenAI (and OpenAI-compatible servers), plain and streamed
+#   POST /v1/messages                  Anthropic, plain and streamed
+#   POST /v1/w3s/developer/transactions/transfer   Circle transfers
+#   POST /api/v1/verify/{app_id}       World ID proof verification
+# Answers take `latency` seconds to start and then arrive at `tokens_per_second`.
+
+config = {
+    'latency': 0.5,
+    'tokens_per_second': 50.0,
+    'tokens': 120,
+    'chunk_tokens': 1,
+    'jitter': 0.2,
+    'circle_latency': 0.2,
+    'world_id_latency': 0.1,
+}
+
+WORDS = ("the arena measures how well each model answers under load while the votes keep moving the "
+         "ratings up and down the leaderboard").split()
+
+_ids = itertools.count(1)
+_transfers = {}
+_nullifiers = set()
+
+
+def jittered(seconds):
+    return max(0.0, seconds * random.uniform(1 - config['jitter'], 1 + config['jitter']))
+
+
+def answer_chunks():
+    tokens = max(1, int(jittered(config['tokens'])))
+    start = random.randrange(len(WORDS))
+    words = [WORDS[(start + i) % len(WORDS)] + ' ' for i in range(tokens)]
+    step = config['chunk_tokens']
+    return [''.join(words[i:i + step]) for i in range(0, len(words), step)]
+
+
+def prompt_tokens(messages):
+    text = ''.join(str(message.get('content', '')) for message in messages)
+    return max(1, len(text) // 4)
+
+
+async def generate(chunks):
+    """Wait for the first token, then pace the chunks at the configured token rate."""
+    await asyncio.sleep(jittered(config['latency']))
+    interval = config['chunk_tokens'] / config['tokens_per_second'] if config['tokens_per_second'] else 0
+    next_at = time.monotonic()
+    for chunk in chunks:
+        yield chunk
+        next_at += interval
+        delay = next_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def wait_for_answer(chunks):
+    async for _ in generate(chunks):
+        pass
+
+
+def sse(data, event=None):
+    prefix = f"event: {event}\n" if event else ''
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+async def openai_chat(request):
+    body = await request.json()
+    model = body.get('model', 'unknown')
+    chunks = answer_chunks()
+    completion_id = f"chatcmpl-{next(_ids)}"
+    created = int(time.time())
+    usage = {'prompt_tokens': prompt_tokens(body.get('messages', [])), 'completion_tokens': len(chunks)}
+    usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+
+    if not body.get('stream'):
+        await wait_for_answer(chunks)
+        return JSONResponse({
+            'id': completion_id, 'object': 'chat.completion', 'created': created, 'model': model,
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ''.join(chunks)},
+                         'finish_reason': 'stop'}],
+            'usage': usage,
+        })
+
+    def chunk(delta, finish_reason=None):
+        return sse({'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                    'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]})
+
+    async def events():
+        yield chunk({'role': 'assistant', 'content': ''})
+        async for text in generate(chunks):
+            yield chunk({'content': text})
+        yield chunk({}, 'stop')
+        if (body.get('stream_options') or {}).get('include_usage'):
+            yield sse({'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                       'choices': [], 'usage': usage})
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type='text/event-stream')
+
+
+async def anthropic_messages(request):
+    body = await request.json()
+    model = body.get('model', 'unknown')
+    chunks = answer_chunks()
+    message_id = f"msg_{next(_ids)}"
+    input_tokens = prompt_tokens(body.get('messages', []))
+    message = {'id': message_id, 'type': 'message', 'role': 'assistant', 'model': model,
+               'stop_reason': None, 'stop_sequence': None}
+
+    if not body.get('stream'):
+        await wait_for_answer(chunks)
+        return JSONResponse(dict(message, content=[{'type': 'text', 'text': ''.join(chunks)}], stop_reason='end_turn',
+                                 usage={'input_tokens': input_tokens, 'output_tokens': len(chunks)}))
+
+    async def events():
+        yield sse({'type': 'message_start', 'message': dict(message, content=[],
+                                                            usage={'input_tokens': input_tokens, 'output_tokens': 0})},
+                  'message_start')
+        yield sse({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}},
+                  'content_block_start')
+        async for text in generate(chunks):
+            yield sse({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': text}},
+                      'content_block_delta')
+        yield sse({'type': 'content_block_stop', 'index': 0}, 'content_block_stop')
+        yield sse({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                   'usage': {'output_tokens': len(chunks)}}, 'message_delta')
+        yield sse({'type': 'message_stop'}, 'message_stop')
+
+    return StreamingResponse(events(), media_type='text/event-stream')
+
+
+async def circle_transfer(request):
+    body = await request.json()
+    await asyncio.sleep(jittered(config['circle_latency']))
+    # Circle deduplicates on the idempotency key, so retried payouts get the original transfer back
+    key = body.get('idempotencyKey') or str(uuid.uuid4())
+    transfer_id = _transfers.setdefault(key, str(uuid.uuid4()))
+    return JSONResponse({'data': {'id': transfer_id, 'state': 'INITIATED'}}, status_code=201)
+
+
+async def world_id_verify(request):
+    body = await request.json()
+    await asyncio.sleep(jittered(config['world_id_latency']))
+    nullifier = body.get('nullifier_hash')
+    action = body.get('action')
+    if not nullifier:
+        return JSONResponse({'code': 'invalid_proof', 'detail': 'Missing nullifier_hash'}, status_code=400)
+    if (nullifier, action) in _nullifiers:
+        return JSONResponse({'code': 'max_verifications_reached',
+                             'detail': 'This person has already verified for this action.'}, status_code=400)
+    _nullifiers.add((nullifier, action))
+    return JSONResponse({'success': True, 'nullifier_hash': nullifier, 'action': action,
+                         'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())})
+
+
+async def health(request):
+    return JSONResponse({'status': 'ok'})
+
+
+app = Starlette(routes=[
+    Route('/v1/chat/completions', openai_chat, methods=['POST']),
+    Route('/v1/messages', anthropic_messages, methods=['POST']),
+    Route('/v1/w3s/developer/transactions/transfer', circle_transfer, methods=['POST']),
+    Route('/api/v1/verify/{app_id}', world_id_verify, methods=['POST']),
+    Route('/health', health, methods=['GET']),
+])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fake LLM, Circle and World ID servers for benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8600)
+    parser.add_argument('--latency', type=float, default=config['latency'], help='seconds until the first token')
+    parser.add_argument('--tokens-per-second', type=float, default=config['tokens_per_second'])
+    parser.add_argument('--tokens', type=int, default=config['tokens'], help='tokens per answer')
+    parser.add_argument('--chunk-tokens', type=int, default=config['chunk_tokens'], help='tokens per stream chunk')
+    parser.add_argument('--jitter', type=float, default=config['jitter'], help='relative spread of latencies')
+    parser.add_argument('--circle-latency', type=float, default=config['circle_latency'])
+    parser.add_argument('--world-id-latency', type=float, default=config['world_id_latency'])
+    args = parser.parse_args(argv)
+    config.update({key: value for key, value in vars(args).items() if key in config})
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning', ws='none')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+
+import httpx
+
+# Arena traffic against a running server. Each virtual user repeatedly picks an action by weight, with an
+# exponentially distributed think time in between; battles are usually followed by a vote on their result,
+# and leaderboards are polled with If-None-Match like the frontend does.
+
+DEFAULT_MIX = 'battle=4,agent_battle=1,leaderboard=8,leaderboard_agents=2,critic=1,verify=1'
+
+PROMPTS = [
+    "Write a haiku about {topic}.",
+    "Explain {topic} to a ten year old.",
+    "Give three arguments for and against {topic}.",
+    "Summarize the history of {topic} in one paragraph.",
+    "Write a limerick about {topic}.",
+]
+TOPICS = ["rollups", "sourdough", "black holes", "the printing press", "tide pools", "compilers", "jazz",
+          "photosynthesis", "chess openings", "glaciers"]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))]
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+        self.started = time.monotonic()
+        self.finished = None
+        self.cancelled = 0
+
+    def add(self, name, seconds, status):
+        self.latencies.setdefault(name, []).append(seconds)
+        statuses = self.statuses.setdefault(name, {})
+        statuses[status] = statuses.get(status, 0) + 1
+
+    def report(self):
+        elapsed = (self.finished or time.monotonic()) - self.started
+        rows = []
+        for name in sorted(self.latencies):
+            values = sorted(self.latencies[name])
+            statuses = self.statuses[name]
+            errors = sum(count for status, count in statuses.items() if not (200 <= status < 400))
+            rows.append({
+                'endpoint': name,
+                'requests': len(values),
+                'errors': errors,
+                'rejected': statuses.get(429, 0),
+                'throughput': len(values) / elapsed if elapsed else 0.0,
+                'p50': percentile(values, 0.50),
+                'p90': percentile(values, 0.90),
+                'p99': percentile(values, 0.99),
+                'max': values[-1],
+                'statuses': {str(status): count for status, count in sorted(statuses.items())},
+            })
+        return {'elapsed': elapsed, 'cancelled': self.cancelled, 'endpoints': rows}
+
+
+def format_report(report):
+    header = f"{'endpoint':<34}{'requests':>9}{'errors':>8}{'429s':>6}{'req/s':>8}" \
+             f"{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+    summary = f"Ran for {report['elapsed']:.1f}s"
+    if report['cancelled']:
+        summary += f", cancelled {report['cancelled']} requests still running after the grace period"
+    lines = [summary, header, '-' * len(header)]
+    for row in report['endpoints']:
+        lines.append(f"{row['endpoint']:<34}{row['requests']:>9}{row['errors']:>8}{row['rejected']:>6}"
+                     f"{row['throughput']:>8.2f}{row['p50'] * 1000:>9.0f}{row['p90'] * 1000:>9.0f}"
+                     f"{row['p99'] * 1000:>9.0f}{row['max'] * 1000:>9.0f}")
+    return '\n'.join(lines)
+
+
+class VirtualUser:
+    def __init__(self, client, stats, args, mix):
+        self.client = client
+        self.stats = stats
+        self.args = args
+        self.actions, self.weights = zip(*mix.items())
+        self.etags = {}
+        self.nullifier = uuid.uuid4().hex
+        self.token = None
+
+    def prompt(self):
+        if self.args.prompt_pool:
+            # A fixed pool of prompts, so repeated ones exercise the LLM cache
+            index = random.randrange(self.args.prompt_pool)
+            return PROMPTS[index % len(PROMPTS)].format(topic=TOPICS[index // len(PROMPTS) % len(TOPICS)]) + \
+                f" ({index})"
+        return random.choice(PROMPTS).format(topic=random.choice(TOPICS)) + f" ({uuid.uuid4().hex[:8]})"
+
+    async def timed(self, name, method, path, **kwargs):
+        started = time.monotonic()
+        try:
+            response = await self.client.request(method, path, **kwargs)
+        except httpx.HTTPError:
+            self.stats.add(name, time.monotonic() - started, 599)
+            return None
+        self.stats.add(name, time.monotonic() - started, response.status_code)
+        return response
+
+    async def timed_stream(self, name, path, body):
+        started = time.monotonic()
+        first_event = None
+        status = 599
+        contestants = {}
+        try:
+            async with self.client.stream('POST', path, json=body) as response:
+                status = response.status_code
+                event = None
+                async for line in response.aiter_lines():
+                    if line.startswith('event: '):
+                        event = line[7:]
+                    elif line.startswith('data: '):
+                        if first_event is None and event == 'delta':
+                            first_event = time.monotonic() - started
+                        data = json.loads(line[6:])
+                        if event == 'start':
+                            contestants = data
+                        elif event == 'error':
+                            status = 502
+        except httpx.HTTPError:
+            status = 599
+        self.stats.add(name, time.monotonic() - started, status)
+        if first_event is not None:
+            self.stats.add(f"{name} (first delta)", first_event, status)
+        return status, contestants
+
+    async def battle(self, arena='models'):
+        key = 'agent' if arena == 'agents' else 'model'
+        body = {'message': self.prompt(), 'arena': arena}
+        if arena == 'models' and random.random() < self.args.stream_share:
+            status, result = await self.timed_stream('POST /battle stream', '/battle', dict(body, stream=True))
+            if status != 200:
+                return
+        else:
+            response = await self.timed(f"POST /battle {arena}", 'POST', '/battle', json=body)
+            if response is None or response.status_code != 200:
+                return
+            result = response.json()
+        contestant_a, contestant_b = result.get(f'{key}A'), result.get(f'{key}B')
+        if not contestant_a or random.random() >= self.args.vote_share:
+            return
+        await self.think()
+        path = '/vote_agents' if arena == 'agents' else '/vote'
+        outcome = random.choice([contestant_a, contestant_b, contestant_a, contestant_b, 'draw'])
+        await self.timed(f"POST {path}", 'POST', path, json={f'{key}A': contestant_a, f'{key}B': contestant_b,
+                                                              'result': outcome, 'verification_token': self.token})
+
+    async def agent_battle(self):
+        await self.battle('agents')
+
+    async def poll_leaderboard(self, path):
+        headers = {'If-None-Match': self.etags[path]} if path in self.etags else {}
+        response = await self.timed(f"GET {path}", 'GET', path, headers=headers)
+        if response is not None and response.headers.get('ETag'):
+            self.etags[path] = response.headers['ETag']
+
+    async def leaderboard(self):
+        await self.poll_leaderboard('/leaderboard')
+
+    async def leaderboard_agents(self):
+        await self.poll_leaderboard('/leaderboard_agents')
+
+    async def critic(self):
+        await self.timed('POST /criticize_user_request', 'POST', '/criticize_user_request',
+                         json={'prompt': self.prompt()})
+
+    async def verify(self, nullifier=None):
+        # Half the attempts reuse this user's nullifier, as a returning user would
+        nullifier = nullifier or (self.nullifier if random.random() < 0.5 else uuid.uuid4().hex)
+        response = await self.timed('POST /verify', 'POST', '/verify', json={
+            'nullifier_hash': nullifier, 'merkle_root': '0x' + '11' * 32, 'proof': '0x' + '22' * 256,
+            'verification_level': 'orb', 'action': 'vote', 'signal': '',
+        })
+        if nullifier == self.nullifier and response is not None and response.status_code == 200:
+            self.token = response.json()['token']
+
+    async def think(self):
+        if self.args.think:
+            await asyncio.sleep(random.expovariate(1 / self.args.think))
+
+    async def run(self, deadline):
+        # Like the frontend, verify with World ID before voting
+        await self.verify(self.nullifier)
+        while time.monotonic() < deadline:
+            action = random.choices(self.actions, self.weights)[0]
+            await getattr(self, action)()
+            await self.think()
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        action, _, weight = part.partition('=')
+        if action.strip() not in ('battle', 'agent_battle', 'leaderboard', 'leaderboard_agents', 'critic',
+                                  'verify'):
+            raise argparse.ArgumentTypeError(f"unknown action in mix: {action}")
+        if float(weight or 1) > 0:
+            weights[action.strip()] = float(weight or 1)
+    return weights
+
+
+def build_parser(parser=None):
+    parser = parser or argparse.ArgumentParser(description='Drive arena traffic against a running server')
+    parser.add_argument('--url', default='http://127.0.0.1:5001', help='base URL of the server under test')
+    parser.add_argument('--users', type=int, default=20, help='concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to run')
+    parser.add_argument('--ramp-up', type=float, default=5, help='seconds over which users start')
+    parser.add_argument('--think', type=float, default=1.0, help='mean think time between actions in seconds')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f'action weights (default: {DEFAULT_MIX})')
+    parser.add_argument('--vote-share', type=float, default=0.8, help='share of battles followed by a vote')
+    parser.add_argument('--stream-share', type=float, default=0.5, help='share of model battles that stream')
+    parser.add_argument('--prompt-pool', type=int, default=0,
+                        help='draw prompts from this many fixed ones (0: every prompt is unique)')
+    parser.add_argument('--timeout', type=float, default=180, help='per-request timeout in seconds')
+    parser.add_argument('--grace', type=float, default=15,
+                        help='seconds to let requests running at the end finish before cancelling them')
+    parser.add_argument('--seed', type=int, help='random seed for a repeatable traffic mix')
+    parser.add_argument('--json', dest='json_path', help='also write the report as JSON to this file')
+    return parser
+
+
+async def run_load(args):
+    if args.seed is not None:
+        random.seed(args.seed)
+    stats = Stats()
+    limits = httpx.Limits(max_connections=args.users * 2, max_keepalive_connections=args.users * 2)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        deadline = time.monotonic() + args.duration
+
+        async def start(index):
+            await asyncio.sleep(args.ramp_up * index / max(args.users, 1))
+            await VirtualUser(client, stats, args, args.mix).run(deadline)
+
+        users = [asyncio.create_task(start(index)) for index in range(args.users)]
+        _, unfinished = await asyncio.wait(users, timeout=deadline + args.grace - time.monotonic())
+        # Requests still running after the grace period are dropped rather than stretching the run
+        for user in unfinished:
+            user.cancel()
+        await asyncio.gather(*unfinished, return_exceptions=True)
+        stats.cancelled = len(unfinished)
+    stats.finished = time.monotonic()
+    return stats.report()
+
+
+def run(args):
+    report = asyncio.run(run_load(args))
+    print(format_report(report))
+    if args.json_path:
+        with open(args.json_path, 'w') as file:
+            json.dump(report, file, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    run(build_parser().parse_args())
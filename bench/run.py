@@ -0,0 +1,157 @@
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from eth_utils import to_checksum_address
+
+import load
+
+# Starts the fake upstreams and the fake chain, launches the app against them with a throwaway database,
+# drives arena traffic at it and prints throughput and latency percentiles per endpoint.
+#   python bench/run.py --server asgi --users 50 --duration 120
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+# Throwaway signing key and critic contract; the fake chain accepts any address as a contract
+BENCH_PRIVATE_KEY = '0x' + '4c' * 32
+BENCH_CRITIC_ADDRESS = to_checksum_address('0x' + 'c1' * 20)
+BENCH_WALLET = to_checksum_address('0x' + 'a0' * 20)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(url, process, log_path, timeout, method='GET'):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            with open(log_path) as file:
+                tail = file.read()[-4000:]
+            raise RuntimeError(f"{url} exited with code {process.returncode}:\n{tail}")
+        try:
+            if httpx.request(method, url, json={}, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s, see {log_path}")
+
+
+def start(name, command, workdir, env=None):
+    log_path = os.path.join(workdir, f'{name}.log')
+    log = open(log_path, 'w')
+    process = subprocess.Popen(command, cwd=REPO_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return process, log_path
+
+
+def app_environment(args, upstreams_url, rpc_url, workdir):
+    env = dict(os.environ)
+    # The repo's own entity_secret module wins when it exists; the stand-in only fills in for it
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [REPO_DIR, os.path.join(BENCH_DIR, 'stand_ins'),
+                                                      env.get('PYTHONPATH')]))
+    env.update({
+        'RPC_URL': rpc_url,
+        'PRIVATE_KEY': BENCH_PRIVATE_KEY,
+        'CONTRACT_CRITIC_ADDRESS': BENCH_CRITIC_ADDRESS,
+        'CONTRACT_CRITIC_WALLET': BENCH_WALLET,
+        'USER_WALLET_ADDRESS': BENCH_WALLET,
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'models.db')}",
+        'OPENAI_BASE_URL': f'{upstreams_url}/v1',
+        'OPENAI_API_KEY': 'bench',
+        'ANTHROPIC_BASE_URL': upstreams_url,
+        'ANTHROPIC_API_KEY': 'bench',
+        'LOCAL_LLM_BASE_URL': f'{upstreams_url}/v1',
+        'LOCAL_LLM_API_KEY': 'bench',
+        'CIRCLE_API_BASE_URL': upstreams_url,
+        'CIRCLE_API_KEY': 'bench',
+        'NEXT_PUBLIC_WLD_API_BASE_URL': upstreams_url,
+        'NEXT_PUBLIC_WLD_APP_ID': 'app_bench',
+    })
+    # Tuning knobs keep any value given in the environment
+    for key, value in {'CONTRACT_POLL_INTERVAL': '0.25', 'TX_REPLACE_AFTER': '30', 'LLM_CACHE_SQLITE': '0',
+                       'WORLD_ID_REQUIRED': '1'}.items():
+        env.setdefault(key, value)
+    return env
+
+
+def app_command(args, port):
+    if args.server == 'asgi':
+        return [sys.executable, '-m', 'uvicorn', 'asgi_app:app', '--host', '127.0.0.1', '--port', str(port),
+                '--log-level', 'warning', '--ws', 'none']
+    return [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--host', '127.0.0.1', '--port', str(port),
+            '--with-threads']
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Benchmark the arena against local fake upstreams')
+    load.build_parser(parser)
+    parser.set_defaults(url=None)
+    group = parser.add_argument_group('servers')
+    group.add_argument('--server', choices=['flask', 'asgi'], default='flask', help='how to serve the app')
+    group.add_argument('--llm-latency', type=float, default=0.5, help='seconds until the first token')
+    group.add_argument('--llm-tokens-per-second', type=float, default=50.0)
+    group.add_argument('--llm-tokens', type=int, default=120, help='tokens per answer')
+    group.add_argument('--block-time', type=float, default=1.0)
+    group.add_argument('--oracle-latency', type=float, default=2.0,
+                       help='seconds from a mined sendMessage to the contract response')
+    group.add_argument('--startup-timeout', type=float, default=60)
+    group.add_argument('--keep', action='store_true', help='keep the database and server logs')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix='llamarally-bench-')
+    processes = []
+    try:
+        upstreams_port, rpc_port, app_port = free_port(), free_port(), free_port()
+        upstreams_url, rpc_url = f'http://127.0.0.1:{upstreams_port}', f'http://127.0.0.1:{rpc_port}'
+
+        upstreams = start('upstreams', [
+            sys.executable, os.path.join(BENCH_DIR, 'fake_upstreams.py'), '--port', str(upstreams_port),
+            '--latency', str(args.llm_latency), '--tokens-per-second', str(args.llm_tokens_per_second),
+            '--tokens', str(args.llm_tokens)], workdir)
+        processes.append(upstreams[0])
+        chain = start('chain', [
+            sys.executable, os.path.join(BENCH_DIR, 'fake_evm.py'), '--port', str(rpc_port),
+            '--block-time', str(args.block_time), '--oracle-latency', str(args.oracle_latency)], workdir)
+        processes.append(chain[0])
+        wait_until_up(f'{upstreams_url}/health', *upstreams, timeout=args.startup_timeout)
+        wait_until_up(rpc_url, *chain, timeout=args.startup_timeout, method='POST')
+
+        env = app_environment(args, upstreams_url, rpc_url, workdir)
+        subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'init-db'], cwd=REPO_DIR, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        server = start('app', app_command(args, app_port), workdir, env=env)
+        processes.append(server[0])
+        args.url = f'http://127.0.0.1:{app_port}'
+        wait_until_up(f'{args.url}/ready', *server, timeout=args.startup_timeout)
+
+        print(f"Benchmarking the {args.server} server with {args.users} users for {args.duration:.0f}s")
+        load.run(args)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if args.keep:
+            print(f"Database and server logs are in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,8 @@
+import base64
+import os
+
+# Used only when the deployment's own entity_secret module is absent; the Circle stand-in accepts any ciphertext.
+
+
+def generate_entity_secret():
+    return base64.b64encode(os.urandom(256)).decode()
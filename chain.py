@@ -0,0 +1,94 @@
+import json
+import logging
+import threading
+from types import SimpleNamespace
+
+from contracts import ContractRegistry
+from http_client import get_session, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+from response_watcher import ResponseWatcher
+from transactions import TransactionPipeline
+
+logger = logging.getLogger(__name__)
+
+
+class Chain:
+    """The web3 client, transaction pipeline, contract registry and response watcher, built on first use.
+
+    web3 is only imported, and the ABI only read, once a request needs the
+    chain, so processes start quickly and without talking to the node.
+    """
+
+    def __init__(self, rpc_url, private_key, abi_path, chain_id, gas, gas_price_gwei, replace_after=60.0,
+                 poll_interval=1.0, response_timeout=120.0):
+        self.rpc_url = rpc_url
+        self.private_key = private_key
+        self.abi_path = abi_path
+        self.chain_id = chain_id
+        self.gas = gas
+        self.gas_price_gwei = gas_price_gwei
+        self.replace_after = replace_after
+        self.poll_interval = poll_interval
+        self.response_timeout = response_timeout
+        self._components = None
+        self._lock = threading.Lock()
+
+    def _build(self):
+        from web3 import Web3
+        from web3.middleware import geth_poa_middleware
+
+        web3 = Web3(Web3.HTTPProvider(self.rpc_url,
+                                      request_kwargs={'timeout': (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)},
+                                      session=get_session()))
+        web3.middleware_onion.inject(geth_poa_middleware, layer=0)
+        with open(self.abi_path, 'r') as file:
+            contract_abi = json.load(file)
+        account = web3.eth.account.from_key(self.private_key)
+        # All transactions from the signing account go through one pipeline so concurrent requests never share a nonce
+        tx_pipeline = TransactionPipeline(web3, account, self.private_key, chain_id=self.chain_id, gas=self.gas,
+                                          gas_price=web3.to_wei(self.gas_price_gwei, 'gwei'),
+                                          replace_after=self.replace_after)
+        # Contract objects are reused across requests; their reads are batched into one JSON-RPC request per tick
+        contracts = ContractRegistry(web3, contract_abi, rpc_url=self.rpc_url, session=get_session(),
+                                     timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+        response_watcher = ResponseWatcher(contracts, poll_interval=self.poll_interval,
+                                           timeout=self.response_timeout, tx_hash_resolver=tx_pipeline.sent_tx_hashes,
+                                           tx_hash_done=tx_pipeline.forget_replacement)
+        logger.info(f"Chain clients ready for {self.rpc_url}")
+        return SimpleNamespace(web3=web3, contract_abi=contract_abi, tx_pipeline=tx_pipeline, contracts=contracts,
+                               response_watcher=response_watcher)
+
+    def _get(self):
+        with self._lock:
+            if self._components is None:
+                self._components = self._build()
+            return self._components
+
+    @property
+    def web3(self):
+        return self._get().web3
+
+    @property
+    def tx_pipeline(self):
+        return self._get().tx_pipeline
+
+    @property
+    def contracts(self):
+        return self._get().contracts
+
+    @property
+    def response_watcher(self):
+        return self._get().response_watcher
+
+    def check(self, timeout):
+        """Ask the node for its chain id, without building the clients; raises if it is unreachable or elsewhere."""
+        # Not retried, so an unreachable node fails the probe within `timeout`
+        response = get_session(retries=0).post(self.rpc_url, json={'jsonrpc': '2.0', 'id': 1, 'method': 'eth_chainId',
+                                                                   'params': []}, timeout=timeout)
+        response.raise_for_status()
+        reply = response.json()
+        if 'error' in reply:
+            raise RuntimeError(f"eth_chainId failed: {reply['error']}")
+        chain_id = int(reply['result'], 16)
+        if chain_id != self.chain_id:
+            raise RuntimeError(f"node is on chain {chain_id}, expected {self.chain_id}")
+        return {'chain_id': chain_id}
@@ -2,24 +2,38 @@ import dotenv
 
 dotenv.load_dotenv()
 
-import requests
+import logging
 import os
 import uuid
 
 from entity_secret import generate_entity_secret
+from http_client import get_session
 
+logger = logging.getLogger(__name__)
 
-url = "https://api.circle.com/v1/w3s/developer/transactions/transfer"
+# Overridable so the bench harness (and staging) can point transfers at a stand-in
+CIRCLE_API_BASE_URL = os.getenv('CIRCLE_API_BASE_URL', 'https://api.circle.com')
+url = f"{CIRCLE_API_BASE_URL}/v1/w3s/developer/transactions/transfer"
 
-def create_transfer(amount: str, destination_address: str) -> None:
+# Circle expects a fresh ciphertext per request by default; only reuse it if the entity is configured to allow that
+REUSE_ENTITY_CIPHERTEXT = os.getenv('CIRCLE_REUSE_ENTITY_CIPHERTEXT') == '1'
+_entity_secret_ciphertext = None
 
-    entitySecretCipherText = generate_entity_secret()
+def get_entity_secret_ciphertext():
+    global _entity_secret_ciphertext
+    if not REUSE_ENTITY_CIPHERTEXT:
+        return generate_entity_secret()
+    if _entity_secret_ciphertext is None:
+        _entity_secret_ciphertext = generate_entity_secret()
+    return _entity_secret_ciphertext
 
-    wallet_id = "f89bfdb1-ccf3-517a-8046-12cffeb406de"
-    #generate new uuid for idempotency key
-    idempotencyKey = uuid.uuid4()
+def build_transfer_request(amount: str, destination_address: str, idempotency_key: str = None):
+
+    entitySecretCipherText = get_entity_secret_ciphertext()
 
-    print(idempotencyKey)
+    wallet_id = "f89bfdb1-ccf3-517a-8046-12cffeb406de"
+    # Callers that retry pass a stable key so Circle can deduplicate; otherwise generate a new one
+    idempotencyKey = idempotency_key or uuid.uuid4()
 
     payload = {
         "idempotencyKey": str(idempotencyKey),
@@ -36,10 +50,14 @@ def create_transfer(amount: str, destination_address: str) -> None:
         "Authorization": "Bearer "+os.getenv('CIRCLE_API_KEY')
     }
 
-    response = requests.post(url, json=payload, headers=headers)
+    return payload, headers
 
-    print(response.text)
+def create_transfer(amount: str, destination_address: str, idempotency_key: str = None) -> None:
 
-    return response.json().get('data').get('id')
+    payload, headers = build_transfer_request(amount, destination_address, idempotency_key)
+
+    response = get_session(retry_posts=True).post(url, json=payload, headers=headers)
+    logger.info(f"Circle transfer {payload['idempotencyKey']} answered {response.status_code}")
 
-create_transfer("0.1", "0xe5a0fE830657E5f473251a7d8Ff593aEb8C166a7")
\ No newline at end of file
+    response.raise_for_status()
+    return response.json().get('data').get('id')
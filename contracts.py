@@ -0,0 +1,150 @@
+import itertools
+import logging
+import threading
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+
+class RPCError(Exception):
+    pass
+
+
+# Galadriel's oracle contract, which sendMessage() asks for an answer, logs the prompt id it assigns with this event;
+# its operator answers with an addOpenAiResponse(promptId, promptCallbackId, response, errorMessage) transaction to
+# the oracle, which calls onOracleOpenAiLlmResponse on the contract that asked
+PROMPT_ADDED = 'OpenAiPromptAdded(uint256,uint256,address)'
+
+# An addOpenAiResponse transaction: the oracle it went to, the prompt it answers and the contract's new response()
+Answer = namedtuple('Answer', ['oracle', 'prompt_id', 'tx_hash', 'response'])
+
+
+class ContractRegistry:
+    """Contract objects for the agent and critic contracts, built on first use and reused.
+
+    All of them share the OpenAiSimpleLLM ABI, so the selector and argument
+    types of the oracle's answer transactions are worked out once as well.
+    With a `session`, block and receipt lookups go to the node as a single
+    JSON-RPC batch request.
+    """
+
+    def __init__(self, web3, contract_abi, rpc_url=None, session=None, timeout=None):
+        from eth_utils import collapse_if_tuple, keccak
+
+        self.web3 = web3
+        self.contract_abi = contract_abi
+        self.rpc_url = rpc_url
+        self.session = session
+        self.timeout = timeout
+        self._contracts = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        # addOpenAiResponse takes the prompt id followed by the arguments of the callback it makes
+        callback = web3.eth.contract(abi=contract_abi).get_function_by_name('onOracleOpenAiLlmResponse').abi
+        self._answer_types = ['uint256'] + [collapse_if_tuple(argument) for argument in callback['inputs']]
+        self._answer_selector = keccak(text=f"addOpenAiResponse({','.join(self._answer_types)})")[:4]
+        self._prompt_topic = keccak(text=PROMPT_ADDED)
+
+    def get(self, address):
+        with self._lock:
+            contract = self._contracts.get(address)
+            if contract is None:
+                contract = self._contracts[address] = self.web3.eth.contract(address=address, abi=self.contract_abi)
+            return contract
+
+    def batch(self, calls):
+        """Send (method, params) calls as one JSON-RPC batch; returns results or RPCError instances in order."""
+        if not calls:
+            return []
+        payload = [{'jsonrpc': '2.0', 'id': next(self._ids), 'method': method, 'params': params}
+                   for method, params in calls]
+        response = self.session.post(self.rpc_url, json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        replies = response.json()
+        if isinstance(replies, dict):
+            # Nodes answer a batch they refuse with a single error object
+            raise RPCError(replies.get('error', replies))
+        by_id = {reply.get('id'): reply for reply in replies}
+        results = []
+        for request in payload:
+            reply = by_id.get(request['id'])
+            if reply is None or 'error' in reply:
+                results.append(RPCError(reply['error'] if reply else 'missing reply'))
+            else:
+                results.append(reply.get('result'))
+        return results
+
+    def block_number(self):
+        if self.session is None:
+            return self.web3.eth.block_number
+        result = self.batch([('eth_blockNumber', [])])[0]
+        if isinstance(result, RPCError):
+            raise result
+        return int(result, 16)
+
+    def get_answers(self, block_numbers):
+        """Oracle answers mined in each block of `block_numbers`: {number: [Answer, ...] or RPCError}."""
+        if self.session is None:
+            blocks = {number: self._block_or_error(number) for number in block_numbers}
+        else:
+            results = self.batch([('eth_getBlockByNumber', [hex(number), True]) for number in block_numbers])
+            blocks = dict(zip(block_numbers, results))
+        return {number: block if isinstance(block, RPCError) else
+                RPCError(f"Block {number} not found") if block is None else self._decode_answers(block)
+                for number, block in blocks.items()}
+
+    def get_receipts(self, tx_hashes):
+        """Receipt of every transaction in `tx_hashes`: {tx_hash: receipt dict, None if not mined, or RPCError}."""
+        if self.session is None:
+            return {tx_hash: self._receipt_or_none(tx_hash) for tx_hash in tx_hashes}
+        results = self.batch([('eth_getTransactionReceipt', [self.web3.to_hex(tx_hash)]) for tx_hash in tx_hashes])
+        receipts = {}
+        for tx_hash, result in zip(tx_hashes, results):
+            if isinstance(result, dict):
+                result = dict(result, status=int(result['status'], 16), blockNumber=int(result['blockNumber'], 16),
+                              transactionIndex=int(result['transactionIndex'], 16))
+            receipts[tx_hash] = result
+        return receipts
+
+    def oracle_prompt(self, receipt):
+        """(oracle address, prompt id) logged in the receipt of a sendMessage() transaction, None if there is none."""
+        from hexbytes import HexBytes
+
+        for log in receipt['logs']:
+            topics = [HexBytes(topic) for topic in log['topics']]
+            if len(topics) > 1 and topics[0] == self._prompt_topic:
+                return log['address'].lower(), int.from_bytes(topics[1], 'big')
+        return None
+
+    def _decode_answers(self, block):
+        from hexbytes import HexBytes
+
+        answers = []
+        for tx in block['transactions']:
+            data = HexBytes(tx['input'])
+            if not tx['to'] or data[:4] != self._answer_selector:
+                continue
+            try:
+                prompt_id, _, response, error = self.web3.codec.decode(self._answer_types, data[4:])
+            except Exception as e:
+                logger.error(f"Undecodable oracle answer in {HexBytes(tx['hash']).hex()}: {e}")
+                continue
+            # Like the contract, take the error message instead of the content when the oracle reports one
+            answers.append(Answer(tx['to'].lower(), prompt_id, HexBytes(tx['hash']), error or response[1]))
+        return answers
+
+    def _block_or_error(self, number):
+        try:
+            return self.web3.eth.get_block(number, full_transactions=True)
+        except Exception as e:
+            return RPCError(str(e))
+
+    def _receipt_or_none(self, tx_hash):
+        from web3.exceptions import TransactionNotFound
+
+        try:
+            return self.web3.eth.get_transaction_receipt(tx_hash)
+        except TransactionNotFound:
+            return None
+        except Exception as e:
+            return RPCError(str(e))
@@ -0,0 +1,174 @@
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+
+from response_watcher import ContractResponseTimeout
+
+logger = logging.getLogger(__name__)
+
+# Sent ahead of the prompts of a batch; the critic is asked for one verdict per prompt, keyed by id. Prompts are
+# JSON-encoded so one user's prompt can't pass itself off as the end of the list.
+BATCH_INSTRUCTIONS = (
+    "You are to receive several user prompts. Evaluate each prompt on its own: determine if it is good or bad, "
+    "assign it a score out of 10 and provide a description explaining the score. The prompts are given as a JSON "
+    "array of objects with an id and a prompt. Answer ONLY with a JSON array holding one object per prompt, in the "
+    "same order and without ```json or ANY other info, of the form "
+    "{\"id\": <id>, \"score\": <score out of 10>, \"description\": \"<explanation of the score>\"}."
+    "\n\nHere are the prompts for you to evaluate:\n\n"
+)
+
+
+class CriticResponseError(ValueError):
+    pass
+
+
+def batch_message(prompts):
+    return BATCH_INSTRUCTIONS + json.dumps([{'id': i, 'prompt': prompt} for i, prompt in enumerate(prompts, 1)])
+
+
+def parse_verdict(verdict):
+    if not isinstance(verdict, dict) or not isinstance(verdict.get('score'), (int, float)):
+        raise CriticResponseError(f"Not a critic verdict: {verdict!r}")
+    return {'score': verdict['score'], 'description': verdict.get('description')}
+
+
+def parse_response(response):
+    """Return the verdict of a critic answer to a lone prompt."""
+    try:
+        verdict = json.loads(response)
+    except ValueError as e:
+        raise CriticResponseError(f"Critic answer is not JSON: {e}")
+    return parse_verdict(verdict)
+
+
+def parse_batch_response(response, count):
+    """Return one verdict per prompt of the batch, or a CriticResponseError for prompts the answer misses.
+
+    A verdict only counts for the prompt whose id it names: an answer
+    without ids, e.g. one verdict for the whole message, scores no prompt.
+    """
+    try:
+        verdicts = json.loads(response)
+    except ValueError as e:
+        return [CriticResponseError(f"Critic answer is not JSON: {e}")] * count
+    if isinstance(verdicts, dict):
+        verdicts = [verdicts]
+    if not isinstance(verdicts, list):
+        return [CriticResponseError(f"Critic answer is not a list: {response!r}")] * count
+    by_id = {}
+    for verdict in verdicts:
+        if isinstance(verdict, dict) and 'id' in verdict:
+            by_id.setdefault(verdict['id'], []).append(verdict)
+    results = []
+    for prompt_id in range(1, count + 1):
+        if len(by_id.get(prompt_id, ())) != 1:
+            results.append(CriticResponseError(f"Critic answer has no single verdict for prompt {prompt_id}"))
+            continue
+        try:
+            results.append(parse_verdict(by_id[prompt_id][0]))
+        except CriticResponseError as e:
+            results.append(e)
+    return results
+
+
+class CriticBatcher:
+    """Sends prompts to the critic contract in batches, one transaction per batch.
+
+    Up to `max_in_flight` batches are out at a time, each answered on its own
+    since the response watcher matches every answer to its transaction.
+    While all of them are out, prompts queue up, and the next batch takes up
+    to `max_batch` of them, waiting at most `window` seconds for more once
+    the first has arrived. Throughput thus grows with the batch size once
+    transactions in flight are the limit. A batch of one is sent as the bare
+    prompt, exactly as before batching, which is the default since the
+    deployed critic must be able to answer batches; see BATCH_INSTRUCTIONS.
+    `send(message)` sends a message to the critic and blocks until its
+    response. Callers give up on a verdict after `timeout` seconds; prompts
+    whose caller gave up are dropped from their batch.
+    """
+
+    def __init__(self, send, max_batch=1, window=0.5, timeout=None, max_in_flight=16):
+        self.send = send
+        self.max_batch = max_batch
+        self.window = window
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='critic')
+        self._thread = None
+        self._counts = {'prompts': 0, 'batches': 0, 'in_flight': 0}
+
+    def submit(self, prompt):
+        """Queue `prompt` and return a Future for its verdict, a dict with score and description."""
+        future = Future()
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='critic-batcher', daemon=True)
+                self._thread.start()
+        self._queue.put((prompt, future))
+        return future
+
+    def evaluate(self, prompt):
+        future = self.submit(prompt)
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise ContractResponseTimeout(f"No critic verdict within {self.timeout}s")
+
+    def stats(self):
+        with self._lock:
+            return {**self._counts, 'queued': self._queue.qsize()}
+
+    def _run(self):
+        while True:
+            # Prompts arriving while every slot is taken gather in the queue for the next batch
+            self._slots.acquire()
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self._executor.submit(self._send_batch, batch)
+
+    def _send_batch(self, batch):
+        with self._lock:
+            self._counts['in_flight'] += 1
+        try:
+            self._answer_batch([(prompt, future) for prompt, future in batch if not future.cancelled()])
+        finally:
+            with self._lock:
+                self._counts['in_flight'] -= 1
+            self._slots.release()
+
+    def _answer_batch(self, batch):
+        if not batch:
+            return
+        prompts = [prompt for prompt, _ in batch]
+        with self._lock:
+            self._counts['prompts'] += len(batch)
+            self._counts['batches'] += 1
+        logger.info(f"Sending {len(batch)} prompts to the critic")
+        try:
+            if len(batch) == 1:
+                results = [parse_response(self.send(prompts[0]))]
+            else:
+                results = parse_batch_response(self.send(batch_message(prompts)), len(batch))
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            try:
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+            except InvalidStateError:
+                # The caller gave up meanwhile, e.g. its client disconnected
+                pass
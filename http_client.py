@@ -0,0 +1,217 @@
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# Shared outbound HTTP layer: keep-alive pools per host, default timeouts, retries with jittered backoff on
+# 429/5xx and a circuit breaker per host, for World ID, Circle, the RPC node and the LLM SDKs. Only idempotent
+# methods are retried, and POSTs only where the request carries an idempotency key.
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '30'))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', '3'))
+HTTP_BACKOFF = float(os.getenv('HTTP_BACKOFF', '0.5'))
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '32'))
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', '5'))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', '30'))
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', '120'))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '2'))
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Stops calling a host after repeated failures until `reset_timeout` has passed.
+
+    After the timeout a single trial request is let through; its outcome
+    closes the circuit again or re-opens it for another timeout.
+    """
+
+    def __init__(self, host, failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return 'closed'
+            return 'half-open' if time.monotonic() - self.opened_at >= self.reset_timeout else 'open'
+
+    def before_request(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_timeout or self._trial_in_flight:
+                raise CircuitOpenError(f"Circuit open for {self.host}")
+            self._trial_in_flight = True
+
+    def cancel_trial(self):
+        # The request failed for a reason of our own, so it says nothing about the host; let the next one try
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record(self, success):
+        with self._lock:
+            self._trial_in_flight = False
+            if success:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning(f"Opening circuit for {self.host} after {self.failures} failures")
+                self.opened_at = time.monotonic()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(url):
+    host = urlsplit(str(url)).netloc
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker(host)
+        return breaker
+
+
+def breaker_states():
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.host: breaker.state for breaker in breakers}
+
+
+class ResilientAdapter(HTTPAdapter):
+    """requests adapter adding default timeouts and circuit breaking on top of urllib3 retries."""
+
+    def __init__(self, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        breaker = get_breaker(request.url)
+        breaker.before_request()
+        try:
+            response = super().send(request, timeout=timeout or self.timeout, **kwargs)
+        except requests.RequestException:
+            breaker.record(False)
+            raise
+        except BaseException:
+            breaker.cancel_trial()
+            raise
+        breaker.record(response.status_code < 500)
+        return response
+
+
+def make_session(retries=HTTP_RETRIES, backoff=HTTP_BACKOFF, pool_size=HTTP_POOL_SIZE,
+                 allowed_methods=Retry.DEFAULT_ALLOWED_METHODS):
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        backoff_jitter=backoff,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=allowed_methods,  # None retries every method, POSTs included
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    session = requests.Session()
+    adapter = ResilientAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+_sessions = {}
+_session_lock = threading.Lock()
+
+
+def get_session(retry_posts=False, retries=HTTP_RETRIES):
+    # Only for POSTs that are safe to repeat, like Circle transfers with their idempotency key, pass retry_posts=True:
+    # a retried World ID verification would fail on its already used nullifier. Probes with a deadline of their own
+    # pass retries=0.
+    with _session_lock:
+        session = _sessions.get((retry_posts, retries))
+        if session is None:
+            allowed_methods = None if retry_posts else Retry.DEFAULT_ALLOWED_METHODS
+            session = _sessions[retry_posts, retries] = make_session(retries=retries, allowed_methods=allowed_methods)
+        return session
+
+
+class BreakerTransport(httpx.BaseTransport):
+    def __init__(self, transport):
+        self.transport = transport
+
+    def handle_request(self, request):
+        breaker = get_breaker(request.url)
+        breaker.before_request()
+        try:
+            response = self.transport.handle_request(request)
+        except httpx.TransportError:
+            breaker.record(False)
+            raise
+        except BaseException:
+            breaker.cancel_trial()
+            raise
+        breaker.record(response.status_code < 500)
+        return response
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncBreakerTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport):
+        self.transport = transport
+
+    async def handle_async_request(self, request):
+        breaker = get_breaker(request.url)
+        breaker.before_request()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except httpx.TransportError:
+            breaker.record(False)
+            raise
+        except BaseException:
+            breaker.cancel_trial()
+            raise
+        breaker.record(response.status_code < 500)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def _limits(pool_size):
+    return httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+
+
+def make_httpx_client(timeout=HTTP_READ_TIMEOUT, pool_size=HTTP_POOL_SIZE):
+    # Status retries are left to the caller (the LLM SDKs retry 429/5xx with jittered backoff themselves)
+    transport = httpx.HTTPTransport(limits=_limits(pool_size), retries=HTTP_RETRIES)
+    return httpx.Client(transport=BreakerTransport(transport),
+                        timeout=httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT))
+
+
+def make_async_httpx_client(timeout=HTTP_READ_TIMEOUT, pool_size=HTTP_POOL_SIZE):
+    transport = httpx.AsyncHTTPTransport(limits=_limits(pool_size), retries=HTTP_RETRIES)
+    return httpx.AsyncClient(transport=AsyncBreakerTransport(transport),
+                             timeout=httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT))
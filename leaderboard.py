@@ -0,0 +1,69 @@
+import hashlib
+import threading
+import time
+
+from models import SCORE_MODELS
+
+
+def build_leaderboard(rows):
+    rows = sorted(rows, key=lambda row: row[1], reverse=True)
+    return [
+        {
+            'rank': idx + 1,
+            'name': name,
+            'score': score,
+            'price': price,
+            'price_per_score': score / price if price != 0 else 0
+        }
+        for idx, (name, score, price, _) in enumerate(rows)
+    ]
+
+
+class LeaderboardCache:
+    """Materialized leaderboards, serialized once per change.
+
+    A snapshot is rebuilt only after `invalidate(kind)` (called when votes are
+    applied in this process) or once it is older than `max_age` seconds, which
+    bounds staleness when other processes apply votes. Each page is cached as
+    ready-to-send JSON bytes with a content-derived ETag, so every worker
+    hands out the same ETag for the same leaderboard.
+    """
+
+    def __init__(self, app, ratings, max_age=5.0):
+        self.app = app
+        self.ratings = ratings
+        self.max_age = max_age
+        self._snapshots = {}
+        self._stale = set(SCORE_MODELS)
+        self._lock = threading.Lock()
+
+    def invalidate(self, kind):
+        with self._lock:
+            self._stale.add(kind)
+
+    def get(self, kind, page=None, per_page=None):
+        """Return (body, etag, total) for the whole leaderboard or one page of it."""
+        snapshot = self._snapshot(kind)
+        key = (page, per_page)
+        cached = snapshot['pages'].get(key)
+        if cached is None:
+            rows = snapshot['rows']
+            if page is not None and per_page is not None:
+                rows = rows[(page - 1) * per_page:page * per_page]
+            # Serialize like jsonify so cached bodies match the uncached responses byte for byte
+            body = (self.app.json.dumps(rows) + '\n').encode('utf-8')
+            etag = hashlib.sha1(body).hexdigest()
+            cached = snapshot['pages'][key] = (body, etag)
+        return cached[0], cached[1], len(snapshot['rows'])
+
+    def _snapshot(self, kind):
+        with self._lock:
+            snapshot = self._snapshots.get(kind)
+            if snapshot is not None and kind not in self._stale \
+                    and time.monotonic() - snapshot['built_at'] < self.max_age:
+                return snapshot
+            self._stale.discard(kind)
+            rows = build_leaderboard(self.ratings.rows(kind))
+            snapshot = {'rows': rows, 'pages': {}, 'built_at': time.monotonic()}
+            self._snapshots[kind] = snapshot
+            return snapshot
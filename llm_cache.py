@@ -0,0 +1,206 @@
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_message(message):
+    # Only the ends: whitespace inside a prompt (code, tables, poems) can change the answer
+    return message.strip()
+
+
+def make_cache_key(model, message, system_prompt=None, params=None):
+    raw = json.dumps([model, normalize_message(message), system_prompt, params or {}], sort_keys=True)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ComputeAbandoned(Exception):
+    """The caller computing a value was cancelled; the callers waiting for it compute it themselves."""
+
+
+def split_for_replay(text, chunk_size=64):
+    return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+
+class ResponseCache:
+    """Two-tier cache of LLM answers keyed by model, prompt and generation params.
+
+    The first tier is an in-memory LRU, the optional second tier a SQLite file
+    that survives restarts and is shared by workers on the same host. Both
+    tiers expire entries after `ttl` seconds. Concurrent misses for the same
+    key are coalesced: the first caller computes the answer and the others
+    wait for its result instead of calling the provider again, for at most
+    `wait_timeout` seconds.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600, sqlite_path=None, sqlite_max_entries=100000, wait_timeout=None):
+        self.max_entries = max_entries
+        self.wait_timeout = wait_timeout
+        self.ttl = ttl
+        self.sqlite_max_entries = sqlite_max_entries
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'sqlite_hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0}
+        self.sqlite_path = sqlite_path
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._db_writes = 0
+
+    def _connection(self):
+        # Opened on first use, with _db_lock held, so a preforking server never shares one connection between workers
+        if self._db is None:
+            self._db = sqlite3.connect(self.sqlite_path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS llm_cache '
+                             '(key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS ix_llm_cache_created_at ON llm_cache (created_at)')
+            self._db.commit()
+        return self._db
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, created_at = entry
+                if now - created_at < self.ttl:
+                    self._entries.move_to_end(key)
+                    self._counters['hits'] += 1
+                    return value
+                del self._entries[key]
+
+        value, created_at = self._sqlite_get(key, now)
+        with self._lock:
+            if value is None:
+                self._counters['misses'] += 1
+                return None
+            self._counters['sqlite_hits'] += 1
+            self._remember(key, value, created_at)
+        return value
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+        self._sqlite_set(key, value, now)
+
+    def get_or_compute(self, key, compute):
+        while True:
+            value = self.get(key)
+            if value is not None:
+                return value
+            future, leader = self._join(key)
+            if leader:
+                break
+            try:
+                return future.result(self.wait_timeout)
+            except ComputeAbandoned:
+                continue
+        try:
+            value = compute()
+        except BaseException as e:
+            self._finish(key, future, error=e if isinstance(e, Exception) else ComputeAbandoned())
+            raise
+        self._finish(key, future, value)
+        return value
+
+    async def get_or_compute_async(self, key, compute):
+        while True:
+            value = self.get(key)
+            if value is not None:
+                return value
+            future, leader = self._join(key)
+            if leader:
+                break
+            waiting = asyncio.wrap_future(future)
+            # Retrieves the leader's error even if this caller stopped waiting for it, so it isn't logged as lost
+            waiting.add_done_callback(lambda done: done.cancelled() or done.exception())
+            try:
+                # Shielded, so a waiting caller that is cancelled or times out doesn't cancel the others' future
+                return await asyncio.wait_for(asyncio.shield(waiting), self.wait_timeout)
+            except ComputeAbandoned:
+                continue
+        try:
+            value = await compute()
+        except BaseException as e:
+            # Includes CancelledError, e.g. the leader's client went away: the key must not stay in flight
+            self._finish(key, future, error=e if isinstance(e, Exception) else ComputeAbandoned())
+            raise
+        self._finish(key, future, value)
+        return value
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._entries)
+            stats['in_flight'] = len(self._in_flight)
+        lookups = stats['hits'] + stats['sqlite_hits'] + stats['misses']
+        stats['hit_ratio'] = (stats['hits'] + stats['sqlite_hits']) / lookups if lookups else 0
+        return stats
+
+    def _remember(self, key, value, created_at):
+        self._entries[key] = (value, created_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._counters['evictions'] += 1
+
+    def _join(self, key):
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self._counters['coalesced'] += 1
+                return future, False
+            future = Future()
+            self._in_flight[key] = future
+            return future, True
+
+    def _finish(self, key, future, value=None, error=None):
+        # Failed or empty answers are handed to the waiting callers but never cached
+        if error is None and value is not None:
+            self.set(key, value)
+        with self._lock:
+            self._in_flight.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(value)
+
+    def _sqlite_get(self, key, now):
+        if not self.sqlite_path:
+            return None, None
+        try:
+            with self._db_lock:
+                row = self._connection().execute(
+                    'SELECT value, created_at FROM llm_cache WHERE key = ? AND created_at > ?',
+                    (key, now - self.ttl)).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to read LLM cache entry: {str(e)}")
+            return None, None
+        return row if row else (None, None)
+
+    def _sqlite_set(self, key, value, now):
+        if not self.sqlite_path:
+            return
+        try:
+            with self._db_lock:
+                db = self._connection()
+                db.execute('INSERT OR REPLACE INTO llm_cache (key, value, created_at) VALUES (?, ?, ?)',
+                           (key, value, now))
+                self._db_writes += 1
+                # Trim expired and surplus rows every so often rather than on every write
+                if self._db_writes % 100 == 0:
+                    db.execute('DELETE FROM llm_cache WHERE created_at <= ?', (now - self.ttl,))
+                    db.execute('DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache '
+                               'ORDER BY created_at DESC LIMIT -1 OFFSET ?)', (self.sqlite_max_entries,))
+                db.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to write LLM cache entry: {str(e)}")
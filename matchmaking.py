@@ -0,0 +1,100 @@
+import bisect
+import math
+import random
+import threading
+import time
+
+from models import SCORE_MODELS
+
+INITIAL_RATING = 1200
+
+
+def win_probability(rating, opponent_rating):
+    # Same curve as rating_store.elo_update
+    return 1 / (1 + 10 ** ((opponent_rating - rating) / 400))
+
+
+class Matchmaker:
+    """Picks battle pairs that tell the leaderboard the most per vote.
+
+    The first contestant is drawn with probability proportional to its
+    rating uncertainty, 1 / sqrt(votes + 1), so new and rarely voted
+    contestants battle more often. Its opponent is drawn from the
+    `neighbours` contestants on either side of it in rating order, weighted
+    by the information a vote on the pair carries: p * (1 - p) for the win
+    probability p, times the pair's summed uncertainty. With probability
+    `explore` the pair is drawn uniformly instead, so every pairing keeps
+    occurring and lopsided ratings still get corrected.
+
+    Ratings and vote counts are held in a snapshot rebuilt after
+    `invalidate(kind)` or once older than `max_age` seconds, like the
+    leaderboards. A pick costs O(log n) for the first contestant and
+    O(neighbours) for the second.
+    """
+
+    def __init__(self, ratings, contestants, neighbours=4, explore=0.1, max_age=30.0):
+        if neighbours < 1:
+            # Without neighbours a contestant has no opponent to be paired with
+            raise ValueError(f"neighbours must be at least 1, got {neighbours}")
+        self.ratings = ratings
+        # kind -> names that may be matched, e.g. only the models whose endpoints are configured
+        self.contestants = contestants
+        self.neighbours = neighbours
+        self.explore = explore
+        self.max_age = max_age
+        self._snapshots = {}
+        self._stale = set(SCORE_MODELS)
+        self._lock = threading.Lock()
+
+    def invalidate(self, kind):
+        with self._lock:
+            self._stale.add(kind)
+
+    def pick(self, kind):
+        names = self.contestants[kind]
+        if len(names) <= 2 or random.random() < self.explore:
+            return random.sample(names, 2)
+        snapshot = self._snapshot(kind)
+        order, uncertainty, ratings = snapshot['order'], snapshot['uncertainty'], snapshot['ratings']
+
+        cum_weights = snapshot['cum_weights']
+        index = min(bisect.bisect_right(cum_weights, random.random() * cum_weights[-1]), len(order) - 1)
+        first = order[index]
+        candidates = order[max(0, index - self.neighbours):index] + order[index + 1:index + 1 + self.neighbours]
+        weights = []
+        for name in candidates:
+            p = win_probability(ratings[first], ratings[name])
+            weights.append(p * (1 - p) * (uncertainty[first] + uncertainty[name]))
+        second = random.choices(candidates, weights)[0]
+        # Either may be shown first, so the A/B position carries no hint about the ratings
+        return [first, second] if random.random() < 0.5 else [second, first]
+
+    def _snapshot(self, kind):
+        with self._lock:
+            snapshot = self._snapshots.get(kind)
+            if snapshot is not None and kind not in self._stale \
+                    and time.monotonic() - snapshot['built_at'] < self.max_age:
+                return snapshot
+            self._stale.discard(kind)
+            rows = [(name, score, votes) for name, score, _, votes in self.ratings.rows(kind)]
+            snapshot = self._build(self.contestants[kind], rows)
+            self._snapshots[kind] = snapshot
+            return snapshot
+
+    @staticmethod
+    def _build(names, rows):
+        stored = {name: (score, votes) for name, score, votes in rows}
+        ratings = {}
+        uncertainty = {}
+        for name in names:
+            score, votes = stored.get(name, (INITIAL_RATING, 0))
+            ratings[name] = score
+            uncertainty[name] = 1 / math.sqrt(votes + 1)
+        order = sorted(names, key=ratings.get)
+        cum_weights = []
+        total = 0.0
+        for name in order:
+            total += uncertainty[name]
+            cum_weights.append(total)
+        return {'order': order, 'ratings': ratings, 'uncertainty': uncertainty, 'cum_weights': cum_weights,
+                'built_at': time.monotonic()}
@@ -0,0 +1,164 @@
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Share of requests whose per-stage timings are logged as one JSON trace line, 0 to 1
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0'))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [(name, value) for name, value in zip(names, values) if value != ''] + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Histogram:
+    def __init__(self, name, help, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        for key, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{_format_labels(self.label_names, key, [("le", bound)])} {cumulative}')
+            lines.append(f'{self.name}_bucket{_format_labels(self.label_names, key, [("le", "+Inf")])} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(self.label_names, key)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.label_names, key)} {count}')
+        return lines
+
+
+STAGE_SECONDS = Histogram('llamarally_stage_seconds', 'Time spent in one stage of a request',
+                          ('stage', 'provider', 'model', 'agent'))
+REQUEST_SECONDS = Histogram('llamarally_http_request_seconds', 'Time until the response starts, per endpoint',
+                            ('endpoint', 'method', 'status'))
+
+_collectors = []
+
+
+def register_collector(collect):
+    """`collect()` returns [(name, type, help, [(labels dict, value), ...]), ...] read at scrape time."""
+    _collectors.append(collect)
+
+
+def render():
+    lines = STAGE_SECONDS.render() + REQUEST_SECONDS.render()
+    for collect in _collectors:
+        try:
+            families = collect()
+        except Exception as e:
+            logger.error(f"Error collecting metrics: {str(e)}")
+            continue
+        for name, metric_type, help, samples in families:
+            lines += [f'# HELP {name} {help}', f'# TYPE {name} {metric_type}']
+            for labels, value in samples:
+                lines.append(f'{name}{_format_labels(list(labels), list(labels.values()))} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class Trace:
+    def __init__(self, name):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, labels):
+        offset = time.perf_counter() - self.started - seconds
+        with self._lock:
+            self.spans.append({'stage': stage, 'start': round(offset, 4), 'seconds': round(seconds, 4),
+                               **{name: value for name, value in labels.items() if value}})
+
+    def finish(self, status):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span['start'])
+        logger.info("trace " + json.dumps({'trace_id': self.trace_id, 'request': self.name, 'status': status,
+                                           'seconds': round(time.perf_counter() - self.started, 4),
+                                           'spans': spans}))
+
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def start_trace(name):
+    """Start a trace for the current request if it is sampled; returns the reset token for finish_trace."""
+    trace = Trace(name) if TRACE_SAMPLE_RATE and random.random() < TRACE_SAMPLE_RATE else None
+    return _current_trace.set(trace)
+
+
+def finish_trace(token, status):
+    trace = _current_trace.get()
+    _current_trace.reset(token)
+    if trace is not None:
+        trace.finish(status)
+
+
+def record(stage, seconds, trace=None, **labels):
+    STAGE_SECONDS.observe(seconds, stage=stage, **labels)
+    trace = trace or _current_trace.get()
+    if trace is not None:
+        trace.add(stage, seconds, labels)
+
+
+@contextmanager
+def observe(stage, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - started, **labels)
+
+
+def traced(endpoint):
+    """Wrap an async Starlette endpoint with request timing and sampled tracing."""
+    async def wrapper(request):
+        started = time.perf_counter()
+        token = start_trace(request.url.path)
+        status = 'error'
+        try:
+            response = await endpoint(request)
+            status = response.status_code
+            return response
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=request.url.path,
+                                    method=request.method, status=status)
+            finish_trace(token, status)
+    return wrapper
@@ -0,0 +1,96 @@
+import logging
+import time
+
+from sqlalchemy import func, inspect, or_
+
+from models import db, ModelScore, AgentScore, Vote, Verification, SCORE_MODELS
+
+logger = logging.getLogger(__name__)
+
+# Schema changes to tables that already exist. db.create_all() creates missing tables with their current
+# columns and indexes, but never alters an existing table; each migration does that for databases created
+# before it, and is a no-op on fresh ones. Append new migrations at the end and never rename applied ones.
+
+schema_migrations = db.Table(
+    'schema_migrations',
+    db.Column('name', db.String(100), primary_key=True),
+    db.Column('applied_at', db.Float, nullable=False),
+)
+
+
+def _create_index(connection, model, column):
+    index = next(index for index in model.__table__.indexes if index.columns.keys() == [column])
+    index.create(connection, checkfirst=True)
+
+
+def add_score_indexes(connection):
+    # Leaderboards are read in score order
+    _create_index(connection, ModelScore, 'score')
+    _create_index(connection, AgentScore, 'score')
+
+
+def add_vote_counts(connection):
+    # Votes per contestant, counted from the vote log, for matchmaking
+    for kind, model in SCORE_MODELS.items():
+        table = model.__table__
+        if 'votes' in {column['name'] for column in inspect(connection).get_columns(table.name)}:
+            continue
+        connection.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN votes INTEGER NOT NULL DEFAULT 0')
+        votes = db.select(func.count(Vote.id)).where(
+            Vote.kind == kind, or_(Vote.contestant_a == table.c.name, Vote.contestant_b == table.c.name)
+        ).scalar_subquery()
+        connection.execute(table.update().values(votes=votes))
+
+
+def add_verification_proofs(connection):
+    # Verifications stored before this have no proof to compare and are sent to World ID again
+    table = Verification.__table__
+    if 'proof_hash' not in {column['name'] for column in inspect(connection).get_columns(table.name)}:
+        connection.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN proof_hash VARCHAR(64)')
+
+
+def add_vote_applied(connection):
+    # Votes logged before this were applied to the scores in the same transaction
+    table = Vote.__table__
+    if 'applied_at' not in {column['name'] for column in inspect(connection).get_columns(table.name)}:
+        connection.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN applied_at FLOAT')
+        connection.execute(table.update().values(applied_at=table.c.created_at))
+    _create_index(connection, Vote, 'applied_at')
+
+
+# (name, upgrade, required): the models can't query a database without the columns of a required migration
+MIGRATIONS = [
+    ('0001_score_indexes', add_score_indexes, False),
+    ('0002_vote_counts', add_vote_counts, True),
+    ('0003_verification_proofs', add_verification_proofs, True),
+    ('0004_vote_applied', add_vote_applied, True),
+]
+
+
+def applied_migrations():
+    return {name for name, in db.session.execute(db.select(schema_migrations.c.name))}
+
+
+def pending_migrations(required=False):
+    """Names of the migrations not applied yet, only the required ones if `required`."""
+    # A database init-db never migrated has no schema_migrations table and every migration pending
+    applied = applied_migrations() if inspect(db.engine).has_table(schema_migrations.name) else set()
+    return [name for name, _, needed in MIGRATIONS if name not in applied and (needed or not required)]
+
+
+def migrate():
+    """Apply pending migrations in order, each in its own transaction; returns the names applied."""
+    schema_migrations.create(db.engine, checkfirst=True)
+    applied = applied_migrations()
+    db.session.commit()
+    done = []
+    for name, upgrade, _ in MIGRATIONS:
+        if name in applied:
+            continue
+        # A concurrent run applying the same migration fails on the primary key and rolls back
+        with db.engine.begin() as connection:
+            upgrade(connection)
+            connection.execute(schema_migrations.insert().values(name=name, applied_at=time.time()))
+        logger.info(f"Applied migration {name}")
+        done.append(name)
+    return done
@@ -0,0 +1,140 @@
+import logging
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+from sqlalchemy import func
+
+from circle import create_transfer
+from metrics import observe
+from models import db, Payout, begin_write
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_payout(wallet, amount, reason, commit=True):
+    db.session.add(Payout(wallet=wallet, amount=str(amount), reason=reason))
+    if commit:
+        with observe('db_commit'):
+            db.session.commit()
+
+
+def payout_backlog(status=None, limit=50):
+    now = time.time()
+    summary = {}
+    rows = db.session.query(Payout.status, func.count(Payout.id), func.min(Payout.created_at)) \
+        .group_by(Payout.status).all()
+    for row_status, count, oldest in rows:
+        summary[row_status] = {'count': count, 'oldest_age': now - oldest if oldest else 0}
+
+    query = Payout.query.order_by(Payout.id.desc())
+    if status:
+        query = query.filter_by(status=status)
+    payouts = [
+        {
+            'id': payout.id,
+            'wallet': payout.wallet,
+            'amount': payout.amount,
+            'reason': payout.reason,
+            'status': payout.status,
+            'transfer_id': payout.transfer_id,
+            'attempts': payout.attempts,
+            'error': payout.error,
+            'created_at': payout.created_at
+        }
+        for payout in query.limit(limit)
+    ]
+    return {'summary': summary, 'payouts': payouts}
+
+
+class PayoutWorker:
+    """Sends queued payouts to Circle from a background thread.
+
+    Payouts to the same wallet are held for `window` seconds and then sent as
+    one transfer. Each batch gets its idempotency key stored on its rows
+    before the first attempt, so retries (including after a crash) reuse the
+    key and Circle never pays a batch twice. Batches are claimed with a
+    conditional update, so several processes can run a worker on one database.
+    """
+
+    def __init__(self, app, window=30.0, interval=5.0, max_attempts=5, stale_after=300.0):
+        self.app = app
+        self.window = window
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.stale_after = stale_after
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='payout-worker', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    self.process_due()
+            except Exception as e:
+                logger.error(f"Error while processing payouts: {str(e)}")
+                with self.app.app_context():
+                    db.session.rollback()
+            time.sleep(self.interval)
+
+    def process_due(self):
+        now = time.time()
+        self._release_stale(now)
+        self._assign_batches(now)
+        for batch_key, in db.session.query(Payout.batch_key).filter(
+                Payout.status == 'pending', Payout.batch_key.isnot(None),
+                Payout.next_attempt_at <= now).distinct().all():
+            self._send_batch(batch_key)
+
+    def _release_stale(self, now):
+        # Batches left in 'sending' by a crashed worker go back to the queue with their idempotency key
+        Payout.query.filter(Payout.status == 'sending', Payout.updated_at < now - self.stale_after) \
+            .update({'status': 'pending', 'updated_at': now}, synchronize_session=False)
+        db.session.commit()
+
+    def _assign_batches(self, now):
+        begin_write()
+        due_wallets = db.session.query(Payout.wallet).filter(
+            Payout.status == 'pending', Payout.batch_key.is_(None)
+        ).group_by(Payout.wallet).having(func.min(Payout.created_at) <= now - self.window).all()
+        for wallet, in due_wallets:
+            Payout.query.filter(Payout.status == 'pending', Payout.batch_key.is_(None), Payout.wallet == wallet) \
+                .update({'batch_key': str(uuid.uuid4()), 'updated_at': now}, synchronize_session=False)
+        db.session.commit()
+
+    def _send_batch(self, batch_key):
+        now = time.time()
+        claimed = Payout.query.filter_by(batch_key=batch_key, status='pending') \
+            .update({'status': 'sending', 'updated_at': now}, synchronize_session=False)
+        db.session.commit()
+        if not claimed:
+            return
+
+        payouts = Payout.query.filter_by(batch_key=batch_key).all()
+        wallet = payouts[0].wallet
+        total = sum((Decimal(payout.amount) for payout in payouts), Decimal(0))
+        attempts = max(payout.attempts for payout in payouts) + 1
+        logger.info(f"Sending {total} to {wallet} for {len(payouts)} payouts (batch {batch_key}, attempt {attempts})")
+
+        try:
+            with observe('payout'):
+                transfer_id = create_transfer(str(total), wallet, idempotency_key=batch_key)
+            update = {'status': 'sent', 'transfer_id': transfer_id, 'error': None}
+        except Exception as e:
+            logger.error(f"Payout batch {batch_key} failed: {str(e)}")
+            retry_in = min(self.interval * 2 ** attempts, 3600)
+            update = {
+                'status': 'failed' if attempts >= self.max_attempts else 'pending',
+                'error': str(e),
+                'next_attempt_at': time.time() + retry_in
+            }
+        update.update({'attempts': attempts, 'updated_at': time.time()})
+        Payout.query.filter_by(batch_key=batch_key).update(update, synchronize_session=False)
+        db.session.commit()
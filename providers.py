@@ -0,0 +1,393 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from admission import AdmissionLimit, AdmissionRejected, Ticket, DEFAULT_MAX_QUEUE, DEFAULT_QUEUE_TIMEOUT
+from http_client import make_httpx_client, make_async_httpx_client, LLM_TIMEOUT, LLM_MAX_RETRIES
+from llm_cache import make_cache_key
+from metrics import observe, record
+
+logger = logging.getLogger(__name__)
+
+# Model settings come from models_data.json. Besides name and price an entry may set:
+#   provider        "openai" (default), "anthropic" or "openai-compatible" (llama.cpp, vLLM, ... servers)
+#   model           upstream model id, defaults to the name
+#   base_url        endpoint of an OpenAI-compatible server, or base_url_env to read it from the environment
+#   api_key_env     environment variable holding the API key
+#   system_prompt   system prompt sent with every request
+#   params          generation params passed through to the API (max_tokens, temperature, ...)
+#   timeout         seconds per upstream call
+#   max_concurrency upstream calls in flight per process; up to max_queue further requests wait up to
+#                   queue_timeout seconds for a slot
+#   requests_per_minute, tokens_per_minute
+#                   rate limits; requests over them are rejected with 429
+# Limits shared by all models of a provider come from the environment, e.g. OPENAI_RPM, OPENAI_TPM,
+# ANTHROPIC_MAX_CONCURRENCY or OPENAI_COMPATIBLE_MAX_QUEUE.
+DEFAULT_API_KEY_ENV = {'openai': 'OPENAI_API_KEY', 'anthropic': 'ANTHROPIC_API_KEY',
+                       'openai-compatible': 'LOCAL_LLM_API_KEY'}
+DEFAULT_MAX_CONCURRENCY = 16
+DEFAULT_COMPLETION_TOKENS = 512
+CHARS_PER_TOKEN = 4
+CLAUDE_MAX_TOKENS = 1024  # the Messages API requires max_tokens
+
+
+class ModelSpec:
+    def __init__(self, entry):
+        self.name = entry['name']
+        self.price = entry['price']
+        self.provider = entry.get('provider', 'openai')
+        if self.provider not in PROVIDERS:
+            raise ValueError(f"Unknown provider {self.provider} for model {self.name}")
+        self.model = entry.get('model', self.name)
+        self.base_url = entry.get('base_url') or (os.getenv(entry['base_url_env']) if 'base_url_env' in entry else None)
+        self.api_key_env = entry.get('api_key_env', DEFAULT_API_KEY_ENV[self.provider])
+        self.system_prompt = entry.get('system_prompt')
+        self.params = dict(entry.get('params', {}))
+        if self.provider == 'anthropic':
+            self.params.setdefault('max_tokens', CLAUDE_MAX_TOKENS)
+        self.timeout = float(entry.get('timeout', LLM_TIMEOUT))
+        self.limit = AdmissionLimit(self.name, requests_per_minute=entry.get('requests_per_minute'),
+                                    tokens_per_minute=entry.get('tokens_per_minute'),
+                                    max_concurrency=int(entry.get('max_concurrency', DEFAULT_MAX_CONCURRENCY)),
+                                    max_queue=int(entry.get('max_queue', DEFAULT_MAX_QUEUE)),
+                                    queue_timeout=float(entry.get('queue_timeout', DEFAULT_QUEUE_TIMEOUT)))
+
+    def estimate_tokens(self, message):
+        # Rough count for the tokens/min buckets, settled against the reported usage afterwards
+        prompt = len(message) + len(self.system_prompt or '')
+        return prompt // CHARS_PER_TOKEN + self.params.get('max_tokens', DEFAULT_COMPLETION_TOKENS)
+
+    @property
+    def enabled(self):
+        # A self-hosted model only joins the arena once its server is configured
+        return self.provider != 'openai-compatible' or bool(self.base_url)
+
+
+# The SDKs are imported when the first client of their provider is made: they take longer to import than the rest
+# of the app together, and a provider without models never needs its SDK.
+class OpenAIProvider:
+    @staticmethod
+    def make_client(spec, async_client=False):
+        import openai
+
+        # Local servers usually ignore the key, but the SDK insists on one
+        api_key = os.getenv(spec.api_key_env) or ('none' if spec.base_url else None)
+        if async_client:
+            return openai.AsyncOpenAI(api_key=api_key, base_url=spec.base_url, timeout=LLM_TIMEOUT,
+                                      max_retries=LLM_MAX_RETRIES, http_client=make_async_httpx_client(LLM_TIMEOUT))
+        return openai.OpenAI(api_key=api_key, base_url=spec.base_url, timeout=LLM_TIMEOUT,
+                             max_retries=LLM_MAX_RETRIES, http_client=make_httpx_client(LLM_TIMEOUT))
+
+    @staticmethod
+    def rate_limit_error():
+        import openai
+        return openai.RateLimitError
+
+    @staticmethod
+    def request(spec, message):
+        messages = [{"role": "user", "content": message}]
+        if spec.system_prompt:
+            messages.insert(0, {"role": "system", "content": spec.system_prompt})
+        return dict(model=spec.model, messages=messages, timeout=spec.timeout, **spec.params)
+
+    @staticmethod
+    def result(completion):
+        """(text, total tokens used) of a completion."""
+        return completion.choices[0].message.content, completion.usage.total_tokens if completion.usage else None
+
+    @staticmethod
+    def complete(client, spec, message):
+        return OpenAIProvider.result(client.chat.completions.create(**OpenAIProvider.request(spec, message)))
+
+    @staticmethod
+    async def complete_async(client, spec, message):
+        return OpenAIProvider.result(await client.chat.completions.create(**OpenAIProvider.request(spec, message)))
+
+    @staticmethod
+    def delta(chunk):
+        """(text, stop_reason) of one stream chunk."""
+        if not chunk.choices:
+            return None, None
+        choice = chunk.choices[0]
+        return choice.delta.content, choice.finish_reason
+
+    @staticmethod
+    def stream(client, spec, message):
+        return client.chat.completions.create(stream=True, **OpenAIProvider.request(spec, message))
+
+    @staticmethod
+    async def stream_async(client, spec, message):
+        return await client.chat.completions.create(stream=True, **OpenAIProvider.request(spec, message))
+
+
+class AnthropicProvider:
+    @staticmethod
+    def make_client(spec, async_client=False):
+        import anthropic
+
+        api_key = os.getenv(spec.api_key_env)
+        if async_client:
+            return anthropic.AsyncAnthropic(api_key=api_key, base_url=spec.base_url, timeout=LLM_TIMEOUT,
+                                            max_retries=LLM_MAX_RETRIES,
+                                            http_client=make_async_httpx_client(LLM_TIMEOUT))
+        return anthropic.Anthropic(api_key=api_key, base_url=spec.base_url, timeout=LLM_TIMEOUT,
+                                   max_retries=LLM_MAX_RETRIES, http_client=make_httpx_client(LLM_TIMEOUT))
+
+    @staticmethod
+    def rate_limit_error():
+        import anthropic
+        return anthropic.RateLimitError
+
+    @staticmethod
+    def request(spec, message):
+        request = dict(model=spec.model, messages=[{"role": "user", "content": message}], timeout=spec.timeout,
+                       **spec.params)
+        if spec.system_prompt:
+            request['system'] = spec.system_prompt
+        return request
+
+    @staticmethod
+    def result(response):
+        text = response.content[0].text if response.content and len(response.content) > 0 else ""
+        return text, response.usage.input_tokens + response.usage.output_tokens if response.usage else None
+
+    @staticmethod
+    def complete(client, spec, message):
+        return AnthropicProvider.result(client.messages.create(**AnthropicProvider.request(spec, message)))
+
+    @staticmethod
+    async def complete_async(client, spec, message):
+        return AnthropicProvider.result(await client.messages.create(**AnthropicProvider.request(spec, message)))
+
+    @staticmethod
+    def delta(event):
+        if event.type == 'content_block_delta' and event.delta.type == 'text_delta':
+            return event.delta.text, None
+        if event.type == 'message_delta':
+            return None, event.delta.stop_reason
+        return None, None
+
+    @staticmethod
+    def stream(client, spec, message):
+        return client.messages.create(stream=True, **AnthropicProvider.request(spec, message))
+
+    @staticmethod
+    async def stream_async(client, spec, message):
+        return await client.messages.create(stream=True, **AnthropicProvider.request(spec, message))
+
+
+PROVIDERS = {'openai': OpenAIProvider, 'anthropic': AnthropicProvider, 'openai-compatible': OpenAIProvider}
+
+
+class StreamTimer:
+    """Records time to first token and total duration of a stream."""
+
+    def __init__(self, provider, model):
+        self.labels = {'provider': provider, 'model': model}
+        self.started = time.perf_counter()
+
+    def delta(self, streamed):
+        if not streamed:
+            record('llm_ttft', time.perf_counter() - self.started, **self.labels)
+
+    def finish(self):
+        record('llm_stream', time.perf_counter() - self.started, **self.labels)
+
+
+class ModelRegistry:
+    """The arena's models, with one pooled client per provider endpoint and admission limits per model and provider.
+
+    Completions and streams are dispatched by the model's configured
+    provider, so adding a model (or pointing it at another server) only
+    takes an entry in models_data.json.
+    """
+
+    def __init__(self, specs):
+        self.specs = {spec.name: spec for spec in specs}
+        self.provider_limits = {
+            provider: AdmissionLimit.from_env(provider, provider.upper().replace('-', '_'))
+            for provider in sorted({spec.provider for spec in specs})
+        }
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'r') as file:
+            specs = [ModelSpec(entry) for entry in json.load(file)]
+        for spec in specs:
+            if not spec.enabled:
+                logger.info(f"Model {spec.name} is disabled, no endpoint configured")
+        return cls(specs)
+
+    def names(self):
+        return [name for name, spec in self.specs.items() if spec.enabled]
+
+    def get(self, name):
+        spec = self.specs.get(name)
+        return spec if spec is not None and spec.enabled else None
+
+    def cache_key(self, name, message):
+        spec = self.specs[name]
+        return make_cache_key(name, message, spec.system_prompt, spec.params)
+
+    def _client(self, spec, async_client):
+        key = (spec.provider, spec.base_url, spec.api_key_env, async_client)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._clients[key] = PROVIDERS[spec.provider].make_client(spec, async_client)
+            return client
+
+    def _spec(self, name):
+        spec = self.get(name)
+        if spec is None:
+            raise ValueError(f"Invalid model: {name}")
+        return spec
+
+    def _limits(self, spec):
+        # The model's own limit first: requests queued on one busy model must not hold provider slots that the
+        # provider's other models could use meanwhile
+        return [spec.limit, self.provider_limits[spec.provider]]
+
+    def admit(self, name, message):
+        """Reserve capacity for one call to the model; raises AdmissionRejected when over a limit."""
+        spec = self._spec(name)
+        return Ticket.acquire(self._limits(spec), spec.estimate_tokens(message))
+
+    async def admit_async(self, name, message):
+        spec = self._spec(name)
+        return await Ticket.acquire_async(self._limits(spec), spec.estimate_tokens(message))
+
+    def admit_all(self, names, message):
+        """Tickets for several models at once, e.g. both contestants of a battle, or none of them."""
+        tickets = []
+        try:
+            for name in names:
+                tickets.append(self.admit(name, message))
+        except AdmissionRejected:
+            for ticket in tickets:
+                ticket.refund()
+            raise
+        return tickets
+
+    async def admit_all_async(self, names, message):
+        tickets = []
+        try:
+            for name in names:
+                tickets.append(await self.admit_async(name, message))
+        except BaseException:
+            for ticket in tickets:
+                ticket.refund()
+            raise
+        return tickets
+
+    def _rate_limited(self, spec, e):
+        # The SDK already retried; hold back the whole provider instead of hammering it further
+        retry_after = e.response.headers.get('retry-after', '')
+        retry_after = float(retry_after) if retry_after.replace('.', '', 1).isdigit() else 1.0
+        self.provider_limits[spec.provider].back_off(retry_after)
+        return AdmissionRejected(f"{spec.provider}: upstream rate limited", retry_after)
+
+    @staticmethod
+    def _stream_tokens(message, text):
+        return (len(message) + len(text)) // CHARS_PER_TOKEN
+
+    def complete(self, name, message):
+        spec = self._spec(name)
+        ticket = self.admit(name, message)
+        try:
+            with observe('llm_call', provider=spec.provider, model=name):
+                text, used = PROVIDERS[spec.provider].complete(self._client(spec, False), spec, message)
+            ticket.settle(used)
+            return text
+        except PROVIDERS[spec.provider].rate_limit_error() as e:
+            raise self._rate_limited(spec, e)
+        finally:
+            ticket.release()
+
+    async def complete_async(self, name, message):
+        spec = self._spec(name)
+        ticket = await self.admit_async(name, message)
+        try:
+            with observe('llm_call', provider=spec.provider, model=name):
+                text, used = await PROVIDERS[spec.provider].complete_async(self._client(spec, True), spec, message)
+            ticket.settle(used)
+            return text
+        except PROVIDERS[spec.provider].rate_limit_error() as e:
+            raise self._rate_limited(spec, e)
+        finally:
+            ticket.release()
+
+    def stream(self, name, message, cancellation, ticket):
+        """Yield ('delta', text) items and finally ('done', stop_reason) for a streamed answer.
+
+        `ticket` comes from admit(), called before the response starts so that
+        rejections can still be answered with 429.
+        """
+        spec = self._spec(name)
+        provider = PROVIDERS[spec.provider]
+        streamed = []
+        timer = StreamTimer(spec.provider, name)
+        try:
+            stream = provider.stream(self._client(spec, False), spec, message)
+            cancellation.register(stream.close)
+            stop_reason = None
+            for event in stream:
+                text, stop = provider.delta(event)
+                if text:
+                    timer.delta(streamed)
+                    streamed.append(text)
+                    yield 'delta', text
+                stop_reason = stop or stop_reason
+        except provider.rate_limit_error() as e:
+            raise self._rate_limited(spec, e)
+        finally:
+            timer.finish()
+            ticket.settle(self._stream_tokens(message, ''.join(streamed)))
+            ticket.release()
+        yield 'done', stop_reason
+
+    async def stream_async(self, name, message, ticket):
+        spec = self._spec(name)
+        provider = PROVIDERS[spec.provider]
+        streamed = []
+        timer = StreamTimer(spec.provider, name)
+        try:
+            stream = await provider.stream_async(self._client(spec, True), spec, message)
+            stop_reason = None
+            try:
+                async for event in stream:
+                    text, stop = provider.delta(event)
+                    if text:
+                        timer.delta(streamed)
+                        streamed.append(text)
+                        yield 'delta', text
+                    stop_reason = stop or stop_reason
+            finally:
+                # Also runs when the client disconnects, so the provider stops generating
+                await stream.close()
+        except provider.rate_limit_error() as e:
+            raise self._rate_limited(spec, e)
+        finally:
+            timer.finish()
+            ticket.settle(self._stream_tokens(message, ''.join(streamed)))
+            ticket.release()
+        yield 'done', stop_reason
+
+    def stats(self):
+        return {
+            'providers': {provider: limit.stats() for provider, limit in self.provider_limits.items()},
+            'models': {name: spec.limit.stats() for name, spec in self.specs.items() if spec.enabled},
+        }
+
+    async def aclose(self):
+        with self._lock:
+            clients, self._clients = list(self._clients.items()), {}
+        for key, client in clients:
+            if key[-1]:
+                await client.close()
+            else:
+                client.close()
@@ -0,0 +1,167 @@
+import threading
+import time
+from array import array
+from collections import namedtuple
+
+from models import SCORE_MODELS
+
+K = 32  # Elo constant
+
+# A vote applied to the ratings and what it changed, until a checkpoint writes it
+AppliedVote = namedtuple('AppliedVote', ['vote', 'score_change_a', 'score_change_b'])
+
+
+def elo_update(rating_a, rating_b, actual_a, k=K):
+    """Return the new ratings of A and B after a game A scored `actual_a` (1, 0 or 0.5) in.
+
+    As the live leaderboard always has, B's expectation is taken against
+    A's already updated rating; ratings.py replays votes without this quirk.
+    """
+    new_a = rating_a + k * (actual_a - 1 / (1 + 10 ** ((rating_b - rating_a) / 400)))
+    new_b = rating_b + k * ((1 - actual_a) - 1 / (1 + 10 ** ((new_a - rating_b) / 400)))
+    return new_a, new_b
+
+
+class RatingTable:
+    """Ratings of one kind of contestant in flat arrays, indexed through `index`.
+
+    `pending_score` and `pending_votes` hold the changes made in this
+    process since the last checkpoint; the database holds everything else.
+    """
+
+    def __init__(self, rows):
+        self.names = [name for name, _, _, _ in rows]
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.score = array('d', [score for _, score, _, _ in rows])
+        self.price = array('d', [price for _, _, price, _ in rows])
+        self.votes = array('q', [votes for _, _, _, votes in rows])
+        self.pending_score = array('d', bytes(8 * len(rows)))
+        self.pending_votes = array('q', bytes(8 * len(rows)))
+        self.loaded_at = time.monotonic()
+
+
+class RatingStore:
+    """The leaderboards' ratings, held in memory and checkpointed to the score tables.
+
+    Votes update the in-memory ratings at once, under a lock and without
+    touching the database, and are remembered until the next checkpoint:
+    `take_pending()` hands the buffered votes and the per-contestant rating
+    and vote-count changes to the writer, which adds the changes to the
+    score rows and marks the votes applied in the log. As the rows are incremented
+    rather than overwritten, several processes can share the tables. Each
+    table is reloaded from the database, with the still pending changes
+    reapplied, after a checkpoint or once it is older than `max_age`
+    seconds when read, which picks up other processes' votes; on restart the
+    tables are simply loaded again.
+    """
+
+    def __init__(self, app, max_age=5.0):
+        self.app = app
+        self.max_age = max_age
+        self._tables = {}
+        self._pending = []
+        self._lock = threading.Lock()
+        # Bumped when a checkpoint starts and ends; a reload that overlapped one is not installed
+        self._generation = 0
+        self._checkpointing = False
+
+    def knows(self, kind, contestant_a, contestant_b):
+        table = self._table(kind)
+        return contestant_a in table.index and contestant_b in table.index
+
+    def apply(self, vote):
+        """Apply a logged PendingVote to the ratings; returns False if a contestant is not on the leaderboard."""
+        if vote.kind not in self._tables:
+            self.reload(vote.kind)
+        with self._lock:
+            # Looked up under the lock, so a vote never lands in a table a reload just replaced
+            table = self._tables[vote.kind]
+            a = table.index.get(vote.contestant_a)
+            b = table.index.get(vote.contestant_b)
+            if a is None or b is None:
+                return False
+            if a == b:
+                # A contestant against itself nets to no change; the vote is only marked applied
+                self._pending.append(AppliedVote(vote, 0.0, 0.0))
+                return True
+            actual_a = 1.0 if vote.result == vote.contestant_a else 0.0 if vote.result == vote.contestant_b else 0.5
+            old_a, old_b = table.score[a], table.score[b]
+            table.score[a], table.score[b] = elo_update(old_a, old_b, actual_a)
+            change_a, change_b = table.score[a] - old_a, table.score[b] - old_b
+            table.pending_score[a] += change_a
+            table.pending_score[b] += change_b
+            table.votes[a] += 1
+            table.votes[b] += 1
+            table.pending_votes[a] += 1
+            table.pending_votes[b] += 1
+            self._pending.append(AppliedVote(vote, change_a, change_b))
+        return True
+
+    def pending(self):
+        return len(self._pending)
+
+    def take_pending(self):
+        """Start a checkpoint: return the pending AppliedVotes and {kind: [(name, score change, vote change)]}."""
+        with self._lock:
+            self._checkpointing = True
+            self._generation += 1
+            votes, self._pending = self._pending, []
+            changes = {}
+            for kind, table in self._tables.items():
+                changes[kind] = [(name, table.pending_score[i], table.pending_votes[i])
+                                 for i, name in enumerate(table.names) if table.pending_votes[i]]
+                for i in range(len(table.names)):
+                    table.pending_score[i] = 0.0
+                    table.pending_votes[i] = 0
+        return votes, changes
+
+    def finish_checkpoint(self, votes, changes, written):
+        """End the checkpoint started by take_pending(); if it wasn't written, the next one writes its votes."""
+        with self._lock:
+            if not written:
+                self._pending[:0] = votes
+                for kind, rows in changes.items():
+                    table = self._tables[kind]
+                    for name, score_change, vote_change in rows:
+                        i = table.index.get(name)
+                        if i is not None:
+                            table.pending_score[i] += score_change
+                            table.pending_votes[i] += vote_change
+            self._checkpointing = False
+            self._generation += 1
+
+    def rows(self, kind):
+        """(name, score, price, votes) of every contestant, in no particular order."""
+        table = self._table(kind)
+        with self._lock:
+            return list(zip(table.names, table.score, table.price, table.votes))
+
+    def reload(self, kind):
+        with self._lock:
+            generation = self._generation
+        score_model = SCORE_MODELS[kind]
+        with self.app.app_context():
+            rows = score_model.query.with_entities(score_model.name, score_model.score, score_model.price,
+                                                   score_model.votes).order_by(score_model.id).all()
+        fresh = RatingTable(rows)
+        with self._lock:
+            current = self._tables.get(kind)
+            if current is not None and generation != self._generation:
+                return current
+            if current is not None:
+                # Changes not yet checkpointed stay on top of the stored ratings
+                for i, name in enumerate(current.names):
+                    j = fresh.index.get(name)
+                    if j is not None and current.pending_votes[i]:
+                        fresh.score[j] += current.pending_score[i]
+                        fresh.votes[j] += current.pending_votes[i]
+                        fresh.pending_score[j] = current.pending_score[i]
+                        fresh.pending_votes[j] = current.pending_votes[i]
+            self._tables[kind] = fresh
+        return fresh
+
+    def _table(self, kind):
+        table = self._tables.get(kind)
+        if table is None or (time.monotonic() - table.loaded_at >= self.max_age and not self._checkpointing):
+            table = self.reload(kind)
+        return table
@@ -0,0 +1,230 @@
+"""Offline rating engine: recompute the leaderboards from the full vote log.
+
+Replays Elo over all recorded votes for several K values at once and fits a
+Bradley-Terry model with bootstrap confidence intervals, then stores the
+results as a new rating snapshot. Run it next to the app, e.g.:
+
+    python ratings.py --kind model --k 4 16 32 64 --bootstrap 1000
+"""
+import argparse
+import logging
+import math
+import time
+import uuid
+
+import numpy as np
+from flask import Flask
+
+from models import db, Vote, RatingSnapshot, configure_database
+
+logger = logging.getLogger(__name__)
+
+INITIAL_RATING = 1200
+SCALE = 400  # Elo points per factor of 10 in odds, as in rating_store.elo_update
+LN10_OVER_SCALE = math.log(10) / SCALE
+VECTORIZE_ABOVE_K = 12
+
+
+def load_votes(kind):
+    """Return contestant names and the vote log as index/outcome arrays, in vote order.
+
+    `outcome` is 1 when contestant A won, 0 when B won and 0.5 for a draw.
+    """
+    statement = db.select(Vote.contestant_a, Vote.contestant_b, Vote.result) \
+        .where(Vote.kind == kind).order_by(Vote.id)
+    connection = db.session.connection()
+    # Fetch plain tuples from the DBAPI cursor; building ORM rows dominates the load time for millions of votes
+    cursor = connection.connection.cursor()
+    cursor.execute(str(statement.compile(connection, compile_kwargs={'literal_binds': True})))
+    rows = cursor.fetchall()
+    cursor.close()
+    if not rows:
+        empty = np.zeros(0, dtype=np.int64)
+        return [], empty, empty, np.zeros(0)
+
+    index = {}
+    idx_a = np.fromiter((index.setdefault(name, len(index)) for name, _, _ in rows), np.int64, len(rows))
+    idx_b = np.fromiter((index.setdefault(name, len(index)) for _, name, _ in rows), np.int64, len(rows))
+    outcome = np.fromiter((1.0 if result == a else 0.0 if result == b else 0.5 for a, b, result in rows),
+                          float, len(rows))
+    return list(index), idx_a, idx_b, outcome
+
+
+def replay_elo(idx_a, idx_b, outcome, n, k_values):
+    """Replay the vote log with standard Elo for every K in `k_values`.
+
+    Returns an (n, len(k_values)) array of final ratings. Unlike the live
+    update, both sides are updated from the pre-vote ratings. Elo is
+    sequential in the votes, so only the K dimension can be vectorized; numpy
+    call overhead makes that pay off only beyond about a dozen K values, below
+    that each K is replayed with plain floats.
+    """
+    k_values = [float(k) for k in k_values]
+    if len(k_values) > VECTORIZE_ABOVE_K:
+        return _replay_elo_vectorized(idx_a, idx_b, outcome, n, k_values)
+
+    votes = list(zip(idx_a.tolist(), idx_b.tolist(), outcome.tolist()))
+    columns = []
+    exp = math.exp
+    for k in k_values:
+        ratings = [float(INITIAL_RATING)] * n
+        for a, b, actual in votes:
+            delta = k * (actual - 1 / (1 + exp((ratings[b] - ratings[a]) * LN10_OVER_SCALE)))
+            ratings[a] += delta
+            ratings[b] -= delta
+        columns.append(ratings)
+    return np.array(columns).T
+
+
+def _replay_elo_vectorized(idx_a, idx_b, outcome, n, k_values):
+    k = np.asarray(k_values)
+    k_times_outcome = {actual: k * actual for actual in (0.0, 0.5, 1.0)}
+    ratings = np.full((n, len(k)), float(INITIAL_RATING))
+    delta = np.empty(len(k))
+    for a, b, actual in zip(idx_a.tolist(), idx_b.tolist(), outcome.tolist()):
+        row_a = ratings[a]
+        row_b = ratings[b]
+        # delta = k * (actual - expected_a), computed in place to keep the per-vote overhead down
+        np.subtract(row_b, row_a, out=delta)
+        delta *= LN10_OVER_SCALE
+        np.exp(delta, out=delta)
+        delta += 1
+        np.divide(k, delta, out=delta)
+        np.subtract(k_times_outcome[actual], delta, out=delta)
+        row_a += delta
+        row_b -= delta
+    return ratings
+
+
+def win_matrix(idx_a, idx_b, outcome, n, counts=None):
+    """wins[i, j] = number of times i beat j, draws counting half for each side."""
+    weights = np.ones(len(idx_a)) if counts is None else counts
+    wins = np.bincount(idx_a * n + idx_b, weights=weights * outcome, minlength=n * n)
+    wins += np.bincount(idx_b * n + idx_a, weights=weights * (1 - outcome), minlength=n * n)
+    return wins.reshape(n, n)
+
+
+def fit_bradley_terry(wins, prior=0.5, max_iterations=2000, tolerance=1e-9):
+    """Maximum-likelihood Bradley-Terry ratings on the Elo scale, via MM iterations.
+
+    `wins` may carry leading batch dimensions (..., n, n); all fits run
+    together. `prior` adds that many virtual wins for every pair so that
+    unbeaten or winless contestants keep finite ratings.
+    """
+    n = wins.shape[-1]
+    wins = wins + prior * (1 - np.eye(n))
+    games = wins + np.swapaxes(wins, -1, -2)
+    total_wins = wins.sum(axis=-1)
+    strength = np.ones(wins.shape[:-1])
+    for _ in range(max_iterations):
+        denominator = (games / (strength[..., :, None] + strength[..., None, :])).sum(axis=-1)
+        updated = total_wins / denominator
+        updated /= np.exp(np.log(updated).mean(axis=-1, keepdims=True))
+        converged = np.max(np.abs(updated - strength)) < tolerance
+        strength = updated
+        if converged:
+            break
+    return INITIAL_RATING + SCALE * np.log10(strength)
+
+
+def bootstrap_bradley_terry(idx_a, idx_b, outcome, n, rounds, seed=None, chunk_size=100):
+    """Bradley-Terry fits on `rounds` resamples of the vote log.
+
+    Votes are collapsed into (pair, outcome) cells first, so each resample is
+    a multinomial draw over cells and costs the same for a thousand votes as
+    for millions.
+    """
+    rng = np.random.default_rng(seed)
+    cells, counts = np.unique(np.stack([idx_a, idx_b, outcome * 2]), axis=1, return_counts=True)
+    cell_a, cell_b, cell_outcome = cells[0].astype(np.int64), cells[1].astype(np.int64), cells[2] / 2
+    total = counts.sum()
+    samples = []
+    for start in range(0, rounds, chunk_size):
+        draws = rng.multinomial(total, counts / total, size=min(chunk_size, rounds - start))
+        wins = np.stack([win_matrix(cell_a, cell_b, cell_outcome, n, draw) for draw in draws])
+        samples.append(fit_bradley_terry(wins))
+    return np.concatenate(samples)
+
+
+def compute_ratings(kind, k_values, bootstrap_rounds, seed=None):
+    started = time.perf_counter()
+    names, idx_a, idx_b, outcome = load_votes(kind)
+    n = len(names)
+    logger.info(f"Loaded {len(outcome)} {kind} votes for {n} contestants in {time.perf_counter() - started:.2f}s")
+    if not n:
+        return names, {}, np.zeros(0)
+
+    started = time.perf_counter()
+    elo = replay_elo(idx_a, idx_b, outcome, n, k_values)
+    logger.info(f"Replayed Elo for K={list(k_values)} in {time.perf_counter() - started:.2f}s")
+
+    started = time.perf_counter()
+    results = {f'elo_k{k:g}': (elo[:, i], None, None) for i, k in enumerate(k_values)}
+    bt = fit_bradley_terry(win_matrix(idx_a, idx_b, outcome, n))
+    ci_low = ci_high = None
+    if bootstrap_rounds:
+        samples = bootstrap_bradley_terry(idx_a, idx_b, outcome, n, bootstrap_rounds, seed)
+        ci_low, ci_high = np.percentile(samples, [2.5, 97.5], axis=0)
+    results['bt'] = (bt, ci_low, ci_high)
+    logger.info(f"Fitted Bradley-Terry with {bootstrap_rounds} bootstrap rounds in "
+                f"{time.perf_counter() - started:.2f}s")
+
+    vote_counts = np.bincount(idx_a, minlength=n) + np.bincount(idx_b, minlength=n)
+    return names, results, vote_counts
+
+
+def save_snapshot(kind, names, results, vote_counts):
+    snapshot_id = str(uuid.uuid4())
+    created_at = time.time()
+    db.session.add_all([
+        RatingSnapshot(snapshot_id=snapshot_id, kind=kind, method=method, name=name, rating=float(ratings[i]),
+                       ci_low=None if ci_low is None else float(ci_low[i]),
+                       ci_high=None if ci_high is None else float(ci_high[i]),
+                       votes=int(vote_counts[i]), created_at=created_at)
+        for method, (ratings, ci_low, ci_high) in results.items()
+        for i, name in enumerate(names)
+    ])
+    db.session.commit()
+    return snapshot_id
+
+
+def print_leaderboard(names, results, vote_counts):
+    ratings, ci_low, ci_high = results['bt']
+    elo_methods = [method for method in results if method != 'bt']
+    header = f"{'rank':>4}  {'name':<30} {'votes':>8} {'bt':>8} {'95% ci':>17}" + \
+             ''.join(f" {method:>9}" for method in elo_methods)
+    print(header)
+    for rank, i in enumerate(np.argsort(-ratings), start=1):
+        ci = f"{ci_low[i]:.0f}..{ci_high[i]:.0f}" if ci_low is not None else '-'
+        row = f"{rank:>4}  {names[i]:<30} {vote_counts[i]:>8} {ratings[i]:>8.1f} {ci:>17}"
+        row += ''.join(f" {results[method][0][i]:>9.1f}" for method in elo_methods)
+        print(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recompute ratings from the vote log')
+    parser.add_argument('--kind', choices=['model', 'agent'], default='model')
+    parser.add_argument('--k', type=float, nargs='+', default=[4, 8, 16, 32, 64], help='Elo K values to replay')
+    parser.add_argument('--bootstrap', type=int, default=1000, help='Bootstrap rounds for confidence intervals')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--dry-run', action='store_true', help='Print the leaderboard without saving a snapshot')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    app = Flask(__name__)
+    configure_database(app)
+
+    with app.app_context():
+        db.create_all()
+        names, results, vote_counts = compute_ratings(args.kind, args.k, args.bootstrap, args.seed)
+        if not names:
+            print(f"No {args.kind} votes recorded yet")
+            return
+        print_leaderboard(names, results, vote_counts)
+        if not args.dry_run:
+            snapshot_id = save_snapshot(args.kind, names, results, vote_counts)
+            print(f"Saved snapshot {snapshot_id}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import logging
+import os
+import time
+
+from http_client import get_breaker
+
+logger = logging.getLogger(__name__)
+
+# Seconds a readiness probe may spend on one dependency
+READY_TIMEOUT = float(os.getenv('READY_TIMEOUT', '2'))
+
+
+class Check:
+    """One dependency of the readiness report.
+
+    `probe()` raises if the dependency is unusable and may return a dict of
+    details. Only failing `required` checks make the process unready; the
+    others are reported so a degraded upstream shows up without taking every
+    replica out of rotation.
+    """
+
+    def __init__(self, name, probe, required=False):
+        self.name = name
+        self.probe = probe
+        self.required = required
+
+    def run(self):
+        started = time.perf_counter()
+        try:
+            result = {'status': 'ok', **(self.probe() or {})}
+        except Exception as e:
+            result = {'status': 'error', 'error': str(e)}
+        result['required'] = self.required
+        result['seconds'] = round(time.perf_counter() - started, 4)
+        return result
+
+
+def run_checks(checks):
+    """Return (ready, {name: result}) for `checks`."""
+    results = {check.name: check.run() for check in checks}
+    ready = all(results[check.name]['status'] == 'ok' for check in checks if check.required)
+    failed = [name for name, result in results.items() if result['status'] != 'ok']
+    if failed:
+        logger.warning(f"Readiness checks failing: {', '.join(failed)}")
+    return ready, results
+
+
+def configured(*env_vars):
+    missing = [name for name in env_vars if not os.getenv(name)]
+    if missing:
+        raise RuntimeError(f"not configured, set {', '.join(missing)}")
+
+
+def circuit_closed(url):
+    """Fail while the circuit breaker for `url`'s host is open, i.e. recent calls to it kept failing."""
+    state = get_breaker(url).state
+    if state == 'open':
+        raise RuntimeError("circuit open after repeated failures")
+    return {'circuit': state}
@@ -0,0 +1,199 @@
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from contracts import RPCError
+from metrics import current_trace, record
+
+logger = logging.getLogger(__name__)
+
+
+class ContractResponseTimeout(Exception):
+    pass
+
+
+class ContractTransactionFailed(Exception):
+    pass
+
+
+class PendingRequest:
+    def __init__(self, request_id, contract_address, tx_hash, deadline, agent=None):
+        self.request_id = request_id
+        self.contract_address = contract_address
+        self.tx_hash = tx_hash
+        self.deadline = deadline
+        self.agent = agent
+        self.trace = current_trace()
+        self.registered_at = time.monotonic()
+        self.mined_at = None
+        self.mined = False
+        self.mined_block = None
+        self.prompt = None  # (oracle address, prompt id) the oracle answers
+        self.future = Future()
+
+
+class ResponseWatcher:
+    """Resolves outstanding contract requests as soon as their response lands.
+
+    The LLM contracts don't emit events and expose a single response() slot,
+    but the oracle contract each of them calls logs an OpenAiPromptAdded
+    event with a prompt id in the request's receipt, and its operator answers
+    with an addOpenAiResponse transaction for that prompt id. A single
+    background thread therefore checks, once per tick, the receipt of every
+    unmined request and then every block mined since the last tick for answer
+    transactions, each as one batch request to the node. An answer resolves
+    the request with its oracle and prompt id, whatever the order requests
+    are answered in.
+    """
+
+    def __init__(self, contracts, poll_interval=1.0, timeout=120.0, tx_hash_resolver=None, tx_hash_done=None,
+                 max_blocks=64):
+        self.contracts = contracts
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        # Blocks scanned per tick at most, so a long stall is caught up on over several ticks
+        self.max_blocks = max_blocks
+        # Maps a submitted tx hash to it and the hashes of the transactions that replaced it, if any
+        self.tx_hash_resolver = tx_hash_resolver or (lambda tx_hash: [tx_hash])
+        # Called with a submitted tx hash once it no longer needs resolving: mined, reverted or timed out
+        self.tx_hash_done = tx_hash_done or (lambda tx_hash: None)
+        self._pending = {}  # request id -> PendingRequest
+        self._prompts = {}  # (oracle address, prompt id) -> PendingRequest, once mined
+        self._next_block = None  # first block not yet scanned for answers
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def watch(self, contract_address, tx_hash, timeout=None, agent=None):
+        """Register a sent transaction and return a Future for its response; `agent` labels its timings."""
+        deadline = time.monotonic() + (timeout if timeout is not None else self.timeout)
+        with self._lock:
+            pending = PendingRequest(next(self._ids), contract_address, tx_hash, deadline, agent)
+            self._pending[pending.request_id] = pending
+            self._ensure_started()
+        logger.info(f"Watching request {pending.request_id} on {contract_address}, tx hash: {tx_hash.hex()}")
+        self._wakeup.set()
+        return pending.future
+
+    def wait(self, contract_address, tx_hash, timeout=None, agent=None):
+        return self.watch(contract_address, tx_hash, timeout, agent).result()
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='response-watcher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                idle = not self._pending
+            # Sleep until a request is registered when there is nothing to watch
+            self._wakeup.wait(None if idle else self.poll_interval)
+            self._wakeup.clear()
+            try:
+                self._tick()
+            except Exception as e:
+                logger.error(f"Error while polling contract responses: {str(e)}")
+
+    def _tick(self):
+        with self._lock:
+            snapshot = list(self._pending.values())
+            if not snapshot:
+                # Nothing is waiting, so the blocks until the next request is mined need no scanning
+                self._next_block = None
+                return
+
+        # The head is read before the receipts, so a transaction mined after it can't be answered in the blocks
+        # scanned this tick
+        head = self.contracts.block_number()
+        unmined = [pending for pending in snapshot if not pending.mined]
+        tx_hashes = [self.tx_hash_resolver(pending.tx_hash) for pending in unmined]
+        receipts = self.contracts.get_receipts(list({tx_hash for sent in tx_hashes for tx_hash in sent}))
+        for pending, sent in zip(unmined, tx_hashes):
+            self._check_receipt(pending, self._first_receipt([receipts[tx_hash] for tx_hash in sent]))
+
+        mined = [pending.mined_block for pending in snapshot if pending.mined]
+        if mined:
+            self._scan(max(min(mined), self._next_block or 0), head)
+
+        self._expire()
+
+    def _scan(self, first, head):
+        numbers = list(range(first, min(head, first + self.max_blocks - 1) + 1))
+        blocks = self.contracts.get_answers(numbers)
+        answers = [answer for number in numbers if not isinstance(blocks[number], RPCError)
+                   for answer in blocks[number]]
+        # Only whitelisted operators can answer, and each prompt once; a reverted answer must not resolve a request
+        receipts = self.contracts.get_receipts([answer.tx_hash for answer in answers])
+        for number in numbers:
+            if isinstance(blocks[number], RPCError):
+                logger.error(f"Error fetching block {number}: {str(blocks[number])}")
+                return
+            for answer in blocks[number]:
+                receipt = receipts[answer.tx_hash]
+                if receipt is None or isinstance(receipt, RPCError):
+                    logger.error(f"Error fetching receipt of answer {answer.tx_hash.hex()}: {str(receipt)}")
+                    return
+            for answer in blocks[number]:
+                if receipts[answer.tx_hash]['status'] == 1:
+                    self._resolve(answer)
+            self._next_block = number + 1
+
+    @staticmethod
+    def _first_receipt(receipts):
+        # Only one transaction per nonce is ever mined; an error only counts while none of them is found mined
+        mined = [receipt for receipt in receipts if receipt is not None and not isinstance(receipt, RPCError)]
+        return mined[0] if mined else next((receipt for receipt in receipts if receipt is not None), None)
+
+    def _check_receipt(self, pending, receipt):
+        if receipt is None:
+            return
+        if isinstance(receipt, RPCError):
+            logger.error(f"Error fetching receipt of {pending.tx_hash.hex()}: {str(receipt)}")
+            return
+        if receipt['status'] == 0:
+            self._fail(pending, ContractTransactionFailed(f"Transaction {pending.tx_hash.hex()} reverted"))
+            return
+        prompt = self.contracts.oracle_prompt(receipt)
+        if prompt is None:
+            self._fail(pending, ContractTransactionFailed(f"Transaction {pending.tx_hash.hex()} asked no oracle"))
+            return
+        pending.mined = True
+        pending.mined_at = time.monotonic()
+        pending.mined_block = receipt['blockNumber']
+        pending.prompt = prompt
+        with self._lock:
+            self._prompts[prompt] = pending
+        self.tx_hash_done(pending.tx_hash)
+        record('receipt_wait', pending.mined_at - pending.registered_at, trace=pending.trace, agent=pending.agent)
+
+    def _resolve(self, answer):
+        with self._lock:
+            pending = self._prompts.pop((answer.oracle, answer.prompt_id), None)
+            if pending is None:
+                # An answer to a request sent by someone else, or to one of ours that already timed out
+                return
+            del self._pending[pending.request_id]
+        logger.info(f"Request {pending.request_id} on {pending.contract_address} resolved by {answer.tx_hash.hex()}")
+        record('response_poll', time.monotonic() - pending.mined_at, trace=pending.trace, agent=pending.agent)
+        pending.future.set_result(answer.response)
+
+    def _expire(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [pending for pending in self._pending.values() if pending.deadline <= now]
+        for pending in expired:
+            self._fail(pending, ContractResponseTimeout(
+                f"No response from {pending.contract_address} for request {pending.request_id}"))
+
+    def _fail(self, pending, error):
+        with self._lock:
+            if self._pending.pop(pending.request_id, None) is None:
+                return
+            self._prompts.pop(pending.prompt, None)
+        self.tx_hash_done(pending.tx_hash)
+        logger.error(str(error))
+        pending.future.set_exception(error)
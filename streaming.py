@@ -0,0 +1,315 @@
+import asyncio
+import contextvars
+import json
+import logging
+import queue
+import threading
+import time
+
+from llm_cache import split_for_replay
+
+logger = logging.getLogger(__name__)
+
+# Server-sent events shared by every streaming endpoint and provider:
+#   event: delta  data: {"model": ..., "text": ...}
+#   event: done   data: {"model": ..., "stop_reason": ...}
+#   event: error  data: {"model": ..., "error": ...}
+# Battle streams add "contestant": "A" or "B" to every payload. Comment lines keep idle connections alive.
+STREAM_MIN_CHARS = 32
+STREAM_FLUSH_INTERVAL = 0.05
+STREAM_HEARTBEAT_INTERVAL = 15.0
+HEARTBEAT = ': keep-alive\n\n'
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def replay_deltas(text, chunk_size=256):
+    for chunk in split_for_replay(text, chunk_size):
+        yield 'delta', chunk
+    yield 'done', 'cached'
+
+
+async def replay_deltas_async(text, chunk_size=256):
+    for item in replay_deltas(text, chunk_size):
+        yield item
+
+
+class StreamSource:
+    """One upstream answer in a stream.
+
+    `deltas` is a callable returning an iterator (or async iterator) of
+    ('delta', text) items ending with ('done', stop_reason). The sync variant
+    receives a Cancellation to register the upstream stream's close() with.
+    `on_complete` gets the full text of an answer that finished without error.
+    `ticket` is the admission the deltas release when done; the stream
+    releases it too when closed, in case the deltas never ran.
+    """
+
+    def __init__(self, model, deltas, contestant=None, on_complete=None, ticket=None):
+        self.model = model
+        self.deltas = deltas
+        self.contestant = contestant
+        self.on_complete = on_complete
+        self.ticket = ticket
+
+
+def release_tickets(sources):
+    # Releasing is idempotent, so tickets the deltas already settled and released are left alone; a stream closed
+    # early keeps the estimate it was admitted with
+    for source in sources:
+        if source.ticket:
+            source.ticket.release()
+
+
+class SSEStream:
+    """The frames of stream_sse. Closing it also releases the sources' tickets,
+    even if the response is closed before its first frame."""
+
+    def __init__(self, frames, sources):
+        self._frames = frames
+        self.sources = sources
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._frames)
+
+    def close(self):
+        try:
+            self._frames.close()
+        finally:
+            release_tickets(self.sources)
+
+
+class AsyncSSEStream:
+    """Async counterpart of SSEStream, for stream_sse_async."""
+
+    def __init__(self, frames, sources):
+        self._frames = frames
+        self.sources = sources
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._frames.__anext__()
+
+    async def aclose(self):
+        try:
+            await self._frames.aclose()
+        finally:
+            release_tickets(self.sources)
+
+
+class Cancellation:
+    def __init__(self):
+        self._cancelled = False
+        self._closers = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def register(self, closer):
+        with self._lock:
+            if not self._cancelled:
+                self._closers.append(closer)
+                return
+        closer()
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            closers, self._closers = self._closers, []
+        for closer in closers:
+            try:
+                closer()
+            except Exception as e:
+                logger.warning(f"Error closing upstream stream: {str(e)}")
+
+
+class FrameBuilder:
+    """Turns upstream items into SSE frames, coalescing small deltas.
+
+    Deltas of a source are buffered until `min_chars` characters are waiting
+    or the oldest buffered delta is `flush_interval` seconds old.
+    """
+
+    def __init__(self, sources, min_chars=STREAM_MIN_CHARS, flush_interval=STREAM_FLUSH_INTERVAL):
+        self.sources = sources
+        self.min_chars = min_chars
+        self.flush_interval = flush_interval
+        self.active = len(sources)
+        self._buffers = [[] for _ in sources]
+        self._buffered = [0] * len(sources)
+        self._first_at = [None] * len(sources)
+        self._texts = [[] for _ in sources]
+
+    def _payload(self, index, **fields):
+        source = self.sources[index]
+        payload = {'model': source.model}
+        if source.contestant:
+            payload['contestant'] = source.contestant
+        payload.update(fields)
+        return payload
+
+    def _flush(self, index):
+        if not self._buffers[index]:
+            return []
+        text = ''.join(self._buffers[index])
+        self._buffers[index] = []
+        self._buffered[index] = 0
+        self._first_at[index] = None
+        return [sse_event('delta', self._payload(index, text=text))]
+
+    def handle(self, index, kind, value, now):
+        if kind == 'delta':
+            if not value:
+                return []
+            self._buffers[index].append(value)
+            self._texts[index].append(value)
+            self._buffered[index] += len(value)
+            if self._first_at[index] is None:
+                self._first_at[index] = now
+            return self._flush(index) if self._buffered[index] >= self.min_chars else []
+
+        frames = self._flush(index)
+        self.active -= 1
+        source = self.sources[index]
+        if kind == 'error':
+            frames.append(sse_event('error', self._payload(index, error=value)))
+            return frames
+        frames.append(sse_event('done', self._payload(index, stop_reason=value)))
+        if source.on_complete and self._texts[index]:
+            try:
+                source.on_complete(''.join(self._texts[index]))
+            except Exception as e:
+                logger.error(f"Error in stream completion hook: {str(e)}")
+        return frames
+
+    def flush_due(self, now):
+        frames = []
+        for index, first_at in enumerate(self._first_at):
+            if first_at is not None and now - first_at >= self.flush_interval:
+                frames.extend(self._flush(index))
+        return frames
+
+    def next_flush_at(self):
+        pending = [first_at for first_at in self._first_at if first_at is not None]
+        return min(pending) + self.flush_interval if pending else None
+
+
+def _produce(index, source, cancellation, items):
+    try:
+        for kind, value in source.deltas(cancellation):
+            if cancellation.cancelled:
+                return
+            items.put((index, kind, value))
+            if kind in ('done', 'error'):
+                return
+        items.put((index, 'done', None))
+    except Exception as e:
+        if not cancellation.cancelled:
+            logger.error(f"Error while streaming from {source.model}: {str(e)}")
+            items.put((index, 'error', str(e)))
+
+
+def stream_sse(sources, first=(), min_chars=STREAM_MIN_CHARS, flush_interval=STREAM_FLUSH_INTERVAL,
+               heartbeat_interval=STREAM_HEARTBEAT_INTERVAL):
+    """SSEStream of SSE frames for one or more concurrently streamed sources, after the frames in `first`.
+
+    Upstream streams are read on their own threads. If the client goes away
+    the WSGI server closes the stream, which closes the upstream streams so
+    the providers stop generating.
+    """
+    return SSEStream(_sse_frames(sources, first, min_chars, flush_interval, heartbeat_interval), sources)
+
+
+def _sse_frames(sources, first, min_chars, flush_interval, heartbeat_interval):
+    yield from first
+    builder = FrameBuilder(sources, min_chars, flush_interval)
+    cancellation = Cancellation()
+    items = queue.Queue()
+    for index, source in enumerate(sources):
+        # Run producers in a copy of the request's context so their timings join its trace
+        threading.Thread(target=contextvars.copy_context().run, args=(_produce, index, source, cancellation, items),
+                         name=f'stream-{source.model}', daemon=True).start()
+
+    started = time.monotonic()
+    next_heartbeat = started + heartbeat_interval
+    try:
+        while builder.active:
+            deadline = min(filter(None, [next_heartbeat, builder.next_flush_at()]))
+            try:
+                item = items.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                item = None
+            now = time.monotonic()
+            frames = builder.handle(*item, now) if item else []
+            frames.extend(builder.flush_due(now))
+            if frames:
+                next_heartbeat = now + heartbeat_interval
+                yield ''.join(frames)
+            elif now >= next_heartbeat:
+                next_heartbeat = now + heartbeat_interval
+                yield HEARTBEAT
+        logger.info(f"Finished streaming {', '.join(source.model for source in sources)} "
+                    f"in {time.monotonic() - started:.2f}s")
+    finally:
+        if builder.active:
+            logger.info("Client disconnected, cancelling upstream streams")
+        cancellation.cancel()
+
+
+async def _produce_async(index, source, items):
+    try:
+        async for kind, value in source.deltas():
+            await items.put((index, kind, value))
+            if kind in ('done', 'error'):
+                return
+        await items.put((index, 'done', None))
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Error while streaming from {source.model}: {str(e)}")
+        await items.put((index, 'error', str(e)))
+
+
+def stream_sse_async(sources, first=(), min_chars=STREAM_MIN_CHARS, flush_interval=STREAM_FLUSH_INTERVAL,
+                     heartbeat_interval=STREAM_HEARTBEAT_INTERVAL):
+    """Async counterpart of stream_sse. On client disconnect the server cancels
+    the stream, which cancels the producer tasks and their upstream reads."""
+    return AsyncSSEStream(_sse_frames_async(sources, first, min_chars, flush_interval, heartbeat_interval), sources)
+
+
+async def _sse_frames_async(sources, first, min_chars, flush_interval, heartbeat_interval):
+    for frame in first:
+        yield frame
+    builder = FrameBuilder(sources, min_chars, flush_interval)
+    items = asyncio.Queue()
+    producers = [asyncio.create_task(_produce_async(index, source, items)) for index, source in enumerate(sources)]
+
+    next_heartbeat = time.monotonic() + heartbeat_interval
+    try:
+        while builder.active:
+            deadline = min(filter(None, [next_heartbeat, builder.next_flush_at()]))
+            try:
+                item = await asyncio.wait_for(items.get(), timeout=max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                item = None
+            now = time.monotonic()
+            frames = builder.handle(*item, now) if item else []
+            frames.extend(builder.flush_due(now))
+            if frames:
+                next_heartbeat = now + heartbeat_interval
+                yield ''.join(frames)
+            elif now >= next_heartbeat:
+                next_heartbeat = now + heartbeat_interval
+                yield HEARTBEAT
+    finally:
+        for producer in producers:
+            producer.cancel()
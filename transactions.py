@@ -0,0 +1,257 @@
+import heapq
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+def _error_message(error):
+    if error.args and isinstance(error.args[0], dict):
+        return str(error.args[0].get('message', '')).lower()
+    return str(error).lower()
+
+
+class NonceManager:
+    """In-process nonce allocator for a single signing account.
+
+    Nonces are handed out from a local counter so concurrent senders never
+    read the same value from the node. Nonces whose transaction never reached
+    the node are released and handed out again before new ones, and the
+    counter is resynchronised with the node's pending count when it reports
+    that our view has drifted (e.g. another process used the account).
+    """
+
+    def __init__(self, web3, address):
+        self.web3 = web3
+        self.address = address
+        self._lock = threading.Lock()
+        self._next = None
+        self._released = []
+        self._pending = {}
+
+    def allocate(self):
+        with self._lock:
+            if self._released:
+                return heapq.heappop(self._released)
+            if self._next is None:
+                self._next = self.web3.eth.get_transaction_count(self.address, 'pending')
+            nonce = self._next
+            self._next += 1
+            return nonce
+
+    def release(self, nonce):
+        with self._lock:
+            if self._next is not None and nonce == self._next - 1:
+                self._next -= 1
+            elif nonce not in self._released:
+                heapq.heappush(self._released, nonce)
+
+    def track(self, nonce, tx_hash, txn):
+        with self._lock:
+            self._pending[nonce] = {'tx_hash': tx_hash, 'txn': txn, 'sent_at': time.monotonic()}
+
+    def pending(self):
+        with self._lock:
+            return dict(self._pending)
+
+    def resync(self):
+        chain_nonce = self.web3.eth.get_transaction_count(self.address, 'pending')
+        with self._lock:
+            self._next = max(chain_nonce, max(self._pending, default=-1) + 1)
+            self._released = [nonce for nonce in self._released if nonce >= chain_nonce]
+            heapq.heapify(self._released)
+        logger.info(f"Nonce resynchronised, next nonce: {self._next}")
+
+    def confirm_mined(self):
+        """Forget transactions whose nonce the chain has already consumed."""
+        mined_nonce = self.web3.eth.get_transaction_count(self.address, 'latest')
+        with self._lock:
+            for nonce in [nonce for nonce in self._pending if nonce < mined_nonce]:
+                del self._pending[nonce]
+            self._released = [nonce for nonce in self._released if nonce >= mined_nonce]
+            heapq.heapify(self._released)
+        return mined_nonce
+
+    def gaps(self):
+        """Released nonces that block higher in-flight transactions."""
+        with self._lock:
+            highest = max(self._pending, default=-1)
+            return [nonce for nonce in self._released if nonce < highest]
+
+    def take(self, nonce):
+        with self._lock:
+            if nonce in self._released:
+                self._released.remove(nonce)
+                heapq.heapify(self._released)
+                return True
+            return False
+
+
+class TransactionPipeline:
+    """Signs and broadcasts contract transactions from a submission queue.
+
+    Callers get a Future for the transaction hash and never wait for a block,
+    so any number of transactions can be in flight at once. When idle, the
+    sender thread drops mined transactions, fills nonce gaps left by failed
+    sends with no-op self transfers and re-broadcasts transactions stuck for
+    longer than `replace_after` seconds with a bumped gas price.
+    """
+
+    MAX_SEND_ATTEMPTS = 3
+    GAS_PRICE_BUMP = 1.125  # Nodes require at least +10% to replace a pending transaction
+    REPLACEMENT_TTL = 3600.0  # Replacements nobody forgot, e.g. of a transaction never watched, are dropped after this
+
+    def __init__(self, web3, account, private_key, chain_id, gas, gas_price,
+                 replace_after=60.0, max_gas_price=None, maintenance_interval=5.0):
+        self.web3 = web3
+        self.account = account
+        self.private_key = private_key
+        self.chain_id = chain_id
+        self.gas = gas
+        self.gas_price = gas_price
+        self.replace_after = replace_after
+        self.max_gas_price = max_gas_price or gas_price * 4
+        self.maintenance_interval = maintenance_interval
+        self.nonces = NonceManager(web3, account.address)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._replacements = {}  # original tx hash -> (every hash sent for its nonce, original first; replaced at)
+
+    def submit(self, contract_function):
+        future = Future()
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='tx-pipeline', daemon=True)
+                self._thread.start()
+        self._queue.put((contract_function, future))
+        return future
+
+    def send(self, contract_function):
+        return self.submit(contract_function).result()
+
+    def sent_tx_hashes(self, tx_hash):
+        """Hashes of `tx_hash` and of every transaction that replaced it; any one of them may be the one mined."""
+        with self._lock:
+            return list(self._replacements.get(tx_hash, ([tx_hash],))[0])
+
+    def forget_replacement(self, tx_hash):
+        """Drop what replaced `tx_hash` once nobody looks it up any more, e.g. its receipt was found."""
+        with self._lock:
+            self._replacements.pop(tx_hash, None)
+
+    def _run(self):
+        last_maintenance = time.monotonic()
+        while True:
+            try:
+                contract_function, future = self._queue.get(timeout=self.maintenance_interval)
+            except queue.Empty:
+                contract_function = None
+            if contract_function is not None and future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self._send(contract_function))
+                except Exception as e:
+                    logger.error(f"Failed to send transaction: {str(e)}")
+                    future.set_exception(e)
+            if self._queue.empty() and time.monotonic() - last_maintenance >= self.maintenance_interval:
+                last_maintenance = time.monotonic()
+                try:
+                    self._maintain()
+                except Exception as e:
+                    logger.error(f"Error during transaction maintenance: {str(e)}")
+
+    def _build(self, contract_function, nonce, gas_price):
+        return contract_function.build_transaction({
+            'chainId': self.chain_id,
+            'gas': self.gas,
+            'gasPrice': gas_price,
+            'nonce': nonce
+        })
+
+    def _broadcast(self, txn):
+        signed_txn = self.web3.eth.account.sign_transaction(txn, private_key=self.private_key)
+        try:
+            return self.web3.eth.send_raw_transaction(signed_txn.rawTransaction)
+        except ValueError as e:
+            if 'already known' in _error_message(e):
+                return signed_txn.hash
+            raise
+
+    def _send(self, contract_function):
+        for attempt in range(self.MAX_SEND_ATTEMPTS):
+            nonce = self.nonces.allocate()
+            try:
+                txn = self._build(contract_function, nonce, self.gas_price)
+                tx_hash = self._broadcast(txn)
+            except ValueError as e:
+                message = _error_message(e)
+                if 'nonce too low' in message or 'replacement transaction underpriced' in message:
+                    # Somebody else consumed this nonce; catch up with the node and retry
+                    logger.warning(f"Nonce {nonce} already used ({message}), resynchronising")
+                    self.nonces.resync()
+                    continue
+                self.nonces.release(nonce)
+                raise
+            except Exception:
+                self.nonces.release(nonce)
+                raise
+            self.nonces.track(nonce, tx_hash, txn)
+            return tx_hash
+        raise RuntimeError(f"Could not allocate a usable nonce after {self.MAX_SEND_ATTEMPTS} attempts")
+
+    def _maintain(self):
+        if not self.nonces.pending() and not self.nonces.gaps():
+            return
+        self.nonces.confirm_mined()
+        pending = self.nonces.pending()
+        # Replacements are kept after their nonce is confirmed, until the response watcher has seen the receipt
+        with self._lock:
+            cutoff = time.monotonic() - self.REPLACEMENT_TTL
+            self._replacements = {original: replacement for original, replacement in self._replacements.items()
+                                  if replacement[1] > cutoff}
+
+        for nonce in self.nonces.gaps():
+            if not self.nonces.take(nonce):
+                continue
+            filler = {
+                'chainId': self.chain_id,
+                'to': self.account.address,
+                'value': 0,
+                'gas': 21000,
+                'gasPrice': self.gas_price,
+                'nonce': nonce
+            }
+            try:
+                tx_hash = self._broadcast(filler)
+            except Exception as e:
+                logger.error(f"Failed to fill nonce gap {nonce}: {str(e)}")
+                self.nonces.release(nonce)
+                continue
+            logger.info(f"Filled nonce gap {nonce} with tx {tx_hash.hex()}")
+            self.nonces.track(nonce, tx_hash, filler)
+
+        now = time.monotonic()
+        for nonce, entry in pending.items():
+            if now - entry['sent_at'] < self.replace_after:
+                continue
+            txn = dict(entry['txn'])
+            txn['gasPrice'] = min(int(txn['gasPrice'] * self.GAS_PRICE_BUMP), self.max_gas_price)
+            if txn['gasPrice'] <= entry['txn']['gasPrice']:
+                continue
+            try:
+                tx_hash = self._broadcast(txn)
+            except ValueError as e:
+                logger.warning(f"Could not replace stuck tx with nonce {nonce}: {_error_message(e)}")
+                continue
+            logger.info(f"Replaced stuck tx with nonce {nonce}, new tx hash: {tx_hash.hex()}")
+            self.nonces.track(nonce, tx_hash, txn)
+            with self._lock:
+                replaced_at = time.monotonic()
+                originals = [original for original, (sent, _) in self._replacements.items()
+                             if sent[-1] == entry['tx_hash']] or [entry['tx_hash']]
+                for original in originals:
+                    sent = self._replacements.get(original, ([original],))[0]
+                    self._replacements[original] = (sent + [tx_hash], replaced_at)
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import logging
+import secrets
+import threading
+import time
+
+from sqlalchemy.exc import IntegrityError
+
+from metrics import observe
+from models import db, Verification, VerificationToken, begin_write
+
+logger = logging.getLogger(__name__)
+
+
+def proof_digest(payload):
+    """sha256 of the proof fields of a /verify request, to recognise the same proof submitted again."""
+    fields = [payload.get(key) for key in ('merkle_root', 'proof', 'verification_level', 'signal')]
+    return hashlib.sha256(json.dumps(fields).encode()).hexdigest()
+
+
+def token_digest(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class VerificationStore:
+    """World ID nullifier hashes verified per action, valid for `ttl` seconds.
+
+    Each successful verification hands out a random token, which later
+    requests carry to show they come from that verified user; the nullifier
+    hash itself is no secret and proves nothing. Verifications and the
+    digests of their tokens are written to the database, and tokens are kept
+    in a dict in this process, so `verified_nullifier` is a dict lookup for
+    tokens issued here and one indexed query the first time another
+    worker's token is seen. The verify endpoint answers locally instead of
+    calling World ID again only when the very proof it accepted for a
+    nullifier and action is submitted again, see `reissue`.
+    """
+
+    def __init__(self, app, ttl=7 * 86400.0, prune_interval=60.0):
+        self.app = app
+        self.ttl = ttl
+        self.prune_interval = prune_interval
+        self._tokens = {}  # token digest -> (nullifier_hash, action, expires_at)
+        self._lock = threading.Lock()
+        self._pruned_at = time.monotonic()
+        self._counts = {'local_hits': 0, 'database_hits': 0, 'misses': 0, 'recorded': 0}
+
+    def verified_nullifier(self, token, action=None):
+        """The nullifier hash `token` was issued to, if unexpired and for `action` (any action if None), else None."""
+        if not token or not isinstance(token, str):
+            return None
+        token_hash = token_digest(token)
+        now = time.time()
+        entry = self._tokens.get(token_hash)
+        if entry is None:
+            with self.app.app_context(), observe('verification_lookup'):
+                row = db.session.get(VerificationToken, token_hash)
+            if row is not None:
+                entry = (row.nullifier_hash, row.action, row.expires_at)
+                with self._lock:
+                    self._tokens[token_hash] = entry
+            self._count('database_hits' if self._valid(entry, action, now) else 'misses')
+        elif self._valid(entry, action, now):
+            self._count('local_hits')
+        return entry[0] if self._valid(entry, action, now) else None
+
+    def reissue(self, nullifier_hash, action, proof_hash):
+        """A new token if the proof digested to `proof_hash` is the unexpired one verified for the nullifier and
+        action, else None."""
+        with self.app.app_context(), observe('verification_lookup'):
+            row = Verification.query.filter_by(nullifier_hash=nullifier_hash, action=action).first()
+            if row is None or row.proof_hash != proof_hash or row.expires_at <= time.time():
+                return None
+            expires_at = row.expires_at
+            token = self._add_token(nullifier_hash, action, expires_at)
+            db.session.commit()
+        self._cache(token, nullifier_hash, action, expires_at)
+        return token
+
+    def record(self, nullifier_hash, action, verification_level=None, proof_hash=None):
+        """Store a verification World ID accepted and return a token for it."""
+        now = time.time()
+        expires_at = now + self.ttl
+        with self.app.app_context(), observe('db_commit'):
+            begin_write()
+            row = Verification.query.filter_by(nullifier_hash=nullifier_hash, action=action).first()
+            if row is None:
+                db.session.add(Verification(nullifier_hash=nullifier_hash, action=action,
+                                            verification_level=verification_level, proof_hash=proof_hash,
+                                            verified_at=now, expires_at=expires_at))
+            else:
+                row.verification_level = verification_level
+                row.proof_hash = proof_hash
+                row.verified_at = now
+                row.expires_at = expires_at
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # Another worker recorded the same verification first
+                db.session.rollback()
+            token = self._add_token(nullifier_hash, action, expires_at)
+            db.session.commit()
+        self._cache(token, nullifier_hash, action, expires_at)
+        self._count('recorded')
+        return token
+
+    def stats(self):
+        with self._lock:
+            return {**self._counts, 'entries': len(self._tokens)}
+
+    def _add_token(self, nullifier_hash, action, expires_at):
+        # Called in an app context; the caller commits
+        token = secrets.token_urlsafe(32)
+        db.session.add(VerificationToken(token_hash=token_digest(token), nullifier_hash=nullifier_hash,
+                                         action=action, expires_at=expires_at))
+        if time.monotonic() - self._pruned_at >= self.prune_interval:
+            VerificationToken.query.filter(VerificationToken.expires_at <= time.time()).delete()
+        return token
+
+    def _cache(self, token, nullifier_hash, action, expires_at):
+        with self._lock:
+            self._tokens[token_digest(token)] = (nullifier_hash, action, expires_at)
+            if time.monotonic() - self._pruned_at >= self.prune_interval:
+                self._prune(time.time())
+
+    @staticmethod
+    def _valid(entry, action, now):
+        return entry is not None and entry[2] > now and (action is None or entry[1] == action)
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def _prune(self, now):
+        self._tokens = {token_hash: entry for token_hash, entry in self._tokens.items() if entry[2] > now}
+        self._pruned_at = time.monotonic()
@@ -0,0 +1,232 @@
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+
+from metrics import observe
+from models import db, Vote, SCORE_MODELS
+
+logger = logging.getLogger(__name__)
+
+PendingVote = namedtuple('PendingVote', ['id', 'kind', 'contestant_a', 'contestant_b', 'result', 'created_at'])
+
+
+class VoteApplier:
+    """Logs submitted votes, applies them to a RatingStore and checkpoints the ratings in batches.
+
+    A vote is committed to the vote log before `submit` returns, and changes
+    the in-memory ratings right after. The log is group-committed: a writer
+    thread inserts the votes submitted within `log_window` seconds of each
+    other (at most `max_batch`) in one transaction, and each caller waits for
+    the commit of its batch. At most `max_delay` seconds later
+    (sooner once `max_batch` votes are waiting) a single transaction adds
+    the buffered votes' rating and vote count changes to the score rows,
+    marks the votes applied and calls `on_vote(vote)` for each, e.g. to queue
+    payouts in the same transaction. A failed checkpoint is retried with
+    the next one; after `max_failures` in a row the next checkpoint writes
+    the votes one by one and parks those that still fail, so one bad vote
+    can't hold up the others. Parked votes stay unapplied in the log. Votes
+    still buffered when the process exits are checkpointed by `flush()`;
+    those a crash leaves unapplied stay in the log and are applied by
+    `recover()`.
+    """
+
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, app, ratings, on_vote=None, max_delay=0.5, max_batch=500, on_applied=None, max_failures=3,
+                 log_window=0.005):
+        self.app = app
+        self.ratings = ratings
+        self.on_vote = on_vote
+        # Called with each kind of score ('model', 'agent') changed by a committed batch
+        self.on_applied = on_applied
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.max_failures = max_failures
+        self.log_window = log_window
+        self.failures = 0
+        self.parked = 0
+        self._wakeup = threading.Event()
+        self._batch_full = threading.Event()
+        self._checkpoint_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._log_queue = queue.Queue()
+        self._log_thread = None
+
+    def submit(self, kind, contestant_a, contestant_b, result):
+        """Log and apply a vote; returns False if a contestant is not on the leaderboard."""
+        if not self.ratings.knows(kind, contestant_a, contestant_b):
+            return False
+        self.ratings.apply(self.log(kind, contestant_a, contestant_b, result))
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='vote-applier', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+        if self.ratings.pending() >= self.max_batch:
+            self._batch_full.set()
+        return True
+
+    def pending(self):
+        return self.ratings.pending()
+
+    def flush(self):
+        return self.checkpoint()
+
+    def log(self, kind, contestant_a, contestant_b, result):
+        """Commit a vote to the log with the others submitted meanwhile and return it as a PendingVote."""
+        future = Future()
+        with self._lock:
+            if self._log_thread is None or not self._log_thread.is_alive():
+                self._log_thread = threading.Thread(target=self._run_log, name='vote-log', daemon=True)
+                self._log_thread.start()
+        self._log_queue.put(((kind, contestant_a, contestant_b, result), future))
+        return future.result()
+
+    def _run_log(self):
+        while True:
+            batch = [self._log_queue.get()]
+            deadline = time.monotonic() + self.log_window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._log_queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                votes = self._write_log([fields for fields, _ in batch])
+            except Exception as e:
+                logger.error(f"Failed to log {len(batch)} votes: {str(e)}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), vote in zip(batch, votes):
+                future.set_result(vote)
+
+    def _write_log(self, batch):
+        now = time.time()
+        with self.app.app_context(), observe('db_commit'):
+            try:
+                rows = [Vote(kind=kind, contestant_a=contestant_a, contestant_b=contestant_b, result=result,
+                             created_at=now) for kind, contestant_a, contestant_b, result in batch]
+                db.session.add_all(rows)
+                # The ids are read before the commit expires the rows, rather than loading each again
+                db.session.flush()
+                votes = [PendingVote(row.id, row.kind, row.contestant_a, row.contestant_b, row.result,
+                                     row.created_at) for row in rows]
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            return votes
+
+    def recover(self):
+        """Apply the logged votes no checkpoint applied, e.g. those of a crashed worker; returns how many.
+
+        Run it while no worker is serving votes, as `init-db` does: a live
+        worker's votes are unapplied until its next checkpoint.
+        """
+        with self.app.app_context():
+            votes = [PendingVote(row.id, row.kind, row.contestant_a, row.contestant_b, row.result, row.created_at)
+                     for row in Vote.query.filter(Vote.applied_at.is_(None)).order_by(Vote.id)]
+        recovered = 0
+        parked = self.parked
+        for vote in votes:
+            if self.ratings.apply(vote):
+                recovered += 1
+            else:
+                logger.error(f"Not applying vote {vote.id}: {vote.contestant_a} or {vote.contestant_b} is not on the "
+                             f"{vote.kind} leaderboard")
+        if recovered and not self.flush():
+            self.checkpoint(one_by_one=True)
+        return recovered - (self.parked - parked)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            self._batch_full.wait(self.max_delay)
+            self._batch_full.clear()
+            if not self.checkpoint():
+                self._wakeup.set()
+
+    def checkpoint(self, one_by_one=False):
+        """Write the votes applied since the last checkpoint; returns False if they were kept for the next one."""
+        with self._checkpoint_lock:
+            applied, changes = self.ratings.take_pending()
+            written = False
+            try:
+                if not applied:
+                    written = True
+                elif one_by_one or self.failures >= self.max_failures:
+                    written = self._write_one_by_one(applied)
+                else:
+                    written = self._write_with_retries(applied, changes)
+            finally:
+                self.ratings.finish_checkpoint(applied, changes, written)
+                self.failures = 0 if written else self.failures + 1
+        if applied and written:
+            # Also drops the changes of parked votes from the ratings
+            for kind in {item.vote.kind for item in applied}:
+                self.ratings.reload(kind)
+                if self.on_applied:
+                    self.on_applied(kind)
+        return written
+
+    def _write_with_retries(self, applied, changes):
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            try:
+                with self.app.app_context():
+                    self.write(applied, changes)
+                return True
+            except Exception as e:
+                logger.error(f"Failed to write {len(applied)} votes (attempt {attempt}): {str(e)}")
+                time.sleep(self.max_delay * attempt)
+        logger.error(f"Keeping {len(applied)} votes for the next checkpoint after {self.MAX_ATTEMPTS} attempts")
+        return False
+
+    def _write_one_by_one(self, applied):
+        logger.warning(f"Writing {len(applied)} votes one by one after {self.failures} failed checkpoints")
+        for item in applied:
+            vote = item.vote
+            # A contestant against itself changes nothing, see RatingStore.apply
+            changes = {vote.kind: [(vote.contestant_a, item.score_change_a, 1),
+                                   (vote.contestant_b, item.score_change_b, 1)]
+                       if vote.contestant_a != vote.contestant_b else []}
+            try:
+                with self.app.app_context():
+                    self.write([item], changes)
+            except Exception as e:
+                # Left unapplied in the log, where recover() picks it up again
+                self.parked += 1
+                logger.error(f"Parking vote {vote.id} ({vote.kind}: {vote.contestant_a} vs {vote.contestant_b}, "
+                             f"result {vote.result}): {str(e)}")
+        return True
+
+    def write(self, applied, changes):
+        try:
+            votes_table = Vote.__table__
+            db.session.execute(
+                votes_table.update().where(votes_table.c.id == db.bindparam('vote_id')).values(applied_at=time.time()),
+                [{'vote_id': item.vote.id} for item in applied])
+            for kind, rows in changes.items():
+                if not rows:
+                    continue
+                table = SCORE_MODELS[kind].__table__
+                # Changes are added rather than written over, so processes checkpointing at once all count
+                db.session.execute(
+                    table.update().where(table.c.name == db.bindparam('contestant')).values(
+                        score=table.c.score + db.bindparam('score_change'),
+                        votes=table.c.votes + db.bindparam('vote_change')),
+                    [{'contestant': name, 'score_change': score_change, 'vote_change': vote_change}
+                     for name, score_change, vote_change in rows])
+            if self.on_vote:
+                for item in applied:
+                    self.on_vote(item.vote)
+            with observe('db_commit'):
+                db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise